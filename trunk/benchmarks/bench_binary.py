@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+"""Benchmark for the encoding of rows, in the text and binary formats
+of COPY.
+
+No backend is required.
+
+$Id$
+
+THIS SOFTWARE IS UNDER MIT LICENSE.
+Copyright (c) 2006 Perillo Manlio (manlio.perillo@gmail.com)
+
+Read LICENSE file for more informations.
+"""
+
+import sys
+import time
+import datetime
+sys.path.append("../")
+
+from pglib import bulk
+from pglib import binary
+
+
+# number of rows for each test
+N = 200000
+
+NOW = datetime.datetime(2006, 1, 1, 12, 0, 0)
+
+TESTS = [
+    ("integers", ["int4", "int8", "int4", "int8"],
+     (123456, 1234567890123, 42, 7)),
+    ("floats", ["float8", "float8", "float8"],
+     (3.14159, 2.71828, 1.41421)),
+    ("mixed", ["int4", "text", "float8", "timestamp"],
+     (123456, "some text for the benchmark", 3.14159, NOW)),
+    ]
+
+
+def benchText(rows):
+    encodeRow = bulk.encodeRow
+
+    start = time.time()
+    size = 0
+    for row in rows:
+        size = size + len(encodeRow(row))
+
+    return time.time() - start, size
+
+def benchBinary(rows, types):
+    encodeRow = binary.BinaryEncoder(types).encodeRow
+
+    start = time.time()
+    size = 0
+    for row in rows:
+        size = size + len(encodeRow(row))
+
+    return time.time() - start, size
+
+
+def main():
+    for name, types, row in TESTS:
+        rows = [row] * N
+
+        times = []
+        for format, (elapsed, size) in [
+            ("text", benchText(rows)),
+            ("binary", benchBinary(rows, types))]:
+            times.append(elapsed)
+            print "%-10s %-8s %10.0f rows/s %8.1f MB/s" % (
+                name, format, N / elapsed, size / elapsed / 2 ** 20)
+
+        print "%-10s binary is %.2f times faster, in rows/s" % (
+            name, times[0] / times[1])
+
+
+if __name__ == "__main__":
+    main()
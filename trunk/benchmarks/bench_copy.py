@@ -0,0 +1,132 @@
+#! /usr/bin/env python
+"""Benchmark for COPY FROM STDIN of a file.
+
+No backend is required: the CopyInResponse is simulated, and data is
+discarded by the transport.
+
+Usage: bench_copy.py [size in MB]
+
+$Id$
+
+THIS SOFTWARE IS UNDER MIT LICENSE.
+Copyright (c) 2006 Perillo Manlio (manlio.perillo@gmail.com)
+
+Read LICENSE file for more informations.
+"""
+
+import os
+import sys
+import time
+import tempfile
+sys.path.append("../")
+
+from struct import pack
+
+from twisted.internet.address import IPv4Address
+
+from pglib import protocol
+from pglib import bulk
+
+
+# the size of the file, in MB
+SIZE = 100
+
+LINE = "123456\tsome text for the benchmark\t2006-01-01 12:00:00\n"
+
+
+def message(opcode, payload=""):
+    return pack("!cI", opcode, len(payload) + 4) + payload
+
+# the response to COPY ... FROM STDIN, with 3 text columns
+COPY_IN_RESPONSE = message("G", pack("!BHHHH", 0, 3, 0, 0, 0))
+
+
+class NullTransport(object):
+    producer = None
+
+    def write(self, data):
+        pass
+
+    def writeSequence(self, seq):
+        pass
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def loseConnection(self):
+        pass
+
+
+class SmallProducer(object):
+    # the naive producer, reading small chunks
+    def __init__(self, path):
+        self.file = open(path, "rb")
+
+    def description(self, ntuples, binaryTuples):
+        pass
+
+    def read(self):
+        return self.file.read(8192)
+
+    def close(self):
+        self.file.close()
+        return protocol.Result()
+
+
+def getProtocol():
+    addr = IPv4Address("TCP", "localhost", 5432)
+    p = protocol.PgProtocol(addr)
+    p.transport = NullTransport()
+    p.dataReceived = p._dataReceived # skip the SSL negotiation
+    p.debug = False
+
+    return p
+
+def makeFile(size):
+    fd, path = tempfile.mkstemp(".csv")
+    block = LINE * (2 ** 20 / len(LINE))
+    for i in xrange(size * 2 ** 20 / len(block)):
+        os.write(fd, block)
+    os.close(fd)
+
+    return path
+
+def bench(p, producer, size):
+    request = protocol.PgRequest("Q", "COPY bench FROM STDIN\0")
+    request.producer = producer
+    p.sendMessage(request)
+
+    start = time.time()
+    p.dataReceived(COPY_IN_RESPONSE)
+    elapsed = time.time() - start
+
+    # complete the request
+    p.dataReceived(message("C", "COPY\0") + message("Z", "I"))
+
+    return size / elapsed
+
+
+def main():
+    size = SIZE
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+
+    path = makeFile(size)
+    realSize = os.path.getsize(path) / float(2 ** 20)
+    try:
+        p = getProtocol()
+        for name, producer in [
+            ("read 8K", SmallProducer(path)),
+            ("read 1M", bulk.FileProducer(path)),
+            ("read 4M", bulk.FileProducer(path, blockSize=2 ** 22)),
+            ("mmap 1M", bulk.FileProducer(path, useMmap=True))]:
+            print "%-10s %8.1f MB/s" % (name, bench(p, producer, realSize))
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
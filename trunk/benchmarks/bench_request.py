@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+"""Benchmark for the per query overhead of the deferred and callback
+based APIs.
+
+No backend is required: responses are simulated.
+
+$Id$
+
+THIS SOFTWARE IS UNDER MIT LICENSE.
+Copyright (c) 2006 Perillo Manlio (manlio.perillo@gmail.com)
+
+Read LICENSE file for more informations.
+"""
+
+import sys
+import time
+sys.path.append("../")
+
+from struct import pack
+
+from twisted.internet.address import IPv4Address
+
+from pglib import protocol
+
+
+# number of queries for each test
+N = 100000
+
+
+def message(opcode, payload=""):
+    return pack("!cI", opcode, len(payload) + 4) + payload
+
+# the response to SELECT 1
+RESPONSE = message("D", pack("!Hi", 1, 1) + "1") + \
+    message("C", "SELECT\0") + message("Z", "I")
+
+
+class NullTransport(object):
+    def write(self, data):
+        pass
+
+    def writeSequence(self, seq):
+        pass
+
+    def loseConnection(self):
+        pass
+
+
+def getProtocol():
+    addr = IPv4Address("TCP", "localhost", 5432)
+    p = protocol.PgProtocol(addr)
+    p.transport = NullTransport()
+    p.dataReceived = p._dataReceived # skip the SSL negotiation
+    p.debug = False
+    
+    return p
+
+def benchDeferred(p):
+    def callback(result):
+        pass
+
+    start = time.time()
+    for i in xrange(N):
+        p.execute("SELECT 1").addCallback(callback)
+        p.dataReceived(RESPONSE)
+
+    return time.time() - start
+
+def benchCallback(p):
+    def callback(result):
+        pass
+
+    start = time.time()
+    for i in xrange(N):
+        p.sendQuery("SELECT 1", callback)
+        p.dataReceived(RESPONSE)
+
+    return time.time() - start
+
+def benchNothing(p):
+    # the cost of parsing the response
+    start = time.time()
+    for i in xrange(N):
+        p._last = protocol.PgRequest("Q", "", lambda _: None)
+        p.dataReceived(RESPONSE)
+
+    return time.time() - start
+
+
+def main():
+    p = getProtocol()
+    
+    base = benchNothing(p)
+    for name, func in [("deferred", benchDeferred),
+                       ("callback", benchCallback)]:
+        elapsed = func(p)
+        print "%-10s %8.0f queries/s, %6.2f us/query overhead" % (
+            name, N / elapsed, (elapsed - base) / N * 1e6)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#! /usr/bin/env python
+"""Benchmark for query templates interpolation.
+
+$Id$
+
+THIS SOFTWARE IS UNDER MIT LICENSE.
+Copyright (c) 2006 Perillo Manlio (manlio.perillo@gmail.com)
+
+Read LICENSE file for more informations.
+"""
+
+import sys
+import time
+sys.path.append("../")
+
+from pglib import template
+
+
+# number of parameters to test
+SIZES = [1, 2, 5, 10, 20, 50, 100]
+
+# number of seconds for each test
+DURATION = 1.0
+
+
+def bench(func):
+    """Return the number of calls per second of func.
+    """
+
+    n = 0
+    calls = 100
+    start = time.time()
+    while True:
+        for i in xrange(calls):
+            func()
+        n = n + calls
+
+        elapsed = time.time() - start
+        if elapsed >= DURATION:
+            return n / elapsed
+
+
+def main():
+    quote = template.Quoter()
+
+    print "%6s %14s %14s %10s" % ("params", "compiled/s", "uncached/s",
+                                  "MB/s")
+    for size in SIZES:
+        query = "INSERT INTO t VALUES (" + \
+            ", ".join(["%s"] * size) + ")"
+        params = []
+        for i in range(size):
+            if i % 2:
+                params.append("it's value %d" % i)
+            else:
+                params.append(i)
+        params = tuple(params)
+
+        tpl = template.compile(query)
+        length = len(tpl.interpolate(params, quote))
+
+        compiled = bench(lambda: template.compile(query).interpolate(
+                params, quote))
+        uncached = bench(lambda: template.Template(query).interpolate(
+                params, quote))
+
+        print "%6d %14.0f %14.0f %10.2f" % (
+            size, compiled, uncached, compiled * length / 2.0 ** 20)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+"""Benchmark for the encoding and decoding of rows in the text format
+of COPY.
+
+No backend is required.
+
+$Id$
+
+THIS SOFTWARE IS UNDER MIT LICENSE.
+Copyright (c) 2006 Perillo Manlio (manlio.perillo@gmail.com)
+
+Read LICENSE file for more informations.
+"""
+
+import sys
+import time
+import datetime
+sys.path.append("../")
+
+from pglib import textcopy
+
+
+# number of rows for each test
+N = 200000
+
+NOW = datetime.datetime(2006, 1, 1, 12, 0, 0)
+
+TESTS = [
+    ("integers", (123456, 1234567890123, 42, 7)),
+    ("mixed", (123456, "some text for the benchmark", 3.14159, NOW)),
+    ("nulls", (123456, None, "some text for the benchmark", None)),
+    ("escapes", (123456, "some\ttext\nfor the\\benchmark", None, NOW)),
+    ]
+
+
+def benchEncode(rows):
+    encodeRow = textcopy.encodeRow
+
+    start = time.time()
+    lines = [encodeRow(row) for row in rows]
+    elapsed = time.time() - start
+
+    return elapsed, lines
+
+def benchDecode(lines):
+    decodeLine = textcopy.decodeLine
+
+    start = time.time()
+    rows = [decodeLine(line) for line in lines]
+
+    return time.time() - start
+
+def benchDecodeBlock(data):
+    start = time.time()
+    textcopy.decodeLines(data)
+
+    return time.time() - start
+
+
+def main():
+    for name, row in TESTS:
+        rows = [row] * N
+
+        elapsed, lines = benchEncode(rows)
+        data = "".join(lines)
+        size = len(data) / float(2 ** 20)
+
+        for what, elapsed in [
+            ("encode", elapsed),
+            ("decode", benchDecode(lines)),
+            ("decode block", benchDecodeBlock(data))]:
+            print "%-10s %-12s %10.0f rows/s %8.1f MB/s" % (
+                name, what, N / elapsed, size / elapsed)
+
+
+if __name__ == "__main__":
+    main()
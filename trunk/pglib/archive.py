@@ -0,0 +1,295 @@
+"""Compressed archives of COPY TO STDOUT.
+
+$Id$
+
+THIS SOFTWARE IS UNDER MIT LICENSE.
+Copyright (c) 2006 Perillo Manlio (manlio.perillo@gmail.com)
+
+Read LICENSE file for more informations.
+"""
+
+import time
+import zlib
+import Queue
+import threading
+from struct import pack
+
+from zope.interface import implements
+
+from twisted.python import log, failure
+from twisted.internet import defer
+
+import ipg
+import protocol
+
+
+class GzipCompressor(object):
+    """An incremental compressor for the gzip format, with the
+    interface of the zlib compression objects.
+    """
+
+    def __init__(self, level=6):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                            -zlib.MAX_WBITS,
+                                            zlib.DEF_MEM_LEVEL, 0)
+        self._crc = zlib.crc32("")
+        self._size = 0
+        self._header = True
+
+    def compress(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._size = self._size + len(data)
+
+        data = self._compressor.compress(data)
+        if self._header:
+            # magic, deflate, no flags, mtime, max compression, unknown OS
+            data = "\037\213\010\000" + pack("<I", long(time.time())) + \
+                "\002\377" + data
+            self._header = False
+
+        return data
+
+    def flush(self):
+        data = ""
+        if self._header:
+            data = self.compress("")
+
+        return data + self._compressor.flush() + pack(
+            "<II", self._crc & 0xffffffffL, self._size & 0xffffffffL)
+
+
+def compressor(method, level=6):
+    """Return an incremental compressor for the given method: gzip,
+    zlib or bz2.
+    """
+
+    if method == "gzip":
+        return GzipCompressor(level)
+    elif method == "zlib":
+        return zlib.compressobj(level)
+    elif method == "bz2":
+        import bz2
+
+        return bz2.BZ2Compressor(max(level, 1))
+    else:
+        raise ValueError("unknown compression method: %r" % method)
+
+
+class ArchiveConsumer(object):
+    """An implementation of the L{pglib.ipg.IConsumer} interface, that
+    compresses the data of COPY TO STDOUT as it arrives, writing it to
+    a file.
+
+    With C{threaded} set, compression and writes are done in a worker
+    thread, and the reactor only queues the data: when C{maxQueue}
+    chunks are waiting for the worker, the transport of the connection
+    is paused, and it is resumed when the worker has caught up.  The
+    worker also closes the file, so the archive is complete only when
+    the C{finished} deferred fires.  Set
+    L{pglib.protocol.PgProtocol.copyBufferSize} to queue larger chunks.
+
+    Errors are logged, and the rest of the data is discarded.
+
+    The result returned by L{close} has a C{stats} attribute: a
+    dictionary with the bytes (uncompressed), compressed, ratio,
+    elapsed and rate (of uncompressed data, in MB/s) keys.  In threaded
+    mode the dictionary is filled only when C{finished} fires.
+
+    @ivar error: the first error, if any
+    @type error: Exception
+
+    @ivar finished: a deferred that will fire with the result of
+                    L{close}, once the archive has been written
+    @type finished: L{twisted.internet.defer.Deferred}
+    """
+
+    implements(ipg.IConsumer)
+
+    error = None
+
+    def __init__(self, file, method="gzip", level=6, threaded=False,
+                 maxQueue=64, connection=None):
+        """Initialize the consumer.
+
+        @param file: a path or a file object; a path is opened for
+                     writing and closed at the end
+
+        @param method: the compression method: gzip, zlib or bz2
+        @type method: str
+
+        @param level: the compression level, from 1 to 9
+        @type level: int
+
+        @param threaded: if True, compress in a worker thread
+        @type threaded: bool
+
+        @param maxQueue: the number of chunks waiting for the worker,
+                         after that the connection is paused
+        @type maxQueue: int
+
+        @param connection: the connection running the COPY, required
+                           in threaded mode
+        @type connection: L{pglib.protocol.PgProtocol}
+        """
+
+        if threaded and connection is None:
+            raise ValueError("a connection is required in threaded mode")
+
+        self.file = file
+        self.method = method
+        self.level = level
+        self.threaded = threaded
+        self.maxQueue = maxQueue
+        self.connection = connection
+
+        self.finished = None
+        self._fp = None
+        self._compressor = None
+        self._queue = None
+        self._thread = None
+
+    def description(self, ntuples, binaryTuples):
+        self.ntuples = ntuples
+        self.binaryTuples = binaryTuples
+
+        self.error = None
+        self.finished = defer.Deferred()
+        self._bytes = 0
+        self._compressed = 0
+        self._start = time.time()
+        self._result = None
+        self._queued = 0 # chunks waiting for the worker
+        self._paused = False
+
+        try:
+            if isinstance(self.file, basestring):
+                self._fp = open(self.file, "wb")
+            else:
+                self._fp = self.file
+            self._compressor = compressor(self.method, self.level)
+        except Exception, error:
+            self._fail(error)
+            return
+
+        if self.threaded:
+            self._queue = Queue.Queue()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def _fail(self, error):
+        # helper method
+        if self.error is None:
+            self.error = error
+            log.err(failure.Failure(error))
+
+    def _compress(self, data):
+        # helper method
+        if self.error is not None:
+            return
+
+        try:
+            data = self._compressor.compress(data)
+            if data:
+                self._fp.write(data)
+                self._compressed = self._compressed + len(data)
+        except Exception, error:
+            self._fail(error)
+
+    def _finish(self):
+        # helper method
+        if self.error is not None:
+            return
+
+        try:
+            data = self._compressor.flush()
+            self._fp.write(data)
+            self._compressed = self._compressed + len(data)
+        except Exception, error:
+            self._fail(error)
+
+    def _closeFile(self):
+        # helper method
+        if self._fp is not None and self._fp is not self.file:
+            try:
+                self._fp.close()
+            except Exception, error:
+                self._fail(error)
+        self._fp = None
+
+    def _run(self):
+        # the worker thread
+        from twisted.internet import reactor
+
+        get = self._queue.get
+        while True:
+            data = get()
+            if data is None:
+                break
+
+            self._compress(data)
+            reactor.callFromThread(self._dequeued)
+
+        self._finish()
+        self._closeFile()
+        reactor.callFromThread(self._done)
+
+    def _dequeued(self):
+        # the worker has compressed a chunk
+        self._queued = self._queued - 1
+        if self._paused and self._queued <= self.maxQueue // 2:
+            self._paused = False
+            self.connection.transport.resumeProducing()
+
+    def _done(self):
+        # all the data has been written
+        self._queue = None
+        self._thread = None
+
+        elapsed = time.time() - self._start
+        stats = self._result.stats
+        stats.update({"bytes": self._bytes, "compressed": self._compressed,
+                      "elapsed": elapsed})
+        if self._compressed:
+            stats["ratio"] = self._bytes / float(self._compressed)
+        else:
+            stats["ratio"] = 0.0
+        if elapsed:
+            stats["rate"] = self._bytes / elapsed / 2 ** 20
+        else:
+            stats["rate"] = 0.0
+
+        self.finished.callback(self._result)
+
+    def write(self, data):
+        self._bytes = self._bytes + len(data)
+
+        if self._queue is not None:
+            self._queue.put(data)
+            self._queued = self._queued + 1
+            if self._queued >= self.maxQueue and not self._paused:
+                self._paused = True
+                self.connection.transport.pauseProducing()
+        else:
+            self._compress(data)
+
+    def writeSequence(self, seq):
+        self.write("".join(seq))
+
+    def close(self):
+        result = protocol.Result()
+        result.ntuples = self.ntuples
+        result.binaryTuples = self.binaryTuples
+        result.status = protocol.PGRES_COPY_OUT
+        result.stats = {}
+        self._result = result
+
+        if self._queue is not None:
+            # the worker will call _done
+            self._queue.put(None)
+        else:
+            self._finish()
+            self._closeFile()
+            self._done()
+
+        return result
@@ -0,0 +1,436 @@
+"""Client side batching of statements.
+
+$Id$
+
+THIS SOFTWARE IS UNDER MIT LICENSE.
+Copyright (c) 2006 Perillo Manlio (manlio.perillo@gmail.com)
+
+Read LICENSE file for more informations.
+"""
+
+from zope.interface import implements
+
+from twisted.internet import defer
+
+import ipg
+import protocol
+
+
+class ResultsConsumer(protocol.RowConsumer):
+    """An implementation of the L{pglib.ipg.IRowConsumer} interface,
+    that keeps the result of each command of a simple query.
+
+    @ivar results: the results of the completed commands
+    @type results: list
+    """
+
+    implements(ipg.IRowConsumer)
+
+    def __init__(self):
+        protocol.RowConsumer.__init__(self)
+        self.results = []
+
+    def complete(self, status, oid, rows):
+        result = protocol.RowConsumer.complete(self, status, oid, rows)
+        self.results.append(result)
+
+        return result
+
+
+class StatementBatcher(object):
+    """Merge statements in a single simple query, saving round trips.
+
+    Statements are queued, and sent to the backend as a single Query
+    message when C{maxStatements} statements are queued, or after
+    C{maxDelay} seconds from the first one (with the default of 0,
+    all the statements issued in the same reactor iteration are
+    merged).
+
+    Each statement gets its own result.
+
+    All the statements of a batch are executed in the same
+    transaction: when one fails, the others are rolled back by the
+    backend, so they are executed again in a new batch.  When the
+    batch fails before the first statement (as with a syntax error,
+    that is detected when the whole query is parsed), the statements
+    are executed one by one.
+
+    @note: Statements must be independent, each with only one
+           command, and the connection must not be used for explicit
+           transactions.
+    """
+
+    def __init__(self, protocol, maxStatements=50, maxDelay=0):
+        self.protocol = protocol
+        self.maxStatements = maxStatements
+        self.maxDelay = maxDelay
+
+        self._pending = [] # list of (query, deferred)
+        self._call = None
+
+    def execute(self, query, params=None):
+        """Queue a statement.
+
+        @param query: the statement, with only one command
+        @type query: str
+
+        @param params: the parameters to be interpolated, see
+                       L{pglib.protocol.PgProtocol.execute}
+        @type params: sequence or dict
+
+        @return: a deferred that will fire with the result of the
+                 statement
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        if params is not None:
+            query = self.protocol.interpolate(query, params)
+
+        query = query.strip().rstrip(";")
+        if not query:
+            return defer.fail(ValueError("empty statement"))
+
+        d = defer.Deferred()
+        self._pending.append((query, d))
+
+        if len(self._pending) >= self.maxStatements:
+            self.flush()
+        elif self._call is None:
+            from twisted.internet import reactor
+
+            self._call = reactor.callLater(self.maxDelay, self.flush)
+
+        return d
+
+    def flush(self):
+        """Send the queued statements now.
+        """
+
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+
+        while self._pending:
+            batch = self._pending[:self.maxStatements]
+            del self._pending[:self.maxStatements]
+
+            self._send(batch)
+
+    def _send(self, batch):
+        # helper method
+        consumer = ResultsConsumer()
+
+        query = ";\n".join([query for query, _ in batch])
+        request = protocol.PgRequest("Q", query + "\0")
+        request.rowConsumer = consumer
+
+        d = self.protocol.sendMessage(request)
+        d.addCallbacks(self._cbBatch, self._ebBatch,
+                       callbackArgs=(batch, consumer),
+                       errbackArgs=(batch, consumer))
+
+    def _cbBatch(self, _, batch, consumer):
+        for (query, d), result in zip(batch, consumer.results):
+            d.callback(result)
+
+    def _ebBatch(self, reason, batch, consumer):
+        if not consumer.results and len(batch) > 1:
+            # the whole query is parsed before executing it, so a
+            # syntax error (42601) in any statement fails the batch
+            # before the first one: execute them one by one
+            for item in batch:
+                self._send([item])
+            return
+
+        # the statements before the failed one have been rolled back
+        index = len(consumer.results)
+        if index >= len(batch):
+            # should not happen
+            index = len(batch) - 1
+
+        query, d = batch[index]
+        retry = batch[:index] + batch[index + 1:]
+
+        if retry:
+            self._pending[:0] = retry
+            self.flush()
+
+        d.errback(reason)
+
+
+class Loader(object):
+    """Coalesce point lookups in a single query.
+
+    The keys requested within C{maxDelay} seconds (with the default of
+    0, in the same reactor iteration) are collected, and looked up
+    with a single query, whose only placeholder is replaced by an
+    array with all the keys:
+
+      >>> loader = Loader(protocol,
+      ...                 "SELECT id, name FROM users WHERE id = ANY(%s)")
+      >>> d = loader.load(42)
+
+    The rows are then dispatched to each caller, by the value of the
+    C{key} column, compared with C{convert(key)}.
+
+    @note: An explicit cast can be required for the array, as in
+           C{ANY(%s::int[])}.
+
+    @ivar queries: the number of queries executed
+    @type queries: int
+
+    @ivar requests: the number of keys requested
+    @type requests: int
+    """
+
+    def __init__(self, protocol, query, key=0, convert=str,
+                 maxKeys=500, maxDelay=0):
+        """Initialize the loader.
+
+        @param query: the lookup query, with one placeholder
+        @type query: str
+
+        @param key: the index of the column with the key, in the rows
+        @type key: int
+
+        @param convert: the function that converts a key to the text
+                        returned by the backend
+        @type convert: callable
+
+        @param maxKeys: the maximum number of keys in a single query
+        @type maxKeys: int
+        """
+        
+        self.protocol = protocol
+        self.query = query
+        self.key = key
+        self.convert = convert
+        self.maxKeys = maxKeys
+        self.maxDelay = maxDelay
+
+        self.queries = 0
+        self.requests = 0
+
+        self._keys = []    # keys in the order of request
+        self._pending = {} # key -> list of deferreds
+        self._call = None
+
+    def load(self, key):
+        """Look up a key.
+
+        @return: a deferred that will fire with the list of the rows
+                 for the key (empty if the key is not found)
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        self.requests = self.requests + 1
+
+        d = defer.Deferred()
+        waiting = self._pending.get(key)
+        if waiting is None:
+            self._pending[key] = [d]
+            self._keys.append(key)
+        else:
+            waiting.append(d)
+
+        if len(self._keys) >= self.maxKeys:
+            self.flush()
+        elif self._call is None:
+            from twisted.internet import reactor
+
+            self._call = reactor.callLater(self.maxDelay, self.flush)
+
+        return d
+
+    def flush(self):
+        """Send the pending lookups now.
+        """
+
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+
+        while self._keys:
+            keys = self._keys[:self.maxKeys]
+            del self._keys[:self.maxKeys]
+
+            waiting = {}
+            for key in keys:
+                waiting[key] = self._pending.pop(key)
+
+            self.queries = self.queries + 1
+            d = self.protocol.execute(self.query, (keys, ))
+            d.addCallbacks(self._cbLoad, self._ebLoad,
+                           callbackArgs=(waiting, ),
+                           errbackArgs=(waiting, ))
+
+    def _cbLoad(self, result, waiting):
+        groups = {}
+        index = self.key
+        for row in result.rows:
+            groups.setdefault(row[index], []).append(row)
+
+        for key, deferreds in waiting.iteritems():
+            rows = groups.get(self.convert(key), [])
+            for d in deferreds:
+                d.callback(list(rows))
+
+    def _ebLoad(self, reason, waiting):
+        for deferreds in waiting.itervalues():
+            for d in deferreds:
+                d.errback(reason)
+
+
+class GroupCommit(object):
+    """Execute independent write statements in shared transactions,
+    so that a single commit (and a single WAL flush on the backend)
+    is paid for a group of statements.
+
+    Statements are collected for C{maxDelay} seconds, or until
+    C{maxStatements} are queued, and then executed in a transaction;
+    statements queued while a transaction is in progress make up the
+    next group.
+
+    Each statement is isolated by a savepoint, so that a failure only
+    rolls back the failed statement.
+    The deferred of a statement fires only after the transaction has
+    been committed; when the commit fails, all the statements of the
+    group fail.
+
+    @note: Statements must be independent, each with only one command,
+           and the connection must not be used for anything else.
+
+    @ivar groups: the number of transactions executed
+    @type groups: int
+    """
+
+    savepoint = "pglib_group"
+
+    def __init__(self, protocol, maxStatements=100, maxDelay=0.005):
+        self.protocol = protocol
+        self.maxStatements = maxStatements
+        self.maxDelay = maxDelay
+
+        self.groups = 0
+
+        self._pending = [] # list of (query, deferred)
+        self._running = False
+        self._call = None
+
+    def execute(self, query, params=None):
+        """Queue a statement.
+
+        @param query: the statement, with only one command
+        @type query: str
+
+        @param params: the parameters to be interpolated, see
+                       L{pglib.protocol.PgProtocol.execute}
+        @type params: sequence or dict
+
+        @return: a deferred that will fire with the result of the
+                 statement, once committed
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        if params is not None:
+            query = self.protocol.interpolate(query, params)
+
+        query = query.strip().rstrip(";")
+        if not query:
+            return defer.fail(ValueError("empty statement"))
+
+        d = defer.Deferred()
+        self._pending.append((query, d))
+
+        if self._running:
+            # will be executed in the next group
+            return d
+        
+        if len(self._pending) >= self.maxStatements:
+            self.flush()
+        elif self._call is None:
+            from twisted.internet import reactor
+
+            self._call = reactor.callLater(self.maxDelay, self.flush)
+
+        return d
+
+    def flush(self):
+        """Start a transaction for the queued statements now, unless
+        one is in progress.
+        """
+
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+
+        if self._running or not self._pending:
+            return
+
+        group = self._pending[:self.maxStatements]
+        del self._pending[:self.maxStatements]
+
+        self._running = True
+        self.groups = self.groups + 1
+        done = [] # list of (deferred, result)
+
+        # the savepoint is created by a command of its own, and
+        # created again after each successful statement, so that it
+        # exists even when a statement cannot be parsed
+        d = self.protocol.execute("BEGIN; SAVEPOINT %s" % self.savepoint)
+        d.addCallback(self._next, iter(group), done)
+        d.addCallback(lambda _: self.protocol.execute("COMMIT"))
+        d.addCallbacks(self._cbCommit, self._ebCommit,
+                       callbackArgs=(done, ), errbackArgs=(group, ))
+
+    def _next(self, _, statements, done):
+        # execute the next statement of the group
+        for query, d in statements:
+            savepoint = self.savepoint
+            request = protocol.PgRequest(
+                "Q", "%s;\nRELEASE SAVEPOINT %s; SAVEPOINT %s\0" % (
+                    query, savepoint, savepoint)
+                )
+            consumer = request.rowConsumer = ResultsConsumer()
+
+            r = self.protocol.sendMessage(request)
+            r.addCallbacks(self._cbStatement, self._ebStatement,
+                           callbackArgs=(d, consumer, done),
+                           errbackArgs=(d, ))
+            r.addCallback(self._next, statements, done)
+
+            return r
+
+    def _cbStatement(self, _, d, consumer, done):
+        done.append((d, consumer.results[0]))
+
+    def _ebStatement(self, reason, d):
+        d.errback(reason)
+
+        # the savepoint is kept
+        return self.protocol.execute(
+            "ROLLBACK TO SAVEPOINT %s" % self.savepoint)
+
+    def _cbCommit(self, _, done):
+        self._running = False
+        for d, result in done:
+            d.callback(result)
+
+        self.flush()
+
+    def _ebCommit(self, reason, group):
+        # make sure the transaction is not left aborted (a ROLLBACK
+        # outside a transaction only gives a warning)
+        d = self.protocol.execute("ROLLBACK")
+        d.addBoth(self._failGroup, reason, group)
+
+    def _failGroup(self, _, reason, group):
+        self._running = False
+        for query, d in group:
+            if not d.called:
+                d.errback(reason)
+
+        self.flush()
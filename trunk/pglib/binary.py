@@ -0,0 +1,610 @@
+"""The binary format of COPY.
+
+$Id$
+
+THIS SOFTWARE IS UNDER MIT LICENSE.
+Copyright (c) 2006 Perillo Manlio (manlio.perillo@gmail.com)
+
+Read LICENSE file for more informations.
+"""
+
+import sys
+import array
+import datetime
+from struct import pack, unpack, calcsize
+
+from zope.interface import implements
+
+import ipg
+import protocol
+
+try:
+    from struct import Struct
+except ImportError:
+    # Python 2.4
+    class Struct(object):
+        """A minimal replacement of the Struct class of Python 2.5.
+        """
+
+        def __init__(self, format):
+            self.format = format
+            self.size = calcsize(format)
+
+        def pack(self, *args):
+            return pack(self.format, *args)
+
+        def unpack(self, data):
+            return unpack(self.format, data)
+
+        def unpack_from(self, data, offset=0):
+            return unpack(self.format, data[offset:offset + self.size])
+
+
+SIGNATURE = "PGCOPY\n\377\r\n\0"
+HEADER = SIGNATURE + pack("!ii", 0, 0) # no flags, no header extension
+TRAILER = pack("!h", -1)
+NULL_FIELD = pack("!i", -1)
+
+# dates and timestamps are relative to 2000-01-01
+DATE_EPOCH = datetime.date(2000, 1, 1)
+TIMESTAMP_EPOCH = datetime.datetime(2000, 1, 1)
+
+# the format of fixed size types (the field length is included)
+FORMATS = {
+    "bool": "!iB",
+    "int2": "!ih",
+    "int4": "!ii",
+    "int8": "!iq",
+    "oid": "!iI",
+    "float4": "!if",
+    "float8": "!id",
+    "date": "!ii",
+    "timestamp": "!iq",
+    "timestamptz": "!iq",
+    }
+
+# types with a variable size, encoded as bytes
+VARIABLE = ("text", "varchar", "bpchar", "name", "bytea")
+
+# the NumPy types of the fixed size types (as sent by the backend)
+DTYPES = {
+    "bool": "u1",
+    "int2": ">i2",
+    "int4": ">i4",
+    "int8": ">i8",
+    "oid": ">u4",
+    "float4": ">f4",
+    "float8": ">f8",
+    "date": ">i4",
+    "timestamp": ">i8",
+    "timestamptz": ">i8",
+    }
+
+# common aliases
+ALIASES = {
+    "boolean": "bool",
+    "smallint": "int2",
+    "integer": "int4",
+    "int": "int4",
+    "bigint": "int8",
+    "real": "float4",
+    "double precision": "float8",
+    }
+
+
+def _days(value):
+    return (value - DATE_EPOCH).days
+
+def _microseconds(value):
+    # XXX the backend must use integer datetimes
+    delta = value - TIMESTAMP_EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + \
+        delta.microseconds
+
+# conversions of Python values, before packing
+CONVERSIONS = {
+    "date": _days,
+    "timestamp": _microseconds,
+    "timestamptz": _microseconds,
+    }
+
+
+def typeName(name):
+    """Return the canonical name of a type.
+    """
+
+    name = name.lower()
+    name = ALIASES.get(name, name)
+    if name not in FORMATS and name not in VARIABLE:
+        raise ValueError("unsupported type %r" % name)
+
+    return name
+
+
+class BinaryEncoder(object):
+    """Encode rows in the binary format of COPY.
+
+    Each column has a type, named as in PostgreSQL (see L{FORMATS}
+    and L{VARIABLE}); values are packed with precompiled structs.
+    When all the columns have a fixed size, rows without NULLs are
+    packed with a single struct.
+
+    @note: timestamps require a backend with integer datetimes, and
+           timestamptz values must be naive datetimes in UTC.
+    """
+
+    def __init__(self, types, encoding="utf_8"):
+        """Initialize the encoder.
+
+        @param types: the types of the columns
+        @type types: sequence of str
+
+        @param encoding: the encoding for unicode strings, that must
+                         match the client encoding
+        @type encoding: str
+        """
+
+        self.types = [typeName(name) for name in types]
+        self.encoding = encoding
+
+        self._count = pack("!h", len(self.types))
+        self._encoders = [self._encoder(name) for name in self.types]
+
+        self._row = None
+        self._conversions = None
+        if not [name for name in self.types if name in VARIABLE]:
+            # all fixed size
+            format = "!h" + "".join([FORMATS[name][1:]
+                                     for name in self.types])
+            self._row = Struct(format)
+
+            self._sizes = [calcsize("!" + FORMATS[name][-1])
+                           for name in self.types]
+            conversions = [CONVERSIONS.get(name) for name in self.types]
+            if [c for c in conversions if c is not None]:
+                self._conversions = conversions
+
+    def _encoder(self, name):
+        # return the function that encodes a field
+        if name in VARIABLE:
+            encoding = self.encoding
+            def encode(value):
+                if value is None:
+                    return NULL_FIELD
+                if isinstance(value, unicode):
+                    value = value.encode(encoding)
+                return pack("!i", len(value)) + value
+
+            return encode
+
+        packer = Struct(FORMATS[name]).pack
+        size = calcsize("!" + FORMATS[name][-1])
+        convert = CONVERSIONS.get(name)
+
+        if convert is None:
+            def encode(value):
+                if value is None:
+                    return NULL_FIELD
+                return packer(size, value)
+        else:
+            def encode(value):
+                if value is None:
+                    return NULL_FIELD
+                return packer(size, convert(value))
+
+        return encode
+
+    def encodeRow(self, row):
+        """Return the encoded row.
+        """
+
+        if self._row is not None and None not in row:
+            args = [len(row)]
+            if self._conversions is None:
+                for size, value in zip(self._sizes, row):
+                    args.append(size)
+                    args.append(value)
+            else:
+                for size, convert, value in zip(self._sizes,
+                                                self._conversions, row):
+                    args.append(size)
+                    if convert is not None:
+                        value = convert(value)
+                    args.append(value)
+
+            return self._row.pack(*args)
+
+        return self._count + "".join([encode(value) for encode, value
+                                      in zip(self._encoders, row)])
+
+
+class BinaryRowsProducer(object):
+    """An implementation of the L{pglib.ipg.IProducer} interface, that
+    encodes and sends the rows from an iterator in the binary format,
+    in chunks of (about) C{chunkSize} bytes.
+
+    The COPY command must use the BINARY option.
+
+    @ivar count: the number of rows sent
+    @type count: int
+    """
+
+    implements(ipg.IProducer)
+
+    chunkSize = 2 ** 16
+
+    def __init__(self, rows, types, encoding="utf_8"):
+        """Initialize the producer.
+
+        @param rows: an iterable over the rows
+        @param types: the types of the columns, see L{BinaryEncoder}
+        """
+
+        self.rows = iter(rows)
+        self.encoder = BinaryEncoder(types, encoding)
+
+        self.count = 0
+        self._state = 0 # 0: header, 1: rows, 2: done
+
+    def description(self, ntuples, binaryTuples):
+        self.ntuples = ntuples
+        self.binaryTuples = binaryTuples
+
+    def read(self):
+        if self._state == 2:
+            return ""
+
+        chunks = []
+        if self._state == 0:
+            chunks.append(HEADER)
+            self._state = 1
+
+        size = 0
+        chunkSize = self.chunkSize
+        encodeRow = self.encoder.encodeRow
+        while size < chunkSize:
+            try:
+                row = self.rows.next()
+            except StopIteration:
+                chunks.append(TRAILER)
+                self._state = 2
+                break
+
+            data = encodeRow(row)
+            chunks.append(data)
+            size = size + len(data)
+            self.count = self.count + 1
+
+        return "".join(chunks)
+
+    def close(self):
+        result = protocol.Result()
+        result.ntuples = self.ntuples
+        result.binaryTuples = self.binaryTuples
+        result.status = protocol.PGRES_COPY_IN
+
+        return result
+
+
+def _typecode(format):
+    # return the array typecode for a struct format character
+    if format in "fd":
+        return format
+
+    size = calcsize(format)
+    if format.islower():
+        codes = "bhilq"
+    else:
+        codes = "BHILQ"
+
+    for code in codes:
+        try:
+            if array.array(code).itemsize == size:
+                return code
+        except ValueError:
+            # q and Q are not available before Python 3.3
+            pass
+
+    raise ValueError("no array type for %r" % format)
+
+
+# the limits of the number of rows decoded in a block
+MIN_BLOCK = 16
+MAX_BLOCK = 2 ** 16
+SHORT_BLOCK = 64
+
+# the maximum number of rows decoded one at a time, after a short block
+MAX_SKIP = 256
+
+INT16 = Struct("!h")
+INT32 = Struct("!i")
+
+
+class BinaryConsumer(object):
+    """An implementation of the L{pglib.ipg.IConsumer} interface, that
+    decodes data in the binary format of COPY into columns.
+
+    Columns of fixed size types are stored in arrays (or NumPy arrays,
+    if requested); dates are stored as days since 2000-01-01, and
+    timestamps as microseconds since 2000-01-01.  Columns of other
+    types are stored in lists of strings.
+
+    When all the columns have a fixed size, consecutive rows without
+    NULLs are decoded in blocks: the bytes of each column are copied
+    with strided slices, without creating a Python object for each
+    value.  Other rows, and the rows that follow a short block, are
+    decoded one at a time.
+
+    Data is parsed as it arrives, and rows can span many CopyData
+    messages.
+
+    The COPY command must use the BINARY option.
+
+    @ivar columns: the columns, available after L{close}
+    @type columns: list
+
+    @ivar nulls: for each column, an array of bytes, with 1 for NULL
+                 values (that are stored as 0 or None in the column);
+                 available after L{close}
+    @type nulls: list
+
+    @ivar count: the number of rows decoded
+    @type count: int
+    """
+
+    implements(ipg.IConsumer)
+
+    def __init__(self, types, useNumpy=False):
+        """Initialize the consumer.
+
+        @param types: the types of the columns, see L{BinaryEncoder}
+        @type types: sequence of str
+
+        @param useNumpy: if True, fixed size columns are NumPy arrays
+        @type useNumpy: bool
+        """
+
+        self.types = [typeName(name) for name in types]
+        self.useNumpy = useNumpy
+
+        self.columns = None
+        self.nulls = None
+        self.count = 0
+
+        n = len(self.types)
+        self._sizes = []
+        for name in self.types:
+            if name in VARIABLE:
+                self._sizes.append(None)
+            else:
+                self._sizes.append(calcsize("!" + FORMATS[name][-1]))
+
+        self._data = [[] for i in range(n)]
+        self._nulls = [[] for i in range(n)]
+        self._buffer = ""
+        self._header = False
+        self._done = False
+
+        # the layout of a row without NULLs, when all the columns have
+        # a fixed size: the offset and value of the bytes of the field
+        # count and lengths, and the offset and size of each field
+        self._meta = None
+        if None not in self._sizes:
+            count = pack("!h", n)
+            meta = [(0, count[0]), (1, count[1])]
+            fields = []
+            pos = 2
+            for size in self._sizes:
+                length = pack("!i", size)
+                meta.extend([(pos + j, length[j]) for j in range(4)])
+                fields.append((pos + 4, size))
+                pos = pos + 4 + size
+
+            self._meta = meta
+            self._fields = fields
+            self._rowSize = pos
+            self._row = Struct("!h" + "".join(["i%ds" % size
+                                               for size in self._sizes]))
+            self._lengths = tuple(self._sizes)
+            self._block = MIN_BLOCK
+            self._skip = 0    # rows to decode before the next block
+            self._backoff = 1
+
+    def description(self, ntuples, binaryTuples):
+        self.ntuples = ntuples
+        self.binaryTuples = binaryTuples
+
+    def _parseHeader(self, buf):
+        # return the offset of the first row, or None if the header
+        # is not complete
+        size = len(SIGNATURE) + 8
+        if len(buf) < size:
+            return None
+
+        if buf[:len(SIGNATURE)] != SIGNATURE:
+            raise ValueError("invalid binary COPY signature")
+
+        flags, extension = unpack("!ii", buf[len(SIGNATURE):size])
+        if len(buf) < size + extension:
+            return None
+
+        return size + extension
+
+    def write(self, data):
+        if self._done:
+            return
+
+        if self._buffer:
+            buf = self._buffer + data
+        else:
+            buf = data
+
+        offset = 0
+        if not self._header:
+            offset = self._parseHeader(buf)
+            if offset is None:
+                self._buffer = buf
+                return
+            self._header = True
+
+        end = len(buf)
+        sizes = self._sizes
+        nfields = len(sizes)
+        columns = self._data
+        nulls = self._nulls
+        unpack16 = INT16.unpack_from
+        unpack32 = INT32.unpack_from
+        blocks = self._meta is not None
+
+        while end - offset >= 2:
+            if blocks:
+                if not self._skip:
+                    count = self._decodeBlock(buf, offset, end)
+                    if count:
+                        offset = offset + count * self._rowSize
+                        continue
+                else:
+                    self._skip = self._skip - 1
+
+                if end - offset >= self._rowSize:
+                    values = self._row.unpack_from(buf, offset)
+                    if values[0] == nfields and \
+                            values[1::2] == self._lengths:
+                        # no NULLs
+                        for column, value in zip(columns, values[2::2]):
+                            column.append(value)
+                        for column in nulls:
+                            column.append("\0")
+
+                        offset = offset + self._rowSize
+                        self.count = self.count + 1
+                        continue
+
+            # decode a row field by field
+            (n,) = unpack16(buf, offset)
+            if n == -1:
+                # the trailer
+                self._done = True
+                offset = end
+                break
+            elif n != nfields:
+                raise ValueError("expected %d fields, got %d" % (
+                        nfields, n))
+
+            # check that the row is complete, and find the fields
+            fields = []
+            pos = offset + 2
+            for size in sizes:
+                if end - pos < 4:
+                    break
+
+                (length,) = unpack32(buf, pos)
+                pos = pos + 4
+                if length == -1:
+                    fields.append(None)
+                    continue
+                elif size is not None and length != size:
+                    raise ValueError("expected %d bytes, got %d" % (
+                            size, length))
+                elif end - pos < length:
+                    break
+
+                fields.append(buf[pos:pos + length])
+                pos = pos + length
+            else:
+                for i, value in enumerate(fields):
+                    if value is None:
+                        nulls[i].append("\1")
+                        if sizes[i] is not None:
+                            value = "\0" * sizes[i]
+                    else:
+                        nulls[i].append("\0")
+                    columns[i].append(value)
+
+                offset = pos
+                self.count = self.count + 1
+                continue
+
+            # incomplete row
+            break
+
+        self._buffer = buf[offset:]
+
+    def _decodeBlock(self, buf, offset, end):
+        # decode the rows without NULLs at offset, and return their
+        # number
+        rowSize = self._rowSize
+        count = min((end - offset) // rowSize, self._block)
+
+        # the rows end at the first one where a byte of the field
+        # count or of a length differs (a NULL, or the trailer)
+        for pos, byte in self._meta:
+            if not count:
+                break
+            start = offset + pos
+            column = buf[start:start + count * rowSize:rowSize]
+            count = min(count, len(column) - len(column.lstrip(byte)))
+
+        # adapt the size of the next block; with many NULLs, rows are
+        # decoded one by one for a while
+        self._block = min(max(2 * count, MIN_BLOCK), MAX_BLOCK)
+        if count < SHORT_BLOCK and (end - offset) // rowSize > count:
+            self._skip = self._backoff
+            self._backoff = min(2 * self._backoff, MAX_SKIP)
+        else:
+            self._backoff = 1
+        if not count:
+            return 0
+
+        stop = offset + count * rowSize
+        for i, (pos, size) in enumerate(self._fields):
+            start = offset + pos
+            if size == 1:
+                data = buf[start:stop:rowSize]
+            else:
+                # interleave the bytes of the values
+                values = array.array("B", "\0" * (count * size))
+                for j in range(size):
+                    values[j::size] = array.array(
+                        "B", buf[start + j:stop:rowSize])
+                data = values.tostring()
+
+            self._data[i].append(data)
+            self._nulls[i].append("\0" * count)
+
+        self.count = self.count + count
+        return count
+
+    def _column(self, name, data):
+        # build a column from the raw data
+        if name in VARIABLE:
+            return data
+
+        data = "".join(data)
+        if self.useNumpy:
+            import numpy
+
+            dtype = numpy.dtype(DTYPES[name])
+            return numpy.fromstring(data, dtype).astype(
+                dtype.newbyteorder("="))
+
+        column = array.array(_typecode(FORMATS[name][-1]))
+        column.fromstring(data)
+        if sys.byteorder == "little" and column.itemsize > 1:
+            column.byteswap()
+
+        return column
+
+    def close(self):
+        self.columns = [self._column(name, data) for name, data
+                        in zip(self.types, self._data)]
+        self.nulls = [array.array("B", "".join(data))
+                      for data in self._nulls]
+        self._data = self._nulls = None
+
+        result = protocol.Result()
+        result.ntuples = self.ntuples
+        result.binaryTuples = self.binaryTuples
+        result.status = protocol.PGRES_COPY_OUT
+
+        return result
@@ -0,0 +1,1279 @@
+"""Bulk loading of rows, using COPY.
+
+$Id$
+
+THIS SOFTWARE IS UNDER MIT LICENSE.
+Copyright (c) 2006 Perillo Manlio (manlio.perillo@gmail.com)
+
+Read LICENSE file for more informations.
+"""
+
+import os
+import re
+import time
+import mmap
+import itertools
+
+from zope.interface import implements
+
+from twisted.python import log, failure
+from twisted.internet import defer
+
+import ipg
+import protocol
+import batch
+from textcopy import escape, encodeValue, encodeRow
+
+
+# the position of an error in COPY, from the context of the error
+LINE_RE = re.compile(r"\bline (\d+)")
+
+
+class LinesProducer(object):
+    """An implementation of the L{pglib.ipg.IProducer} interface, that
+    sends a list of lines, joined in chunks of (about) C{chunkSize}
+    bytes.
+    """
+
+    implements(ipg.IProducer)
+
+    chunkSize = 2 ** 16
+
+    def __init__(self, lines):
+        self.lines = lines
+        self._index = 0
+
+    def description(self, ntuples, binaryTuples):
+        self.ntuples = ntuples
+        self.binaryTuples = binaryTuples
+
+    def read(self):
+        lines = self.lines
+        start = i = self._index
+        size = 0
+        chunkSize = self.chunkSize
+        while i < len(lines) and size < chunkSize:
+            size = size + len(lines[i])
+            i = i + 1
+
+        self._index = i
+        return "".join(lines[start:i])
+
+    def close(self):
+        result = protocol.Result()
+        result.ntuples = self.ntuples
+        result.binaryTuples = self.binaryTuples
+        result.status = protocol.PGRES_COPY_IN
+
+        return result
+
+
+class RowsProducer(object):
+    """An implementation of the L{pglib.ipg.IProducer} interface, that
+    encodes and sends the rows from an iterator, in chunks of (about)
+    C{chunkSize} bytes.
+
+    @ivar count: the number of rows sent
+    @type count: int
+
+    @ivar exhausted: True when the iterator has no more rows
+    @type exhausted: bool
+    """
+
+    implements(ipg.IProducer)
+
+    chunkSize = 2 ** 16
+
+    def __init__(self, rows, maxRows=None, encoding="utf_8"):
+        """Initialize the producer.
+
+        @param rows: an iterator over the rows
+        @param maxRows: the maximum number of rows to send; the
+                        remaining ones are left in the iterator
+        @type maxRows: int
+        """
+
+        self.rows = rows
+        self.maxRows = maxRows
+        self.encoding = encoding
+
+        self.count = 0
+        self.exhausted = False
+
+    def description(self, ntuples, binaryTuples):
+        self.ntuples = ntuples
+        self.binaryTuples = binaryTuples
+
+    def read(self):
+        lines = []
+        size = 0
+        chunkSize = self.chunkSize
+        maxRows = self.maxRows
+
+        while size < chunkSize and (maxRows is None or
+                                    self.count < maxRows):
+            try:
+                row = self.rows.next()
+            except StopIteration:
+                self.exhausted = True
+                break
+
+            line = encodeRow(row, self.encoding)
+            lines.append(line)
+            size = size + len(line)
+            self.count = self.count + 1
+
+        return "".join(lines)
+
+    def close(self):
+        result = protocol.Result()
+        result.ntuples = self.ntuples
+        result.binaryTuples = self.binaryTuples
+        result.status = protocol.PGRES_COPY_IN
+
+        return result
+
+
+class FileProducer(object):
+    """An implementation of the L{pglib.ipg.IProducer} interface, that
+    sends the content of a file (already in the COPY format).
+
+    The file is read in blocks of C{blockSize} bytes, or memory mapped;
+    the transfer rate can be limited to C{rate} bytes per second.
+
+    A file opened from a path, and the memory map, are closed as soon as
+    the end of the file is reached, or when the COPY fails.
+
+    @ivar sent: the number of bytes sent
+    @type sent: int
+    """
+
+    implements(ipg.IProducer)
+
+    def __init__(self, file, blockSize=2 ** 20, useMmap=False,
+                 rate=None):
+        """Initialize the producer.
+
+        @param file: a path, a file descriptor or a file object
+        
+        @param blockSize: the size of the blocks sent
+        @type blockSize: int
+
+        @param useMmap: if True, memory map the file instead of
+                        reading it
+        @type useMmap: bool
+
+        @param rate: the maximum transfer rate, in bytes per second
+        @type rate: int
+        """
+
+        self.blockSize = blockSize
+        self.rate = rate
+        self.sent = 0
+
+        self._file = None
+        self._mmap = None
+        self._offset = 0
+        self._start = None
+
+        if isinstance(file, basestring):
+            file = self._file = open(file, "rb")
+
+        if isinstance(file, (int, long)):
+            fd = file
+            self._read = lambda size: os.read(fd, size)
+        else:
+            fd = getattr(file, "fileno", lambda: None)()
+            self._read = file.read
+
+        if useMmap and fd is not None:
+            size = os.fstat(fd).st_size
+            if size:
+                # an empty file cannot be mapped
+                self._mmap = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+                self._read = self._readMmap
+
+    def _readMmap(self, size):
+        # helper method
+        offset = self._offset
+        data = self._mmap[offset:offset + size]
+        self._offset = offset + len(data)
+
+        return data
+
+    def description(self, ntuples, binaryTuples):
+        self.ntuples = ntuples
+        self.binaryTuples = binaryTuples
+        self._start = time.time()
+
+    def _readBlock(self, _=None):
+        # helper method
+        data = self._read(self.blockSize)
+        if not data:
+            self._release()
+        self.sent = self.sent + len(data)
+
+        return data
+
+    def _release(self):
+        # helper method
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def read(self):
+        if self.rate is not None:
+            delay = self.sent / float(self.rate) - \
+                (time.time() - self._start)
+            if delay > 0:
+                from twisted.internet import reactor
+
+                d = defer.Deferred()
+                reactor.callLater(delay, d.callback, None)
+                
+                return d.addCallback(self._readBlock)
+
+        return self._readBlock()
+
+    def abort(self):
+        self._release()
+
+    def close(self):
+        self._release()
+
+        result = protocol.Result()
+        result.ntuples = self.ntuples
+        result.binaryTuples = self.binaryTuples
+        result.status = protocol.PGRES_COPY_IN
+
+        return result
+
+
+def copyQuery(table, columns=None, binary=False):
+    """Return the COPY FROM STDIN command for a table.
+
+    @param binary: if True, use the binary format
+    @type binary: bool
+    """
+
+    if columns:
+        query = "COPY %s (%s) FROM STDIN" % (table, ", ".join(columns))
+    else:
+        query = "COPY %s FROM STDIN" % table
+
+    if binary:
+        query = query + " WITH BINARY"
+
+    return query
+
+
+class TableWriter(object):
+    """A write-behind buffer of rows, written to a table with COPY.
+
+    Rows are kept in memory, and written with a single COPY command
+    when C{maxRows} rows or C{maxBytes} bytes are buffered, or
+    C{maxDelay} seconds after the first row.
+
+    Only one COPY is executed at a time; while it is in progress, rows
+    are buffered for the next one.  When the buffer is full too,
+    L{write} returns a deferred, and the caller should wait for it
+    before writing more rows, so that memory is bounded.
+
+    Rows of a failed COPY are lost: the error is logged, unless
+    someone is waiting for L{flush}.
+
+    @ivar rows: the number of rows written
+    @type rows: int
+
+    @ivar lost: the number of rows lost, due to failed COPY commands
+    @type lost: int
+
+    @ivar copies: the number of COPY commands executed
+    @type copies: int
+    """
+
+    def __init__(self, protocol, table, columns=None, maxRows=10000,
+                 maxBytes=2 ** 20, maxDelay=1.0, encoding="utf_8"):
+        """Initialize the writer.
+
+        @param table: the name of the table
+        @type table: str
+
+        @param columns: the name of the columns, in the order of the
+                        values of the rows
+        @type columns: sequence
+
+        @param encoding: the encoding for unicode strings, that must
+                         match the client encoding
+        @type encoding: str
+        """
+
+        self.protocol = protocol
+        self.query = copyQuery(table, columns)
+        self.maxRows = maxRows
+        self.maxBytes = maxBytes
+        self.maxDelay = maxDelay
+        self.encoding = encoding
+
+        self.rows = 0
+        self.lost = 0
+        self.copies = 0
+
+        self._lines = []
+        self._size = 0
+        self._copying = False
+        self._waiters = [] # writers waiting for the buffer
+        self._flushes = [] # callers waiting for flush
+        self._call = None
+
+    def _full(self):
+        # helper method
+        return len(self._lines) >= self.maxRows or \
+            self._size >= self.maxBytes
+
+    def write(self, row):
+        """Buffer a row.
+
+        @param row: the values of the row
+        @type row: sequence
+
+        @return: None, or a deferred when the buffer is full; the
+                 deferred will fire when more rows can be written
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        line = encodeRow(row, self.encoding)
+        self._lines.append(line)
+        self._size = self._size + len(line)
+
+        if self._full():
+            if not self._copying:
+                self._copy([])
+            else:
+                d = defer.Deferred()
+                self._waiters.append(d)
+                return d
+        elif self._call is None and not self._copying:
+            from twisted.internet import reactor
+
+            self._call = reactor.callLater(self.maxDelay, self._timeout)
+
+    def writeRows(self, rows):
+        """Buffer many rows.
+
+        @return: None, or a deferred, as with L{write}
+        """
+
+        d = None
+        for row in rows:
+            d = self.write(row) or d
+
+        return d
+
+    def _timeout(self):
+        self._call = None
+        if not self._copying and self._lines:
+            self._copy([])
+
+    def flush(self):
+        """Write the buffered rows now.
+
+        @return: a deferred that will fire when the rows buffered so
+                 far have been written
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        d = defer.Deferred()
+        if self._copying:
+            # will be done when the current COPY completes
+            self._flushes.append(d)
+        elif self._lines:
+            self._copy([d])
+        else:
+            d.callback(None)
+
+        return d
+
+    def _copy(self, flushes):
+        # helper method
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+
+        lines = self._lines
+        self._lines = []
+        self._size = 0
+
+        request = protocol.PgRequest("Q", self.query + "\0")
+        request.producer = LinesProducer(lines)
+
+        self._copying = True
+        self.copies = self.copies + 1
+
+        d = self.protocol.sendMessage(request)
+        d.addBoth(self._cbCopy, len(lines), flushes)
+
+    def _cbCopy(self, result, rows, flushes):
+        self._copying = False
+
+        if isinstance(result, failure.Failure):
+            self.lost = self.lost + rows
+            if not flushes:
+                log.err(result)
+
+            for d in flushes:
+                d.errback(result)
+        else:
+            self.rows = self.rows + rows
+            for d in flushes:
+                d.callback(None)
+
+        # send the rows buffered in the meantime
+        flushes = self._flushes
+        self._flushes = []
+        if self._lines and (flushes or self._full()):
+            self._copy(flushes)
+        else:
+            for d in flushes:
+                d.callback(None)
+            
+            if self._lines and self._call is None:
+                from twisted.internet import reactor
+
+                self._call = reactor.callLater(self.maxDelay,
+                                               self._timeout)
+
+        waiters = self._waiters
+        self._waiters = []
+        for d in waiters:
+            d.callback(None)
+
+    def close(self):
+        """Write the buffered rows, and stop the timer.
+
+        @return: a deferred, as with L{flush}
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        return self.flush()
+
+
+class BulkUpsert(object):
+    """Insert or update many rows of a table, by key.
+
+    Rows are copied into a temporary table, in chunks of C{chunkRows}
+    rows, and each chunk is merged into the table with a set based
+    command: INSERT ... ON CONFLICT DO UPDATE with PostgreSQL 9.5 and
+    later, an UPDATE and an INSERT of the missing rows otherwise.
+
+    Each chunk is merged in its own transaction, so that the size of
+    the temporary table and of the transactions is bounded.
+
+    @note: The keys must be unique within a chunk, and with older
+           servers concurrent inserts of the same keys can fail.
+    """
+
+    _serial = 0
+
+    def __init__(self, protocol, table, columns, keys, chunkRows=50000,
+                 encoding="utf_8"):
+        """Initialize the upsert.
+
+        @param table: the name of the table
+        @type table: str
+
+        @param columns: the name of the columns, in the order of the
+                        values of the rows
+        @type columns: sequence
+
+        @param keys: the columns of the unique key
+        @type keys: sequence
+
+        @param chunkRows: the number of rows merged in each
+                          transaction
+        @type chunkRows: int
+        """
+
+        self.protocol = protocol
+        self.table = table
+        self.columns = list(columns)
+        self.keys = list(keys)
+        self.chunkRows = chunkRows
+        self.encoding = encoding
+
+        for key in self.keys:
+            if key not in self.columns:
+                raise ValueError("key column %r not in columns" % key)
+
+    def _mergeQuery(self, temp):
+        # helper method
+        table = self.table
+        columns = ", ".join(self.columns)
+        values = [column for column in self.columns
+                  if column not in self.keys]
+
+        version = self.protocol.serverVersion
+        if version is not None and version >= 90500:
+            if values:
+                action = "UPDATE SET " + ", ".join(
+                    ["%s = EXCLUDED.%s" % (column, column)
+                     for column in values])
+            else:
+                action = "NOTHING"
+
+            return "WITH upserted AS (" \
+                "INSERT INTO %s (%s) SELECT %s FROM %s " \
+                "ON CONFLICT (%s) DO %s RETURNING xmax = 0 AS inserted) " \
+                "SELECT count(*), " \
+                "coalesce(sum(CASE WHEN inserted THEN 1 ELSE 0 END), 0) " \
+                "FROM upserted" % (table, columns, columns, temp,
+                                   ", ".join(self.keys), action)
+
+        join = " AND ".join(["%s.%s = s.%s" % (table, key, key)
+                             for key in self.keys])
+        queries = []
+        if values:
+            queries.append("UPDATE %s SET %s FROM %s s WHERE %s" % (
+                    table, ", ".join(["%s = s.%s" % (column, column)
+                                      for column in values]),
+                    temp, join))
+        queries.append("INSERT INTO %s (%s) SELECT %s FROM %s s "
+                       "WHERE NOT EXISTS (SELECT 1 FROM %s WHERE %s)" % (
+                table, columns, ", ".join(["s." + column
+                                           for column in self.columns]),
+                temp, table, join))
+
+        return "; ".join(queries)
+
+    def upsert(self, rows):
+        """Insert or update the rows.
+
+        @param rows: an iterable over the rows
+        
+        @return: a deferred that will fire with a dictionary with the
+                 rows, inserted, updated and chunks keys
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        BulkUpsert._serial = BulkUpsert._serial + 1
+        temp = "pglib_upsert_%d" % BulkUpsert._serial
+        stats = {"rows": 0, "inserted": 0, "updated": 0, "chunks": 0}
+
+        d = self.protocol.execute(
+            "CREATE TEMP TABLE %s AS SELECT %s FROM %s LIMIT 0" % (
+                temp, ", ".join(self.columns), self.table)
+            )
+        d.addCallback(self._copy, iter(rows), temp, stats)
+        d.addBoth(self._drop, temp)
+
+        return d
+
+    def _copy(self, _, rows, temp, stats):
+        producer = RowsProducer(rows, self.chunkRows, self.encoding)
+
+        request = protocol.PgRequest(
+            "Q", copyQuery(temp, self.columns) + "\0")
+        request.producer = producer
+
+        d = self.protocol.sendMessage(request)
+        d.addCallback(self._merge, producer, rows, temp, stats)
+
+        return d
+
+    def _merge(self, _, producer, rows, temp, stats):
+        if not producer.count:
+            return stats
+
+        consumer = batch.ResultsConsumer()
+        request = protocol.PgRequest("Q", self._mergeQuery(temp) + "\0")
+        request.rowConsumer = consumer
+
+        d = self.protocol.sendMessage(request)
+        d.addCallback(self._cbMerge, consumer, producer.count, stats)
+        d.addCallback(lambda _: self.protocol.execute("TRUNCATE " + temp))
+        
+        if not producer.exhausted:
+            d.addCallback(self._copy, rows, temp, stats)
+        else:
+            d.addCallback(lambda _: stats)
+
+        return d
+
+    def _cbMerge(self, _, consumer, count, stats):
+        stats["rows"] = stats["rows"] + count
+        stats["chunks"] = stats["chunks"] + 1
+
+        results = consumer.results
+        if results[-1].cmdStatus == "SELECT":
+            # INSERT ... ON CONFLICT
+            affected, inserted = map(int, results[-1].rows[0])
+            updated = affected - inserted
+        else:
+            inserted = results[-1].cmdTuples
+            if len(results) > 1:
+                updated = results[0].cmdTuples
+            else:
+                updated = 0
+
+        stats["inserted"] = stats["inserted"] + inserted
+        stats["updated"] = stats["updated"] + updated
+
+    def _drop(self, result, temp):
+        # drop the temporary table, preserving the result
+        d = self.protocol.execute("DROP TABLE " + temp)
+        d.addBoth(lambda _: result)
+
+        return d
+
+
+def fileChunks(file, blockSize=2 ** 20):
+    """Return an iterator over row aligned chunks of a file, in the
+    text format of COPY.
+
+    @note: CSV files with quoted newlines are not supported.
+
+    @param file: a path or a file object
+    """
+
+    if isinstance(file, basestring):
+        fp = open(file, "rb")
+    else:
+        fp = file
+
+    rest = ""
+    while True:
+        data = fp.read(blockSize)
+        if not data:
+            break
+
+        if rest:
+            data = rest + data
+        end = data.rfind("\n") + 1
+        rest = data[end:]
+        if end:
+            yield data[:end]
+
+    if rest:
+        yield rest
+
+    if fp is not file:
+        fp.close()
+
+def rowChunks(rows, chunkRows=10000, encoding="utf_8"):
+    """Return an iterator over chunks of rows, encoded in the text
+    format of COPY.
+    """
+
+    lines = []
+    for row in rows:
+        lines.append(encodeRow(row, encoding))
+        if len(lines) >= chunkRows:
+            yield "".join(lines)
+            lines = []
+
+    if lines:
+        yield "".join(lines)
+
+
+class ChunkProducer(object):
+    """An implementation of the L{pglib.ipg.IProducer} interface, that
+    sends the chunks taken from a L{ParallelLoader}.
+    """
+
+    implements(ipg.IProducer)
+
+    def __init__(self, loader, stats):
+        self.loader = loader
+        self.stats = stats
+
+    def description(self, ntuples, binaryTuples):
+        self.ntuples = ntuples
+        self.binaryTuples = binaryTuples
+        self.stats["start"] = time.time()
+
+    def read(self):
+        return self.loader._next(self.stats)
+
+    def close(self):
+        stats = self.stats
+        stats["elapsed"] = time.time() - stats["start"]
+
+        result = protocol.Result()
+        result.ntuples = self.ntuples
+        result.binaryTuples = self.binaryTuples
+        result.status = protocol.PGRES_COPY_IN
+
+        return result
+
+
+class ParallelLoader(object):
+    """Load data in a table with many connections at once, each one
+    running its own COPY.
+
+    Data is a sequence of row aligned chunks in the text format of
+    COPY (see L{fileChunks} and L{rowChunks}); each connection takes
+    the next chunk when it can send more data, so faster connections
+    load more chunks.
+
+    With C{transaction} set, each connection loads in a transaction,
+    and all of them are committed only if all the COPY commands
+    succeed, rolled back otherwise.
+
+    @note: The commits of the connections are not atomic: a failure of
+           a COMMIT can leave the data loaded by the other connections.
+
+    @ivar stats: the statistics of the last load, see L{load}
+    @type stats: dict
+    """
+
+    def __init__(self, protocols, table, columns=None,
+                 transaction=False, progress=None):
+        """Initialize the loader.
+
+        @param protocols: the connections
+        @type protocols: sequence of L{pglib.protocol.PgProtocol}
+
+        @param table: the name of the table
+        @type table: str
+
+        @param columns: the name of the columns
+        @type columns: sequence
+
+        @param transaction: if True, commit only if all the
+                            connections succeed
+        @type transaction: bool
+
+        @param progress: called with the statistics each time a chunk
+                         is sent
+        @type progress: callable
+        """
+
+        self.protocols = list(protocols)
+        self.query = copyQuery(table, columns)
+        self.transaction = transaction
+        self.progress = progress
+
+        self.stats = None
+        self._chunks = None
+        self._failed = False
+
+    def _next(self, stats):
+        # return the next chunk, for the given connection
+        if self._failed:
+            return ""
+
+        try:
+            chunk = self._chunks.next()
+        except StopIteration:
+            return ""
+
+        rows = chunk.count("\n")
+        for s in (stats, self.stats):
+            s["bytes"] = s["bytes"] + len(chunk)
+            s["rows"] = s["rows"] + rows
+            s["chunks"] = s["chunks"] + 1
+
+        if self.progress is not None:
+            self.progress(self.stats)
+
+        return chunk
+
+    def load(self, chunks):
+        """Load the data.
+
+        @param chunks: an iterable over the chunks
+
+        @return: a deferred that will fire with the statistics: a
+                 dictionary with the bytes, rows, chunks, elapsed and
+                 rate (in MB/s) keys, and a connections key with the
+                 statistics of each connection
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        self._chunks = iter(chunks)
+        self._failed = False
+        self.stats = {"bytes": 0, "rows": 0, "chunks": 0,
+                      "start": time.time(), "connections": []}
+
+        dl = []
+        for connection in self.protocols:
+            stats = {"bytes": 0, "rows": 0, "chunks": 0,
+                     "start": time.time(), "elapsed": 0.0}
+            self.stats["connections"].append(stats)
+
+            if self.transaction:
+                d = connection.execute("BEGIN")
+            else:
+                d = defer.succeed(None)
+
+            d.addCallback(self._copy, connection, stats)
+            d.addErrback(self._ebCopy)
+            dl.append(d)
+
+        d = defer.DeferredList(dl, consumeErrors=True)
+        d.addCallback(self._finish)
+
+        return d
+
+    def _copy(self, _, connection, stats):
+        request = protocol.PgRequest("Q", self.query + "\0")
+        request.producer = ChunkProducer(self, stats)
+
+        return connection.sendMessage(request)
+
+    def _ebCopy(self, reason):
+        # stop the other connections
+        self._failed = True
+
+        return reason
+
+    def _finish(self, results):
+        failures = [result for success, result in results if not success]
+
+        if not self.transaction:
+            return self._done(None, failures)
+
+        if failures:
+            command = "ROLLBACK"
+        else:
+            command = "COMMIT"
+
+        dl = [connection.execute(command)
+              for connection in self.protocols]
+        d = defer.DeferredList(dl, consumeErrors=True)
+        d.addCallback(lambda results: self._done(None, failures + [
+                    result for success, result in results if not success]))
+
+        return d
+
+    def _done(self, _, failures):
+        stats = self.stats
+        stats["elapsed"] = time.time() - stats.pop("start")
+        
+        for s in [stats] + stats["connections"]:
+            s.pop("start", None)
+            if s["elapsed"]:
+                s["rate"] = s["bytes"] / s["elapsed"] / 2 ** 20
+            else:
+                s["rate"] = 0.0
+
+        if failures:
+            return failures[0]
+
+        return stats
+
+
+class PipeConsumer(object):
+    """An implementation of the L{pglib.ipg.IConsumer} interface, that
+    forwards the data of COPY TO STDOUT to a L{CopyPipe}.
+    """
+
+    implements(ipg.IConsumer)
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def description(self, ntuples, binaryTuples):
+        self.ntuples = ntuples
+        self.binaryTuples = binaryTuples
+
+        self.pipe._start()
+
+    def write(self, data):
+        self.pipe._write(data)
+
+    def writeSequence(self, seq):
+        self.pipe._write("".join(seq))
+
+    def close(self):
+        self.pipe._end()
+
+        result = protocol.Result()
+        result.ntuples = self.ntuples
+        result.binaryTuples = self.binaryTuples
+        result.status = protocol.PGRES_COPY_OUT
+
+        return result
+
+
+class PipeProducer(object):
+    """An implementation of the L{pglib.ipg.IProducer} interface, that
+    sends to COPY FROM STDIN the data taken from a L{CopyPipe}.
+    """
+
+    implements(ipg.IProducer)
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def description(self, ntuples, binaryTuples):
+        self.ntuples = ntuples
+        self.binaryTuples = binaryTuples
+
+    def read(self):
+        return self.pipe._read()
+
+    def close(self):
+        result = protocol.Result()
+        result.ntuples = self.ntuples
+        result.binaryTuples = self.binaryTuples
+        result.status = protocol.PGRES_COPY_IN
+
+        return result
+
+
+class CopyPipe(object):
+    """Copy data from a connection to another, running COPY TO STDOUT
+    on the source and COPY FROM STDIN on the destination.
+
+    The data is forwarded as soon as it arrives, without storing it:
+    when more than C{highWater} bytes are waiting for the destination,
+    the source transport is paused, and it is resumed when the data
+    has been sent.  The memory used is bounded, and the transfer goes
+    as fast as the slower side.
+
+    If the source fails, the COPY on the destination is aborted; if the
+    destination fails, the COPY on the source is cancelled, and the
+    copy fails with the error of the destination as soon as the source
+    connection is ready again.
+
+    @note: The two commands must use the same format, and the same
+           options (delimiter, null string, and so on).
+
+    @ivar stats: the statistics of the last copy, see L{copy}
+    @type stats: dict
+    """
+
+    def __init__(self, source, destination, highWater=2 ** 22):
+        """Initialize the pipe.
+
+        @param source: the connection the data is copied from
+        @type source: L{pglib.protocol.PgProtocol}
+
+        @param destination: the connection the data is copied to
+        @type destination: L{pglib.protocol.PgProtocol}
+
+        @param highWater: the number of bytes waiting for the
+                          destination, after that the source is paused
+        @type highWater: int
+        """
+
+        self.source = source
+        self.destination = destination
+        self.highWater = highWater
+
+        self.stats = None
+        self._reset()
+
+    def _reset(self):
+        # helper method
+        self._buffer = []
+        self._size = 0
+        self._reader = None # the deferred of the waiting producer
+        self._paused = False
+        self._ended = False
+        self._error = None
+        self._discard = False
+        self._started = False
+        self._cancelled = False
+
+    def copy(self, sourceQuery, destinationQuery):
+        """Copy the data.
+
+        @param sourceQuery: the COPY TO STDOUT command
+        @type sourceQuery: str
+
+        @param destinationQuery: the COPY FROM STDIN command (see
+                                 L{copyQuery})
+        @type destinationQuery: str
+
+        @return: a deferred that will fire with the statistics: a
+                 dictionary with the bytes, pauses, elapsed and rate
+                 (in MB/s) keys
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        self._reset()
+        self.stats = {"bytes": 0, "pauses": 0, "start": time.time()}
+
+        request = protocol.PgRequest("Q", destinationQuery + "\0")
+        request.producer = PipeProducer(self)
+        dd = self.destination.sendMessage(request)
+        dd.addErrback(self._ebDestination)
+
+        request = protocol.PgRequest("Q", sourceQuery + "\0")
+        request.consumer = PipeConsumer(self)
+        ds = self.source.sendMessage(request)
+        ds.addErrback(self._ebSource)
+
+        d = defer.DeferredList([ds, dd], consumeErrors=True)
+        d.addCallback(self._done)
+
+        return d
+
+    def _start(self):
+        # the source has started the COPY
+        self._started = True
+        if self._discard:
+            self._cancel()
+
+    def _cancel(self):
+        # helper method
+        if self._started and not self._ended and not self._cancelled:
+            self._cancelled = True
+            d = self.source.getCancel().cancel()
+            d.addErrback(log.err)
+
+    def _write(self, data):
+        # data from the source
+        if self._discard:
+            return
+
+        self.stats["bytes"] = self.stats["bytes"] + len(data)
+
+        if self._reader is not None:
+            d, self._reader = self._reader, None
+            d.callback(data)
+            return
+
+        self._buffer.append(data)
+        self._size = self._size + len(data)
+        if self._size >= self.highWater and not self._paused:
+            self._paused = True
+            self.stats["pauses"] = self.stats["pauses"] + 1
+            self.source.transport.pauseProducing()
+
+    def _end(self):
+        # the source has sent all the data
+        self._ended = True
+        if self._reader is not None and not self._buffer:
+            d, self._reader = self._reader, None
+            d.callback("")
+
+    def _read(self):
+        # the destination can accept more data
+        if self._buffer:
+            data = "".join(self._buffer)
+            self._buffer = []
+            self._size = 0
+            self._resume()
+
+            return data
+
+        if self._error is not None:
+            raise self._error
+        if self._ended:
+            return ""
+
+        self._reader = defer.Deferred()
+        return self._reader
+
+    def _resume(self):
+        # helper method
+        if self._paused:
+            self._paused = False
+            self.source.transport.resumeProducing()
+
+    def _ebSource(self, reason):
+        # abort the COPY on the destination
+        self._error = reason.value
+        if self._reader is not None:
+            d, self._reader = self._reader, None
+            d.errback(reason)
+
+        return reason
+
+    def _ebDestination(self, reason):
+        # cancel the source, and discard the data that is still
+        # arriving, making sure the source is not paused
+        self._discard = True
+        self._buffer = []
+        self._size = 0
+        self._resume()
+        self._cancel()
+
+        return reason
+
+    def _done(self, results):
+        stats = self.stats
+        stats["elapsed"] = time.time() - stats.pop("start")
+        if stats["elapsed"]:
+            stats["rate"] = stats["bytes"] / stats["elapsed"] / 2 ** 20
+        else:
+            stats["rate"] = 0.0
+
+        # report the failure of the source first, unless it has been
+        # cancelled because of the destination
+        if self._cancelled:
+            results.reverse()
+        failures = [result for success, result in results if not success]
+        if failures:
+            return failures[0]
+
+        return stats
+
+
+class BisectingLoader(object):
+    """Load lines in the text format of COPY into a table, isolating
+    the bad ones.
+
+    Lines are loaded in chunks of C{chunkRows} lines, each one with
+    its own COPY.  When a COPY fails because of the data (SQLSTATE
+    classes 22 and 23), the chunk is split and each part is loaded
+    again, until the bad lines are found; when the error reports the
+    line number, the chunk is split around that line, otherwise it is
+    bisected.  Bad lines are written, as they are, to the C{rejects}
+    file, and the error messages are logged.
+
+    Other errors abort the load.
+
+    @note: Each COPY is committed on its own, so the loader must not be
+           used inside a transaction block.
+
+    @ivar stats: the statistics of the last load, see L{load}
+    @type stats: dict
+    """
+
+    def __init__(self, protocol, table, columns=None, chunkRows=10000,
+                 rejects=None):
+        """Initialize the loader.
+
+        @param table: the name of the table
+        @type table: str
+
+        @param columns: the name of the columns
+        @type columns: sequence
+
+        @param rejects: a path or a file object where bad lines are
+                        written; a path is opened on the first bad
+                        line, and closed at the end
+        """
+
+        self.protocol = protocol
+        self.query = copyQuery(table, columns)
+        self.chunkRows = chunkRows
+        self.rejects = rejects
+
+        self.stats = None
+        self._lines = None
+        self._pending = [] # the parts of failed chunks, as a stack
+        self._fp = None
+        self._deferred = None
+
+    def load(self, lines):
+        """Load the lines.
+
+        @param lines: an iterable over the lines (see
+                      L{pglib.textcopy.encodeRow})
+
+        @return: a deferred that will fire with the statistics: a
+                 dictionary with the rows, rejected, copies, failures
+                 and elapsed keys
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        self._lines = iter(lines)
+        self._pending = []
+        self.stats = {"rows": 0, "rejected": 0, "copies": 0,
+                      "failures": 0, "start": time.time()}
+        self._deferred = defer.Deferred()
+
+        self._next()
+
+        return self._deferred
+
+    def _next(self):
+        if self._pending:
+            lines = self._pending.pop()
+        else:
+            lines = list(itertools.islice(self._lines, self.chunkRows))
+            if not lines:
+                self._done(None)
+                return
+
+            if not lines[-1].endswith("\n"):
+                lines[-1] = lines[-1] + "\n"
+
+        request = protocol.PgRequest("Q", self.query + "\0")
+        request.producer = LinesProducer(lines)
+
+        d = self.protocol.sendMessage(request)
+        d.addCallbacks(self._cbCopy, self._ebCopy,
+                       callbackArgs=(lines,), errbackArgs=(lines,))
+        d.addErrback(self._done)
+
+    def _cbCopy(self, result, lines):
+        stats = self.stats
+        stats["rows"] = stats["rows"] + len(lines)
+        stats["copies"] = stats["copies"] + 1
+
+        self._next()
+
+    def _ebCopy(self, reason, lines):
+        reason.trap(protocol.PgError)
+
+        error = reason.value
+        code = error.errorField(protocol.PG_DIAG_SQLSTATE) or ""
+        if code[:2] not in ("22", "23"):
+            return reason
+
+        stats = self.stats
+        stats["copies"] = stats["copies"] + 1
+        stats["failures"] = stats["failures"] + 1
+
+        n = len(lines)
+        match = LINE_RE.search(
+            error.errorField(protocol.PG_DIAG_CONTEXT) or "")
+        if match is not None and 0 < int(match.group(1)) <= n:
+            i = int(match.group(1)) - 1
+        elif n == 1:
+            i = 0
+        else:
+            i = None
+
+        pending = self._pending
+        if i is None:
+            pending.append(lines[n // 2:])
+            pending.append(lines[:n // 2])
+        else:
+            if i + 1 < n:
+                pending.append(lines[i + 1:])
+            self._reject(lines[i], error)
+            if i:
+                pending.append(lines[:i])
+
+        self._next()
+
+    def _reject(self, line, error):
+        # helper method
+        self.stats["rejected"] = self.stats["rejected"] + 1
+        log.msg("rejected line: %r (%s)" % (line, error.errorMessage()))
+
+        if self.rejects is None:
+            return
+
+        if self._fp is None:
+            if isinstance(self.rejects, basestring):
+                self._fp = open(self.rejects, "wb")
+            else:
+                self._fp = self.rejects
+
+        self._fp.write(line)
+
+    def _done(self, reason):
+        if self._fp is not None and self._fp is not self.rejects:
+            self._fp.close()
+        self._fp = None
+
+        stats = self.stats
+        stats["elapsed"] = time.time() - stats.pop("start")
+
+        d, self._deferred = self._deferred, None
+        if reason is not None:
+            d.errback(reason)
+        else:
+            d.callback(stats)
@@ -0,0 +1,396 @@
+"""Client side caching of query results.
+
+$Id$
+
+THIS SOFTWARE IS UNDER MIT LICENSE.
+Copyright (c) 2006 Perillo Manlio (manlio.perillo@gmail.com)
+
+Read LICENSE file for more informations.
+"""
+
+import time
+
+from zope.interface import implements
+
+from twisted.internet import defer
+
+import ipg
+
+
+class SingleFlight(object):
+    """Execute identical queries only once, when they are in progress
+    at the same time.
+
+    While a query is in progress, callers executing the same query
+    (with the same parameters) wait for its result, instead of sending
+    the query again to the backend.
+
+    By default all the callers share the same result object, that must
+    be considered read-only; with C{copy} set to True, each caller but
+    the first receive a copy.
+
+    @note: Only read-only queries should be executed.
+
+    @ivar hits: the number of executions saved
+    @type hits: int
+
+    @ivar misses: the number of queries sent to the backend
+    @type misses: int
+    """
+
+    def __init__(self, protocol, copy=False):
+        self.protocol = protocol
+        self.copy = copy
+
+        self.hits = 0
+        self.misses = 0
+        
+        self._flights = {} # query -> list of deferreds
+
+    def execute(self, query, params=None, timeout=None):
+        """Execute a query, unless the same query is already in
+        progress.
+
+        See L{pglib.protocol.PgProtocol.execute} for the parameters.
+
+        @return: a deferred that will fire with the result of the
+                 query
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        if params is not None:
+            query = self.protocol.interpolate(query, params)
+
+        d = defer.Deferred()
+
+        waiting = self._flights.get(query)
+        if waiting is not None:
+            self.hits = self.hits + 1
+            waiting.append(d)
+
+            return d
+
+        self.misses = self.misses + 1
+        self._flights[query] = [d]
+
+        self.protocol.execute(query, timeout=timeout).addCallbacks(
+            self._cbExecute, self._ebExecute,
+            callbackArgs=(query,), errbackArgs=(query,)
+            )
+
+        return d
+
+    def _cbExecute(self, result, query):
+        waiting = self._flights.pop(query)
+
+        # make all the copies before running the callbacks, that can
+        # modify the result
+        results = [result]
+        for d in waiting[1:]:
+            if self.copy:
+                results.append(result.copy())
+            else:
+                results.append(result)
+
+        for d, result in zip(waiting, results):
+            d.callback(result)
+
+    def _ebExecute(self, reason, query):
+        waiting = self._flights.pop(query)
+
+        for d in waiting:
+            d.errback(reason)
+
+
+class CacheHandler(object):
+    """An implementation of the L{pglib.ipg.IHandler} interface, that
+    forwards notifications to a L{ResultCache}, and then to the
+    original handler.
+    """
+
+    implements(ipg.IHandler)
+
+    def __init__(self, cache, handler):
+        self.cache = cache
+        self.handler = handler
+
+    def notice(self, notice):
+        self.handler.notice(notice)
+
+    def notify(self, notify):
+        self.cache.notify(notify)
+        self.handler.notify(notify)
+
+
+class _Entry(object):
+    # an entry of the cache, in the LRU list
+
+    __slots__ = ("key", "result", "size", "tags", "expires",
+                 "prev", "next")
+
+
+class ResultCache(object):
+    """A cache of query results, with LRU eviction.
+
+    Each entry can have a list of tags (usually the names of the
+    tables used by the query).
+    When a notification is received, the entries tagged with its name
+    are evicted; as an example, a trigger can execute a NOTIFY with
+    the name of the table, after each write (the cache executes the
+    LISTEN commands for all the tags it sees, see L{listen}).
+    Entries also expire after C{ttl} seconds, if given.
+
+    Queries in progress when a notification is received are not
+    cached.
+
+    Results are shared, and must be considered read-only; with
+    C{copy} set to True, each caller receive a copy.
+
+    @note: Only read-only queries should be executed.
+
+    @ivar size: the size of the cached results, in bytes (estimated)
+    @type size: int
+    """
+
+    def __init__(self, protocol, maxBytes=2 ** 24, ttl=None,
+                 copy=False, listen=True):
+        """Initialize the cache, installing a
+        L{pglib.cache.CacheHandler} on the protocol.
+
+        @param maxBytes: the maximum size of the cached results
+        @type maxBytes: int
+
+        @param ttl: the default time to live of the entries, in
+                    seconds; None means no expiration
+        @type ttl: float
+
+        @param listen: if True, LISTEN to the tags of the queries
+        @type listen: bool
+        """
+        
+        self.protocol = protocol
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.copy = copy
+        self.listen = listen
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.size = 0
+
+        self._flight = SingleFlight(protocol)
+        self._entries = {}     # key -> entry
+        self._tags = {}        # tag -> {key: None}
+        self._generations = {} # tag -> number of invalidations
+        self._inFlight = {}    # key -> (tags, generations), at the
+                               # start of the query in progress
+        self._listening = {}   # tag -> None
+
+        # the LRU list (most recent entries first)
+        self._root = root = _Entry()
+        root.prev = root.next = root
+
+        protocol.handler = CacheHandler(self, protocol.handler)
+
+    def _link(self, entry):
+        # helper method
+        root = self._root
+        entry.prev = root
+        entry.next = root.next
+        root.next.prev = entry
+        root.next = entry
+
+    def _unlink(self, entry):
+        # helper method
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+    def _remove(self, entry):
+        # remove an entry from the cache
+        self._unlink(entry)
+        del self._entries[entry.key]
+        self.size = self.size - entry.size
+
+        for tag in entry.tags:
+            keys = self._tags[tag]
+            del keys[entry.key]
+            if not keys:
+                del self._tags[tag]
+
+    def _sizeOf(self, result):
+        # an estimate of the memory used by a result
+        size = 200
+        for row in result.rows:
+            size = size + 40 + 8 * len(row)
+            for value in row:
+                if value is not None:
+                    size = size + len(value)
+
+        return size
+
+    def _store(self, key, result, tags, ttl):
+        # helper method
+        entry = _Entry()
+        entry.key = key
+        entry.result = result
+        entry.size = self._sizeOf(result)
+        entry.tags = tags
+        
+        if ttl is not None:
+            entry.expires = time.time() + ttl
+        else:
+            entry.expires = None
+
+        if entry.size > self.maxBytes:
+            return
+
+        while self.size + entry.size > self.maxBytes:
+            self._remove(self._root.prev)
+            self.evictions = self.evictions + 1
+
+        self._entries[key] = entry
+        self._link(entry)
+        self.size = self.size + entry.size
+
+        for tag in tags:
+            self._tags.setdefault(tag, {})[key] = None
+
+    def execute(self, query, params=None, tags=(), ttl=None):
+        """Execute a query, or return its result from the cache.
+
+        @param query: the query
+        @type query: str
+
+        @param params: the parameters to be interpolated, see
+                       L{pglib.protocol.PgProtocol.execute}
+        @type params: sequence or dict
+
+        @param tags: the tags of the entry
+        @type tags: sequence of str
+
+        @param ttl: the time to live of the entry, in seconds; when
+                    not given, the default one is used
+        @type ttl: float
+
+        @return: a deferred that will fire with the result of the
+                 query
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        if params is not None:
+            query = self.protocol.interpolate(query, params)
+
+        entry = self._entries.get(query)
+        if entry is not None:
+            if entry.expires is not None and entry.expires < time.time():
+                self._remove(entry)
+            else:
+                self.hits = self.hits + 1
+
+                # move to the front of the LRU list
+                self._unlink(entry)
+                self._link(entry)
+
+                if self.copy:
+                    return defer.succeed(entry.result.copy())
+                else:
+                    return defer.succeed(entry.result)
+
+        self.misses = self.misses + 1
+
+        tags = tuple(tags)
+        if self.listen:
+            for tag in tags:
+                if tag not in self._listening:
+                    self.listenTo(tag)
+        
+        if ttl is None:
+            ttl = self.ttl
+
+        # the generations are the ones at the start of the query: a
+        # caller joining the query after an invalidation must not make
+        # its result valid
+        flight = self._inFlight.get(query)
+        if flight is None:
+            generations = [self._generations.get(tag, 0) for tag in tags]
+            flight = self._inFlight[query] = (tags, generations)
+
+        d = self._flight.execute(query)
+        d.addCallbacks(self._cbExecute, self._ebExecute,
+                       callbackArgs=(query, flight, ttl),
+                       errbackArgs=(query, flight))
+
+        return d
+
+    def _endFlight(self, key, flight):
+        # return True if this is the first caller to see the end of
+        # the query in progress
+        if self._inFlight.get(key) is not flight:
+            return False
+
+        del self._inFlight[key]
+        return True
+
+    def _cbExecute(self, result, key, flight, ttl):
+        if self._endFlight(key, flight) and key not in self._entries:
+            tags, generations = flight
+            for tag, generation in zip(tags, generations):
+                if self._generations.get(tag, 0) != generation:
+                    # invalidated while the query was in progress
+                    break
+            else:
+                self._store(key, result, tags, ttl)
+        
+        if self.copy:
+            return result.copy()
+        else:
+            return result
+
+    def _ebExecute(self, reason, key, flight):
+        self._endFlight(key, flight)
+
+        return reason
+
+    def listenTo(self, tag):
+        """Execute a LISTEN command for the tag.
+
+        @return: a deferred that will fire when the command completes
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        self._listening[tag] = None
+        
+        return self.protocol.execute('LISTEN "%s"' % tag.replace('"', '""'))
+
+    def invalidate(self, tag):
+        """Evict all the entries with the given tag.
+        """
+
+        self.invalidations = self.invalidations + 1
+        self._generations[tag] = self._generations.get(tag, 0) + 1
+
+        keys = self._tags.get(tag)
+        if keys:
+            for key in keys.keys():
+                self._remove(self._entries[key])
+
+    def notify(self, notify):
+        """Handle a notification.
+
+        The tag to invalidate is the notification payload, if any, or
+        its name.
+
+        @param notify: the notification
+        @type notify: L{pglib.protocol.Notification}
+        """
+
+        self.invalidate(notify.extra or notify.name)
+
+    def clear(self):
+        """Evict all the entries.
+        """
+
+        for entry in self._entries.values():
+            self._remove(entry)
@@ -86,7 +86,11 @@ class IConsumer(Interface):
         @param data: the data sent by the backend
         @type data: str
 
-        @note: The backend always send one row at a time.
+        @note: The backend always send one row at a time, but the
+               protocol can buffer many rows (see
+               L{pglib.protocol.PgProtocol.copyBufferSize}).
+               If the consumer has a C{writeSequence} method, it is
+               called instead, with the list of rows.
         """
 
     def close():
@@ -98,6 +102,10 @@ class IConsumer(Interface):
 
 class IProducer(Interface):
     """A file like object, capable of writing/producing data.
+
+    A producer can also define an C{abort} method, without arguments:
+    it is called instead of L{close} when the COPY fails, so that the
+    producer can release its resources.
     """
 
     def description(ntuples, binaryTuples):
@@ -121,6 +129,9 @@ class IProducer(Interface):
         
         @return: the data to be copied in the backend.
                  Return the empty string when no more data is available.
+                 A deferred can be returned, when data is not yet
+                 available; no more data will be requested until it
+                 fires.
 
         @note: It is not required to send one row at a time.
         """
@@ -183,6 +194,18 @@ class IRowConsumer(Interface):
                  interface, with the result of the query.
         """
 
+class IPortalConsumer(IRowConsumer):
+    """An object that handles row data from a portal, executed with
+    a limit on the number of rows to return.
+    """
+
+    def suspended():
+        """The row limit has been reached (PortalSuspended).
+
+        The portal can be executed again, to retrieve more rows.
+        """
+
+
 
 class IRowDescription(Interface):
     """A row description.
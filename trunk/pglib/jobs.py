@@ -0,0 +1,309 @@
+"""A job queue stored in a table, consumed with SKIP LOCKED.
+
+$Id$
+
+THIS SOFTWARE IS UNDER MIT LICENSE.
+Copyright (c) 2006 Perillo Manlio (manlio.perillo@gmail.com)
+
+Read LICENSE file for more informations.
+"""
+
+from zope.interface import implements
+
+from twisted.python import log
+from twisted.internet import defer
+
+import ipg
+import timer
+
+
+class JobHandler(object):
+    """An implementation of the L{pglib.ipg.IHandler} interface, that
+    wakes up a L{JobQueue} on notifications, and then forwards them
+    to the original handler.
+    """
+
+    implements(ipg.IHandler)
+
+    def __init__(self, queue, handler):
+        self.queue = queue
+        self.handler = handler
+
+    def notice(self, notice):
+        self.handler.notice(notice)
+
+    def notify(self, notify):
+        if notify.name == self.queue.channel:
+            self.queue.wakeup()
+        self.handler.notify(notify)
+
+
+class _Worker(object):
+    # the state of a connection used by the queue
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.busy = False
+        self.wake = False  # woken up while busy
+        self.timer = None  # the poll timer, when idle
+        
+
+class JobQueue(object):
+    """Consume the jobs stored in a table.
+
+    Each connection dequeues a batch of up to C{batchSize} jobs in a
+    transaction, with SELECT ... FOR UPDATE SKIP LOCKED, so that the
+    connections (and other consumers) never wait for each other.
+    The jobs of a batch are processed concurrently, and the successful
+    ones are acknowledged with a single statement (by default a
+    DELETE) before the commit; the failed ones are left in the table.
+
+    With C{backoff} set, the table must have an C{attempts} column
+    (integer, default 0) and a C{run_after} column (timestamp with
+    time zone, default now()): the attempts of a failed job are
+    incremented, and it is not dequeued again for C{backoff} seconds,
+    doubled at each attempt; after C{maxAttempts} attempts, if given,
+    it is left in the table and never dequeued again.
+    Without C{backoff}, failed jobs are dequeued again by the next
+    batch, and enough of them can starve the other jobs.
+
+    A full batch without failures is followed at once by another one.
+
+    Idle connections wait for a notification on C{channel} (usually
+    sent by a trigger on the table), or at most C{pollInterval}
+    seconds.
+
+    @note: PostgreSQL 9.5 or later is required, and the connections
+           must not be used for anything else.
+
+    @ivar processed: the number of jobs processed successfully
+    @type processed: int
+
+    @ivar failed: the number of jobs failed
+    @type failed: int
+    """
+
+    def __init__(self, protocols, table, handler, channel=None,
+                 columns=("id", ), batchSize=100, pollInterval=5.0,
+                 idType="bigint", ackQuery=None, backoff=None,
+                 maxAttempts=None):
+        """Initialize the queue.
+
+        @param protocols: the connections used for consuming jobs
+        @type protocols: sequence of L{pglib.protocol.PgProtocol}
+
+        @param table: the name of the table with the jobs
+        @type table: str
+
+        @param handler: the function called with the row of each job;
+                        it can return a deferred
+        @type handler: callable
+
+        @param channel: the name of the notification that signals new
+                        jobs
+        @type channel: str
+
+        @param columns: the columns of the rows passed to the handler;
+                        the first one must be the job id, and jobs
+                        are dequeued in its order
+        @type columns: sequence
+
+        @param idType: the SQL type of the job id
+        @type idType: str
+
+        @param ackQuery: the query that acknowledges the processed
+                         jobs, with a placeholder for the array of
+                         their ids; by default they are deleted
+        @type ackQuery: str
+
+        @param backoff: the delay before a failed job is retried, in
+                        seconds, doubled at each attempt; None if
+                        failed jobs are not tracked
+        @type backoff: float
+
+        @param maxAttempts: the number of attempts after that a job is
+                            no longer dequeued (only with C{backoff})
+        @type maxAttempts: int
+        """
+
+        self.table = table
+        self.handler = handler
+        self.channel = channel
+        self.columns = list(columns)
+        self.batchSize = batchSize
+        self.pollInterval = pollInterval
+
+        idColumn = self.columns[0]
+        where = ""
+        if backoff is not None:
+            where = " WHERE run_after <= now()"
+            if maxAttempts is not None:
+                where = where + " AND attempts < %d" % maxAttempts
+
+        self.dequeueQuery = "BEGIN; SELECT %s FROM %s%s ORDER BY %s " \
+            "LIMIT %d FOR UPDATE SKIP LOCKED" % (
+            ", ".join(self.columns), table, where, idColumn, batchSize)
+        self.ackQuery = ackQuery or "DELETE FROM %s WHERE %s = " \
+            "ANY(%%s::%s[])" % (table, idColumn, idType)
+
+        if backoff is not None:
+            # the exponent is limited, to avoid overflows
+            self.failQuery = "UPDATE %s SET attempts = attempts + 1, " \
+                "run_after = now() + interval '%f seconds' * " \
+                "power(2, least(attempts, 20)) " \
+                "WHERE %s = ANY(%%s::%s[])" % (
+                table, backoff, idColumn, idType)
+        else:
+            self.failQuery = None
+        
+        self.processed = 0
+        self.failed = 0
+
+        self.running = False
+        self._workers = [_Worker(protocol) for protocol in protocols]
+        self._stopped = None
+
+    def start(self):
+        """Start consuming jobs.
+        """
+
+        self.running = True
+        for worker in self._workers:
+            protocol = worker.protocol
+            if self.channel is not None:
+                if not isinstance(protocol.handler, JobHandler):
+                    protocol.handler = JobHandler(self, protocol.handler)
+                protocol.execute('LISTEN "%s"' % self.channel).addErrback(
+                    log.err)
+
+            self._poll(worker)
+
+    def stop(self):
+        """Stop consuming jobs.
+
+        @return: a deferred that will fire when the batches in
+                 progress are completed
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        self.running = False
+        for worker in self._workers:
+            if worker.timer is not None:
+                worker.timer.cancel()
+                worker.timer = None
+
+        self._stopped = defer.Deferred()
+        self._checkStopped()
+
+        return self._stopped
+
+    def _checkStopped(self):
+        # helper method
+        if self._stopped is None:
+            return
+        
+        for worker in self._workers:
+            if worker.busy:
+                return
+
+        d, self._stopped = self._stopped, None
+        d.callback(None)
+
+    def wakeup(self):
+        """Make the idle connections check for new jobs.
+        """
+
+        if not self.running:
+            return
+
+        for worker in self._workers:
+            if worker.busy:
+                worker.wake = True
+            else:
+                self._poll(worker)
+
+    def _poll(self, worker):
+        # dequeue a batch of jobs
+        if worker.timer is not None:
+            worker.timer.cancel()
+            worker.timer = None
+
+        worker.busy = True
+        worker.wake = False
+
+        d = worker.protocol.execute(self.dequeueQuery)
+        d.addCallback(self._cbDequeue, worker)
+        d.addErrback(self._ebBatch, worker)
+
+    def _cbDequeue(self, result, worker):
+        if not result.rows:
+            d = worker.protocol.execute("COMMIT")
+            d.addCallback(self._idle, worker, False)
+            return d
+
+        dl = []
+        for row in result.rows:
+            d = defer.maybeDeferred(self.handler, row)
+            d.addCallbacks(lambda _, id=row[0]: (True, id), self._ebJob,
+                           errbackArgs=(row[0], ))
+            dl.append(d)
+
+        d = defer.DeferredList(dl)
+        d.addCallback(self._ack, worker,
+                      len(result.rows) >= self.batchSize)
+
+        return d
+
+    def _ebJob(self, reason, id):
+        log.err(reason)
+        
+        return (False, id)
+
+    def _ack(self, results, worker, full):
+        ids = []
+        failed = []
+        for _, (success, id) in results:
+            if success:
+                ids.append(id)
+            else:
+                failed.append(id)
+
+        self.processed = self.processed + len(ids)
+        self.failed = self.failed + len(failed)
+
+        queries = []
+        params = []
+        if ids:
+            queries.append(self.ackQuery)
+            params.append(ids)
+        if failed and self.failQuery is not None:
+            queries.append(self.failQuery)
+            params.append(failed)
+        queries.append("COMMIT")
+
+        d = worker.protocol.execute("; ".join(queries), tuple(params) or None)
+
+        # with a full batch there can be more jobs, but after failures
+        # the same jobs could be dequeued again at once
+        d.addCallback(self._idle, worker, full and not failed)
+
+        return d
+
+    def _ebBatch(self, reason, worker):
+        log.err(reason)
+        
+        # make sure the transaction is closed
+        d = worker.protocol.execute("ROLLBACK")
+        d.addErrback(log.err)
+        d.addCallback(self._idle, worker, False)
+
+    def _idle(self, _, worker, more):
+        worker.busy = False
+
+        if not self.running:
+            self._checkStopped()
+        elif more or worker.wake:
+            self._poll(worker)
+        else:
+            worker.timer = timer.wheel.schedule(self.pollInterval,
+                                                self._poll, worker)
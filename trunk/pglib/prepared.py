@@ -0,0 +1,176 @@
+"""Automatic promotion of simple queries to prepared statements.
+
+$Id$
+
+THIS SOFTWARE IS UNDER MIT LICENSE.
+Copyright (c) 2006 Perillo Manlio (manlio.perillo@gmail.com)
+
+Read LICENSE file for more informations.
+"""
+
+import protocol
+
+
+# errors that invalidate a prepared statement
+INVALID_STATEMENT_CODE = "26000" # prepared statement does not exist
+FEATURE_ERROR_CODE = "0A000"     # cached plan must not change result type
+
+
+class StatementCache(object):
+    """Count how many times each query is executed on a connection,
+    and execute the most frequent ones as prepared statements.
+
+    Once a query has been executed C{threshold} times, it is parsed
+    into a named prepared statement, and then executed with
+    Bind/Execute, saving the parse and plan on the backend.
+    At most C{maxStatements} statements are kept, the least recently
+    used one being closed when the limit is reached.
+
+    To enable it:
+
+      >>> protocol.statements = StatementCache()
+
+    @note: Queries with more than one command, and COPY commands, are
+           never promoted.
+
+    @ivar hits: the number of executions of a prepared statement
+    @type hits: int
+
+    @ivar misses: the number of executions of a simple query
+    @type misses: int
+
+    @ivar promotions: the number of statements prepared
+    @type promotions: int
+
+    @ivar evictions: the number of statements closed
+    @type evictions: int
+    """
+
+    # the number of distinct queries counted before resetting the
+    # counters, so that memory is bounded
+    maxCounters = 1000
+
+    def __init__(self, threshold=5, maxStatements=100):
+        self.threshold = threshold
+        self.maxStatements = maxStatements
+
+        self.hits = 0
+        self.misses = 0
+        self.promotions = 0
+        self.evictions = 0
+
+        self._counters = {}   # query -> number of executions
+        self._statements = {} # query -> [name, last use]
+        self._closing = []    # statements to be closed
+        self._clock = 0
+        self._serial = 0
+
+    def _promotable(self, query):
+        # helper method
+        query = query.strip().rstrip(";")
+
+        if not query or ";" in query:
+            return False
+
+        return query[:4].upper() != "COPY"
+
+    def _evict(self):
+        # close the least recently used statement
+        lru = None
+        for query, statement in self._statements.iteritems():
+            if lru is None or statement[1] < lru[1][1]:
+                lru = (query, statement)
+
+        query, (name, _) = lru
+        del self._statements[query]
+        self._closing.append(protocol.closeMessage("S", name))
+        self.evictions = self.evictions + 1
+
+    def _ebExecute(self, reason, request, query, name, prepare):
+        # forget the statement, if it is no more valid
+        reason.trap(protocol.PgError)
+
+        code = reason.value.errorField(protocol.PG_DIAG_SQLSTATE)
+        if (prepare and not request.parsed) or \
+                code == INVALID_STATEMENT_CODE:
+            self._statements.pop(query, None)
+        elif code == FEATURE_ERROR_CODE:
+            if self._statements.pop(query, None) is not None:
+                self._closing.append(protocol.closeMessage("S", name))
+
+        return reason
+
+    def request(self, query):
+        """Return the request for executing the query as a prepared
+        statement, or None if the query must be executed as a simple
+        query.
+        """
+
+        statement = self._statements.get(query)
+        if statement is None:
+            self.misses = self.misses + 1
+
+            count = self._counters.get(query, 0) + 1
+            if count < self.threshold or not self._promotable(query):
+                if len(self._counters) >= self.maxCounters:
+                    self._counters.clear()
+                self._counters[query] = count
+
+                return None
+
+            # promote the query
+            del self._counters[query]
+            if len(self._statements) >= self.maxStatements:
+                self._evict()
+
+            self._serial = self._serial + 1
+            name = "pglib_%d" % self._serial
+            statement = self._statements[query] = [name, 0]
+            self.promotions = self.promotions + 1
+
+            prepare = True
+            messages = [protocol.parseMessage(name, query)]
+        else:
+            self.hits = self.hits + 1
+
+            name = statement[0]
+            prepare = False
+            messages = []
+
+        self._clock = self._clock + 1
+        statement[1] = self._clock
+
+        if self._closing:
+            messages[:0] = self._closing
+            self._closing = []
+
+        messages.append(protocol.bindMessage("", name, ()))
+        messages.append(protocol.describeMessage("P", ""))
+        messages.append(protocol.executeMessage(""))
+        messages.append(protocol.SYNC_MESSAGE)
+
+        request = protocol.PgRequest("P", "")
+        request.messages = messages
+        request.deferred.addErrback(self._ebExecute, request, query,
+                                    name, prepare)
+
+        return request
+
+    def stats(self):
+        """Return the statistics of the cache.
+
+        @return: a dictionary with the hits, misses, promotions,
+                 evictions, hitRate and statements keys
+        @rtype: dict
+        """
+
+        total = self.hits + self.misses
+        if total:
+            rate = float(self.hits) / total
+        else:
+            rate = 0.0
+
+        return {"hits": self.hits, "misses": self.misses,
+                "promotions": self.promotions,
+                "evictions": self.evictions, "hitRate": rate,
+                "statements": len(self._statements)}
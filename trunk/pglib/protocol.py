@@ -26,9 +26,11 @@ except ImportError:
 from zope.interface import implements
 
 from twisted.python import log
-from twisted.internet import reactor, protocol, defer, interfaces
+from twisted.internet import protocol, defer, interfaces
 from twisted.internet.address import IPv4Address, UNIXAddress 
 import ipg
+import template
+import timer
 
 
 # protocol version
@@ -129,9 +131,25 @@ class PgError(Error):
     def __str__(self):
         return str(self.args)
 
+class BatchError(PgError):
+    """An error occurred while executing a batch of commands.
+
+    @ivar index: the index of the parameter set that failed, or None
+                 if the error is not related to a parameter set (as
+                 an error in the statement itself)
+    @type index: int
+    """
+
+    def __init__(self, args, index):
+        PgError.__init__(self, args)
+        self.index = index
+
 class InvalidRequest(Error):
     pass
 
+class QueryTimeoutError(Error):
+    pass
+
 class AuthenticationError(Error):
     pass
 
@@ -208,16 +226,436 @@ class PgRequest(object):
     @ivar payload: the data associated with the request
     @type payload: str
 
-    @ivar deferred: a deferred that will fire at command completion.
+    @ivar deferred: a deferred that will fire at command completion,
+                    or None when callbacks are used.
     @type deferred: L{twisted.internet.defer.Deferred}
+
+    @ivar callback: when given, it is called with the result at
+                    command completion, instead of firing a deferred
+    @type callback: callable
+
+    @ivar errback: when given, it is called with the exception in
+                   case of errors, instead of firing a deferred
+    @type errback: callable
+
+    @ivar messages: for extended query requests, an iterable of
+                    (already framed) messages, that will be streamed
+                    to the backend instead of the payload
+    @type messages: iterable
+
+    @ivar rowConsumer: an object implementing the
+                       L{pglib.ipg.IRowConsumer} interface, used only
+                       for this request instead of the one of the
+                       protocol
+
+    @ivar producer: an object implementing the L{pglib.ipg.IProducer}
+                    interface, used only for this request instead of
+                    the one of the protocol (COPY FROM STDIN)
+
+    @ivar consumer: an object implementing the L{pglib.ipg.IConsumer}
+                    interface, used only for this request instead of
+                    the one of the protocol (COPY TO STDOUT)
+
+    @ivar parsed: True when the backend has parsed the statement
+                  (extended query only)
+    @type parsed: bool
+
+    @ivar needSync: True when the backend is waiting for a Sync
+                    message, since the request is driven by Flush
+                    messages; in case of errors the protocol will send
+                    it
+    @type needSync: bool
+
+    @ivar timer: the timer for the request deadline, if any
+    @type timer: L{pglib.timer.Timer}
+
+    @ivar expired: True when the deadline has been reached; the
+                   result of the request is discarded
+    @type expired: bool
     """
-    
-    def __init__(self, opcode, payload):
+
+    __slots__ = ("opcode", "payload", "deferred", "callback", "errback",
+                 "messages", "rowConsumer", "producer", "consumer",
+                 "parsed", "needSync", "timer", "expired")
+
+    def __init__(self, opcode, payload, callback=None, errback=None):
         self.opcode = opcode
         self.payload = payload
+        
+        self.callback = callback
+        self.errback = errback
+        if callback is None:
+            self.deferred = defer.Deferred()
+        else:
+            self.deferred = None
+        
+        self.messages = None
+        self.rowConsumer = None
+        self.producer = None
+        self.consumer = None
+        self.parsed = False
+        self.needSync = False
+        
+        self.timer = None
+        self.expired = False
+
+    def succeed(self, result):
+        """Notify the result of the request.
+        """
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        elif self.expired:
+            return
+        
+        if self.deferred is not None:
+            self.deferred.callback(result)
+            return
+        
+        try:
+            self.callback(result)
+        except Exception:
+            log.err()
+
+    def fail(self, error):
+        """Notify an error.
+
+        @param error: the error
+        @type error: Exception
+        """
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        elif self.expired:
+            return
 
+        if self.deferred is not None:
+            self.deferred.errback(error)
+            return
+        
+        try:
+            if self.errback is not None:
+                self.errback(error)
+            else:
+                log.err(error)
+        except Exception:
+            log.err()
+
+
+# We keep a list of free requests for the callback based API, since
+# they are never exposed to the caller
+_freeRequests = []
+MAX_FREE_REQUESTS = 100
+
+def _newRequest(opcode, payload, callback, errback):
+    # get a request from the free list
+    if not _freeRequests:
+        return PgRequest(opcode, payload, callback, errback)
+    
+    request = _freeRequests.pop()
+    request.opcode = opcode
+    request.payload = payload
+    request.callback = callback
+    request.errback = errback
+
+    return request
+
+def _freeRequest(request):
+    # return a request to the free list
+    if len(_freeRequests) < MAX_FREE_REQUESTS:
+        request.payload = request.callback = request.errback = None
+        request.messages = request.rowConsumer = None
+        request.producer = request.consumer = None
+        request.parsed = request.needSync = request.expired = False
+        request.timer = None
+        
+        _freeRequests.append(request)
+
+
+#
+# Extended Query messages
+#
+# These helpers return the framed message, so that many messages can
+# be sent in a single write.
+#
+def message(opcode, payload):
+    """Return the message with the given type and payload, header
+    included.
+    """
+
+    return pack("!cI", opcode, len(payload) + 4) + payload
+
+def parseMessage(name, query, types=()):
+    """Parse: parse a query into a prepared statement.
+
+    @param name: the name of the prepared statement; the empty string
+                 selects the unnamed prepared statement
+    @type name: str
+
+    @param types: the OIDs of the parameters data types; parameters
+                  not listed are inferred by the backend
+    @type types: sequence of int
+    """
+
+    n = len(types)
+    payload = name + "\0" + query + "\0" + \
+        pack("!H" + "I" * n, n, *types)
+
+    return message("P", payload)
+
+def bindMessage(portal, name, args, fformat=0, rformat=0):
+    """Bind: bind parameters to a prepared statement, creating a
+    portal.
+
+    @param args: the parameters values, as strings or None (for NULL)
+    @type args: sequence
+
+    @param fformat: the format of all the parameters
+    @type fformat: int
+
+    @param rformat: the format of all the result columns
+    @type rformat: int
+    """
+
+    data = [portal, "\0", name, "\0", pack("!HHH", 1, fformat, len(args))]
+    for a in args:
+        if a is None:
+            data.append(NULL_LENGTH)
+        else:
+            data.append(pack("!i", len(a)))
+            data.append(a)
+    data.append(pack("!HH", 1, rformat))
+
+    return message("B", "".join(data))
+
+def executeMessage(portal, maxRows=0):
+    """Execute: execute a portal.
+
+    @param maxRows: the maximum number of rows to return; 0 means no
+                    limit
+    @type maxRows: int
+    """
+
+    return message("E", portal + "\0" + pack("!I", maxRows))
+
+def describeMessage(kind, name):
+    """Describe: describe a prepared statement ("S") or a portal
+    ("P").
+    """
+
+    return message("D", kind + name + "\0")
+
+def closeMessage(kind, name):
+    """Close: close a prepared statement ("S") or a portal ("P").
+    """
+
+    return message("C", kind + name + "\0")
+
+NULL_LENGTH = pack("!i", -1)
+SYNC_MESSAGE = message("S", "")
+FLUSH_MESSAGE = message("H", "")
+
+
+class MessageProducer(object):
+    """Stream messages to the backend, honoring the flow control of
+    the transport.
+
+    Messages are joined in chunks of (about) C{chunkSize} bytes, and
+    the production is paused when the transport buffer is full.
+
+    @ivar deferred: a deferred that will fire when all messages have
+                    been written to the transport, or when the
+                    iteration fails.
+    @type deferred: L{twisted.internet.defer.Deferred}
+    """
+
+    implements(interfaces.IPushProducer)
+
+    chunkSize = 2 ** 16
+
+    def __init__(self, transport, messages):
+        self.transport = transport
         self.deferred = defer.Deferred()
 
+        self._iterator = iter(messages)
+        self._paused = False
+
+    def start(self):
+        """Register ourself with the transport and start the production.
+        """
+
+        self.transport.registerProducer(self, True)
+        self.resumeProducing()
+
+        return self.deferred
+
+    def _stop(self):
+        # helper method
+        self._iterator = None
+        self.transport.unregisterProducer()
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+
+        iterator = self._iterator
+        chunkSize = self.chunkSize
+        write = self.transport.write
+
+        try:
+            # the transport will call pauseProducing from write, when
+            # its buffer is full
+            while iterator is not None and not self._paused:
+                chunk = []
+                size = 0
+                for data in iterator:
+                    chunk.append(data)
+                    size = size + len(data)
+                    if size >= chunkSize:
+                        break
+                else:
+                    # no more messages
+                    self._stop()
+                    write("".join(chunk))
+                    self.deferred.callback(None)
+                    return
+
+                write("".join(chunk))
+        except Exception:
+            self._stop()
+            self.deferred.errback()
+
+    def stopProducing(self):
+        self._paused = True
+        self._iterator = None
+
+
+class CopyProducer(object):
+    """Send the data of a L{pglib.ipg.IProducer} to the backend, for
+    COPY FROM STDIN, honoring the flow control of the transport.
+
+    Data is read only when the transport can accept it: the
+    production is paused when the transport buffer is full, and
+    resumed when it has been flushed.
+    The producer can also return a deferred, pausing the production
+    until data is available.
+    """
+
+    implements(interfaces.IPushProducer)
+
+    def __init__(self, protocol, producer):
+        self.protocol = protocol
+        self.producer = producer
+
+        self._paused = False
+        self._waiting = False
+        self._done = False
+
+    def start(self):
+        """Register ourself with the transport and start the production.
+        """
+
+        self.protocol.transport.registerProducer(self, True)
+        self.resumeProducing()
+
+    def _stop(self):
+        # helper method
+        self._done = True
+        self.protocol.transport.unregisterProducer()
+
+        if self.protocol._copyProducer is self:
+            self.protocol._copyProducer = None
+
+    def _abortProducer(self):
+        # helper method
+        abort = getattr(self.producer, "abort", None)
+        if abort is not None:
+            try:
+                abort()
+            except Exception:
+                log.err()
+
+    def abort(self):
+        """Stop the production, since the backend has ended the COPY
+        (with an ErrorResponse).
+        """
+
+        if not self._done:
+            self._stop()
+            self._abortProducer()
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def _send(self, data):
+        # helper method
+        protocol = self.protocol
+        
+        if not data:
+            # COPY terminated
+            self._stop()
+            protocol.copyDone()
+            protocol.lastResult = self.producer.close()
+        else:
+            protocol.copyData(data)
+
+    def _fail(self, error):
+        # helper method
+        log.err(error)
+
+        self._stop()
+        self._abortProducer()
+        self.protocol.copyFail(str(error))
+
+    def resumeProducing(self):
+        self._paused = False
+        if self._waiting:
+            return
+
+        read = self.producer.read
+        try:
+            # the transport will call pauseProducing from write, when
+            # its buffer is full
+            while not self._done and not self._paused:
+                data = read()
+                if isinstance(data, defer.Deferred):
+                    self._waiting = True
+                    data.addCallbacks(self._cbRead, self._ebRead)
+                    return
+                
+                self._send(data)
+        except Exception, error:
+            self._fail(error)
+
+    def _cbRead(self, data):
+        self._waiting = False
+        if self._done:
+            return
+
+        try:
+            self._send(data)
+        except Exception, error:
+            self._fail(error)
+            return
+
+        if not self._paused:
+            self.resumeProducing()
+
+    def _ebRead(self, reason):
+        self._waiting = False
+        if not self._done:
+            self._fail(reason.value)
+
+    def stopProducing(self):
+        # the connection has been lost
+        if not self._done:
+            self._done = True
+            self._abortProducer()
+
 
 
 class PgProtocol(protocol.Protocol):
@@ -263,6 +701,23 @@ class PgProtocol(protocol.Protocol):
 
     @ivar serverVersion: the version of the backend
     @type serverVersion: int
+
+    @ivar statements: when set, it is used by L{execute} to promote
+                      frequent queries to prepared statements
+    @type statements: L{pglib.prepared.StatementCache}
+
+    @ivar producer: the L{pglib.ipg.IProducer} used for COPY FROM STDIN,
+                    when the request does not have its own
+    
+    @ivar consumer: the L{pglib.ipg.IConsumer} used for COPY TO STDOUT,
+                    when the request does not have its own
+
+    @ivar copyBufferSize: when set, the data of COPY TO STDOUT is
+                          delivered to the consumer in buffers of (at
+                          least) this size, instead of one row at a
+                          time; with a C{writeSequence} method, the
+                          consumer receives the list of rows
+    @type copyBufferSize: int
     """
 
     implements(ipg.IFastPath)
@@ -283,6 +738,12 @@ class PgProtocol(protocol.Protocol):
     serverVersion = None
     backendPID = None
 
+    statements = None
+
+    producer = None
+    consumer = None
+    copyBufferSize = None
+
     
     def __init__(self, addr, handler=None, rowConsumer=None):
         """Initialize the protocol.
@@ -295,6 +756,7 @@ class PgProtocol(protocol.Protocol):
         self.addr = addr # used by cancel
         self.handler = handler or Handler()
         self.rowConsumer = rowConsumer or RowConsumer()
+        self._rowConsumer = self.rowConsumer # for the current request
         
         # cancellation key used for cancel a query in progress
         self.cancelKey = None
@@ -304,6 +766,12 @@ class PgProtocol(protocol.Protocol):
 
         self._buffer = ""
 
+        self._quoter = None
+
+        self._copyBuffer = []
+        self._copyBufferLength = 0
+        self._copyProducer = None # the CopyProducer of COPY FROM STDIN
+
     def _getContextFactory(self):
         context = getattr(self.factory, "sslContext", None)
         if context is not None:
@@ -366,7 +834,7 @@ class PgProtocol(protocol.Protocol):
 
         self._buffer = self._buffer + data
                                           
-        while len(self._buffer) > PG_HEADER_SIZE:
+        while len(self._buffer) >= PG_HEADER_SIZE:
             # read the message header
             opcode, size = unpack("!cI",
                                   self._buffer[:PG_HEADER_SIZE])
@@ -436,24 +904,57 @@ class PgProtocol(protocol.Protocol):
             log.msg("no SSL available")
             self.factory.clientConnectionMade(self)
             
-    def sendMessage(self, request):
+    def sendMessage(self, request, timeout=None):
         """Send the given message to the backend.
+
+        @param timeout: when given, the number of seconds after that
+                        the request will be cancelled, failing with a
+                        L{pglib.protocol.QueryTimeoutError}
+        @type timeout: float
         """
         
+        if timeout is not None:
+            request.timer = timer.wheel.schedule(timeout, self._expire,
+                                                 request, timeout)
+        
         self._queue.append(request)
         self._flush()
 
         return request.deferred
 
     def _flush(self):
-        # send the next queued request
-        if self._queue:
+        # send the next queued request, if the backend is not busy
+        if self._queue and self._last is None:
             request = self._queue.pop(0)
             
             self._last = request
+            self._rowConsumer = request.rowConsumer or self.rowConsumer
+            self._producer = request.producer or self.producer
+            self._consumer = request.consumer or self.consumer
             self.transactionStatus = PGTRANS_ACTIVE
             
-            self._sendMessage(request.opcode, request.payload)
+            if request.messages is not None:
+                # extended query
+                producer = MessageProducer(self.transport,
+                                           request.messages)
+                producer.start().addErrback(log.err)
+            else:
+                self._sendMessage(request.opcode, request.payload)
+
+    def _expire(self, request, timeout):
+        # the deadline of the request has been reached
+        request.timer = None
+
+        if request is self._last:
+            # the backend will reply with an error
+            d = self.getCancel().cancel()
+            d.addErrback(log.err)
+        else:
+            self._queue.remove(request)
+
+        request.fail(QueryTimeoutError(
+                "query timed out after %s seconds" % timeout))
+        request.expired = True
 
     def _sendMessage(self, opcode, payload):
         # internal helper
@@ -478,7 +979,7 @@ class PgProtocol(protocol.Protocol):
             error = InvalidRequest(opcode)
             
             if self._last is not None:
-                self._last.deferred.errback(error)
+                self._last.fail(error)
             else:
                 log.err(error)
             
@@ -508,10 +1009,20 @@ class PgProtocol(protocol.Protocol):
 
         self.lastError = error
         log.msg("ERROR:", str(error))
+
+        if self._copyProducer is not None:
+            # the COPY has been aborted by the backend: no more data
+            # must be sent, not even after the next query
+            self._copyProducer.abort()
+
+        if self._last.needSync:
+            # the backend will ignore all messages until Sync
+            self._last.needSync = False
+            self._sendMessage("S", "")
         
         # check if we failed the authentication
         if self._last.opcode is None:
-            self._last.deferred.errback(PgError(error))
+            self._last.fail(PgError(error))
             self.transport.loseConnection()
         
     def message_N(self, data):
@@ -540,7 +1051,7 @@ class PgProtocol(protocol.Protocol):
         if not method:
             error = UnsupportedError("Authentication",  authtype)
             
-            self._last.deferred.errback(error)
+            self._last.fail(error)
             self.transport.loseConnection()
 
         self.status = CONNECTION_AWAITING_RESPONSE # XXX
@@ -566,7 +1077,7 @@ class PgProtocol(protocol.Protocol):
 
         if self._password is None:
             error = AuthenticationError("password is required")
-            self._last.deferred.errback(error)
+            self._last.fail(error)
 
             self.transport.loseConnection()
             return
@@ -584,7 +1095,7 @@ class PgProtocol(protocol.Protocol):
 
         if self._password is None:
             error = AuthenticationError("password is required")
-            self._last.deferred.errback(error)
+            self._last.fail(error)
 
             self.transport.loseConnection()
             return
@@ -606,6 +1117,10 @@ class PgProtocol(protocol.Protocol):
 
         key, val, _ = data.split("\0")
         self.parameterStatus[key] = val
+
+        if key in ("standard_conforming_strings", "client_encoding"):
+            # quoting rules changed
+            self._quoter = None
 		
     def message_Z(self, transactionStatus):
         """ReadyForQuery: the backend is ready for a new query cycle.
@@ -613,29 +1128,35 @@ class PgProtocol(protocol.Protocol):
         
         self.transactionStatus = transactionStatus
 
-        assert self._last
-        deferred = self._last.deferred
-        opcode = self._last.opcode
+        request = self._last
+        assert request
         self._last = None
+
+        if self._copyProducer is not None:
+            self._copyProducer.abort()
         
         if self.lastError:
-            deferred.errback(PgError(self.lastError))
-            self.lastError = {}
-            return
-        
-        self.status = CONNECTION_OK
-        
-        if opcode is None: 
-            # compute the server version, as required by the libpq
-            # interface
-            version = self.parameterStatus["server_version"]
-            major, minor, rev = map(int, version.split("."))
-            self.serverVersion = rev + minor * 100 + major * 10000
-            
-            deferred.callback(self.parameterStatus)
+            # reset the error before firing, since the errback can
+            # issue new requests
+            error, self.lastError = self.lastError, {}
+            request.fail(PgError(error))
         else:
-            deferred.callback(self.lastResult)
+            self.status = CONNECTION_OK
+            
+            if request.opcode is None: 
+                # compute the server version, as required by the libpq
+                # interface
+                version = self.parameterStatus["server_version"]
+                major, minor, rev = map(int, version.split("."))
+                self.serverVersion = rev + minor * 100 + major * 10000
+                
+                request.succeed(self.parameterStatus)
+            else:
+                request.succeed(self.lastResult)
         
+        if request.deferred is None:
+            _freeRequest(request)
+
         # send the next request
         self._flush()
 
@@ -665,28 +1186,26 @@ class PgProtocol(protocol.Protocol):
         
         if cmdStatus == "COPY" and \
                 self.lastResult.status in (PGRES_COPY_OUT, PGRES_COPY_IN):
-            # XXX we already have a result
-            assert rows == 0
-            assert oid == 0
-            
+            # XXX we already have a result; the number of rows is
+            # reported only by PostgreSQL 8.2 and later
             self.lastResult.cmdStatus = cmdStatus
             self.lastResult.cmdTuples = rows
             self.lastResult.oidValue = oid
         else:
-            self.lastResult = self.rowConsumer.complete(cmdStatus,
+            self.lastResult = self._rowConsumer.complete(cmdStatus,
                                                         oid, rows)
     def message_T(self, data):
         """RowDescription: a description of row fields.
         """
 
         # XXX should we parse data here?
-        self.rowConsumer.description(data)
+        self._rowConsumer.description(data)
 
     def message_D(self, data):
         """DataRow: a row from the result.
         """
 
-        self.rowConsumer.row(data)
+        self._rowConsumer.row(data)
 
     def message_I(self, data):
         """EmptyQueryResponse: an empty query string was recognized.
@@ -694,6 +1213,40 @@ class PgProtocol(protocol.Protocol):
 
         self.lastResult = Result()
         
+
+    #
+    # Extended Query
+    #
+    def message_1(self, data):
+        """ParseComplete: the statement has been parsed.
+        """
+
+        self._last.parsed = True
+
+    def message_2(self, data):
+        """BindComplete: the parameters have been bound to a portal.
+        """
+
+        pass
+
+    def message_3(self, data):
+        """CloseComplete: the statement or portal has been closed.
+        """
+
+        pass
+
+    def message_n(self, data):
+        """NoData: the statement or portal will not return rows.
+        """
+
+        pass
+
+    def message_s(self, data):
+        """PortalSuspended: the row limit of Execute has been reached.
+        """
+
+        self._rowConsumer.suspended()
+
     
     #
     # Function Call (aka Fast-Path Interface)
@@ -716,25 +1269,6 @@ class PgProtocol(protocol.Protocol):
     #
     # COPY Operations
     #
-    def _copyData(self):
-        # helper method
-        
-        try:
-            data = self.producer.read()
-            if not data:
-                # COPY terminated
-                self.copyDone()
-                
-                self.lastResult = self.producer.close()
-            else:
-                self.copyData(data)
-                
-                # continue the transfer
-                reactor.callLater(0, self._copyData)
-        except Exception, error:
-            log.err(error)
-            self.copyFail(str(error))
-    
     def message_G(self, data):
         """CopyInResponse: the frontend must now send copy data.
         """
@@ -745,13 +1279,16 @@ class PgProtocol(protocol.Protocol):
         try:
             # NOTE we ignore formats, since this feature is not yet
             # implemented in the PostgreSQL backend
-            self.producer.description(ntuples, binaryTuples)
+            self._producer.description(ntuples, binaryTuples)
         except Exception, error:
             log.err(error)
             self.copyFail(str(error))
+            return
 
-        # send all data from producer to the backend
-        reactor.callLater(0, self._copyData)
+        # send all data from producer to the backend, as fast as the
+        # transport can accept it
+        self._copyProducer = CopyProducer(self, self._producer)
+        self._copyProducer.start()
         
     def message_H(self, data):
         """CopyOutResponse: the frontend must now receive copy data.
@@ -764,16 +1301,39 @@ class PgProtocol(protocol.Protocol):
         # format code
         # we ignore errors, since the frontend cannot abort data
         # transfer
-        self.consumer.description(ntuples, binaryTuples)
+        self._consumer.description(ntuples, binaryTuples)
+
+        self._copyBuffer = []
+        self._copyBufferLength = 0
+
+    def _flushCopyBuffer(self):
+        # deliver the buffered data to the consumer
+        buf = self._copyBuffer
+        self._copyBuffer = []
+        self._copyBufferLength = 0
+
+        writeSequence = getattr(self._consumer, "writeSequence", None)
+        if writeSequence is not None:
+            writeSequence(buf)
+        else:
+            self._consumer.write("".join(buf))
     
     def message_d(self, data):
         """CopyData: data for COPY.
 
-        The backend sends always one message per row.
+        The backend sends always one message per row; when
+        L{copyBufferSize} is set, data is buffered.
         """
 
         # we ignore errors, since the frontend cannot abort data transfer
-        self.consumer.write(data)
+        if self.copyBufferSize is None:
+            self._consumer.write(data)
+            return
+
+        self._copyBuffer.append(data)
+        self._copyBufferLength = self._copyBufferLength + len(data)
+        if self._copyBufferLength >= self.copyBufferSize:
+            self._flushCopyBuffer()
     
     def message_c(self, data):
         """CopyDone: COPY transfer complete.
@@ -781,7 +1341,10 @@ class PgProtocol(protocol.Protocol):
 
         assert not data
 
-        self.lastResult = self.consumer.close()
+        if self._copyBuffer:
+            self._flushCopyBuffer()
+
+        self.lastResult = self._consumer.close()
 
     
     #
@@ -853,17 +1416,218 @@ class PgProtocol(protocol.Protocol):
 
         self._sendMessage("p", password + "\0")
 
-    def execute(self, query, *args, **kwargs):
+    def execute(self, query, params=None, timeout=None):
         """Query: execute a simple query.
         
         @param query: the query to execute
         @type query: str
 
-        @todo: string interpolation.
+        @param params: the parameters to be quoted and interpolated in
+                       the query, with C{%s} or C{%(name)s}
+                       placeholders
+        @type params: sequence or dict
+
+        @param timeout: the deadline for the query, in seconds; when
+                        reached, the query is cancelled
+        @type timeout: float
         """
 
+        if params is not None:
+            query = self.interpolate(query, params)
+        
+        if self.statements is not None:
+            request = self.statements.request(query)
+            if request is not None:
+                return self.sendMessage(request, timeout)
+        
         request = PgRequest("Q", query + "\0")
-        return self.sendMessage(request)
+        return self.sendMessage(request, timeout)
+
+    def sendQuery(self, query, callback, errback=None, params=None,
+                  timeout=None):
+        """Query: execute a simple query, calling C{callback} with the
+        result, or C{errback} with the exception.
+
+        This is a lower level alternative to L{execute}, that avoids
+        the overhead of deferreds.
+
+        @param callback: a function that will be called with the
+                         result
+        @type callback: callable
+
+        @param errback: a function that will be called with the
+                        exception, in case of errors; when not given,
+                        errors are logged
+        @type errback: callable
+
+        @param timeout: the deadline for the query, in seconds
+        @type timeout: float
+
+        @note: exceptions raised by callbacks are logged.
+        @note: queries are never promoted to prepared statements.
+        """
+
+        if params is not None:
+            query = self.interpolate(query, params)
+
+        request = _newRequest("Q", query + "\0", callback, errback)
+        if timeout is not None:
+            request.timer = timer.wheel.schedule(timeout, self._expire,
+                                                 request, timeout)
+
+        self._queue.append(request)
+        self._flush()
+
+    def executemany(self, query, seq, fformat=0, tags=False,
+                    timeout=None):
+        """Execute a command against all the parameter sequences in
+        C{seq}, using the extended query protocol.
+
+        The command is parsed only once, then a Bind/Execute pair is
+        sent for each parameter sequence, followed by a single Sync.
+        Messages are streamed to the backend, honoring the flow control
+        of the transport.
+
+        Note that all the commands are executed in the same
+        transaction: if one of them fails, none will be committed.
+
+        @param query: the command to execute, using $1, $2, ... as
+                      parameters placeholders
+        @type query: str
+
+        @param seq: an iterable of sequences of parameters
+        @type seq: iterable
+
+        @param fformat: the parameters format; can be 0 (text) or 1
+                        (binary)
+        @type fformat: int
+
+        @param tags: if True, the result will have a C{tags} attribute,
+                     with the (cmdStatus, oidValue, cmdTuples) tuple of
+                     each command
+        @type tags: bool
+
+        @param timeout: the deadline for the whole batch, in seconds
+        @type timeout: float
+
+        @note: Arguments must be strings, or None for NULL values.
+        
+        @return: a deferred that will fire with the result; its
+                 C{cmdTuples} is the number of the rows affected by
+                 all the commands (0, with C{cmdStatus} set to None,
+                 if C{seq} is empty).
+                 In case of errors, it will fire with a
+                 L{pglib.protocol.BatchError}, with the index of the
+                 parameter sequence that failed.
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        consumer = BatchRowConsumer(tags)
+
+        failure = [] # local errors, see _batchMessages
+
+        request = PgRequest("P", "")
+        request.rowConsumer = consumer
+        request.messages = self._batchMessages(query, seq, fformat,
+                                               failure)
+
+        def cbBatch(result):
+            # with no parameter sequences, no command is completed and
+            # the backend only replies to Parse and Sync
+            return consumer.result
+
+        def ebBatch(reason):
+            reason.trap(PgError)
+
+            if failure:
+                # the error was raised by us
+                index, args = failure[0]
+            elif request.parsed:
+                index, args = consumer.count, reason.value.args
+            else:
+                index, args = None, reason.value.args
+            
+            raise BatchError(args, index)
+
+        return self.sendMessage(request, timeout).addCallbacks(cbBatch,
+                                                               ebBatch)
+
+    def cursor(self, query, args=(), fformat=0, rows=100, prefetch=1):
+        """Execute a query, retrieving the rows in batches from a
+        portal, using the extended query protocol.
+
+        Unlike DECLARE CURSOR, no additional round trip is required:
+        the portal is executed with a limit on the number of rows, and
+        the next batch is requested as soon as the previous one has
+        been received.
+        
+        The connection is reserved to the cursor until it is
+        exhausted or closed.
+
+        @param query: the query to execute, using $1, $2, ... as
+                      parameters placeholders
+        @type query: str
+
+        @param args: the parameters, as strings or None
+        @type args: sequence
+
+        @param fformat: the format of parameters and columns; can be 0
+                        (text) or 1 (binary)
+        @type fformat: int
+
+        @param rows: the initial number of rows in a batch
+        @type rows: int
+
+        @param prefetch: the number of batches to keep ready
+        @type prefetch: int
+
+        @return: the cursor
+        @rtype: L{pglib.protocol.Cursor}
+        """
+
+        cursor = Cursor(self, rows, prefetch)
+
+        request = PgRequest("P", "")
+        request.rowConsumer = cursor
+        request.needSync = True
+        request.messages = [
+            parseMessage("", query),
+            bindMessage("", "", args, fformat, fformat),
+            describeMessage("P", ""),
+            executeMessage("", rows),
+            FLUSH_MESSAGE
+            ]
+
+        cursor.start(request, self.sendMessage(request))
+        
+        return cursor
+
+    def _batchMessages(self, query, seq, fformat, failure):
+        # helper generator for executemany
+        
+        yield parseMessage("", query)
+
+        execute = executeMessage("")
+        index = 0
+        try:
+            for args in seq:
+                if self.lastError:
+                    # the backend will ignore all messages until Sync
+                    break
+
+                yield bindMessage("", "", args, fformat) + execute
+                index = index + 1
+        except Exception, error:
+            log.err(error)
+            
+            failure.append((index, {PG_DIAG_SEVERITY: "ERROR",
+                                    PG_DIAG_MESSAGE_PRIMARY: str(error)}))
+            
+            # make sure the transaction is aborted, executing a portal
+            # that does not exist
+            yield executeMessage("pglib_abort")
+
+        yield SYNC_MESSAGE
 
     def fn(self, fnid, fformat, *args):
         """FunctionCall: execute a function.
@@ -909,7 +1673,9 @@ class PgProtocol(protocol.Protocol):
         @note: internal method
         """
 
-        self._sendMessage("d", data)
+        # avoid copying the data, that can be large
+        self.transport.writeSequence([pack("!cI", "d", len(data) + 4),
+                                      data])
     
     def copyFail(self, error):
         """CopyFail: COPY transfer failed.
@@ -968,6 +1734,39 @@ class PgProtocol(protocol.Protocol):
     #
     # Helper methods
     #
+    def quoter(self):
+        """Return the object used for quoting parameters, as required
+        by the current runtime parameters of the backend.
+
+        @rtype: L{pglib.template.Quoter}
+        """
+
+        if self._quoter is None:
+            self._quoter = template.Quoter.fromParameters(
+                self.parameterStatus, self.serverVersion
+                )
+
+        return self._quoter
+
+    def interpolate(self, query, params):
+        """Return the query with the parameters quoted and
+        interpolated.
+
+        Compiled templates are cached, so that a query is parsed only
+        once.
+        
+        @param query: the query, with C{%s} or C{%(name)s}
+                      placeholders
+        @type query: str
+
+        @param params: the parameters
+        @type params: sequence or dict
+
+        @rtype: str
+        """
+
+        return template.compile(query).interpolate(params, self.quoter())
+
     def errorMessage(self):
         """Return the error message associated with th3 last command,
         or an empty string if there was no error.
@@ -1091,7 +1890,65 @@ class Result(object):
     def __init__(self):
         self.descriptions = []
         self.rows = []
+
+    def copy(self):
+        """Return a copy of the result, that can be safely modified.
+
+        Rows are copied, values are shared (they are immutable).
+        """
+
+        result = self.__class__()
+        result.__dict__.update(self.__dict__)
+        
+        result.descriptions = self.descriptions[:]
+        result.rows = [list(row) for row in self.rows]
+
+        return result
         
+class BatchRowConsumer(object):
+    """An implementation of the L{pglib.ipg.IRowConsumer} interface,
+    that accumulates the results of a batch of commands.
+
+    Rows are discarded.
+
+    @ivar count: the number of commands completed
+    @type count: int
+    """
+
+    implements(ipg.IRowConsumer)
+
+    def __init__(self, tags=False):
+        self.count = 0
+
+        self.result = Result()
+        self.result.status = PGRES_COMMAND_OK
+        self.result.cmdTuples = 0
+        self.result.oidValue = 0
+
+        if tags:
+            self.tags = self.result.tags = []
+        else:
+            self.tags = None
+
+    def description(self, data):
+        pass
+
+    def row(self, data):
+        pass
+
+    def complete(self, status, oid, rows):
+        self.count = self.count + 1
+        
+        result = self.result
+        result.cmdStatus = status
+        result.cmdTuples = result.cmdTuples + rows
+        result.oidValue = oid
+
+        if self.tags is not None:
+            self.tags.append((status, oid, rows))
+
+        return result
+
 class RowConsumer(object):
     """Default implementation for the L{pglib.ipg.IRowConsumer}
     interface.
@@ -1132,7 +1989,7 @@ class RowConsumer(object):
 
         row = []
         for i in range(ntuples):
-            (length,) = unpack("!I", buf.read(4))
+            (length,) = unpack("!i", buf.read(4))
             if length == -1:
                 # a NULL value
                 row.append(None)
@@ -1161,3 +2018,210 @@ class RowConsumer(object):
         self.result = Result()
         
         return tmp
+
+
+class Cursor(RowConsumer):
+    """A cursor on the unnamed portal, implementing the
+    L{pglib.ipg.IPortalConsumer} interface.
+
+    Rows are retrieved in batches; the size of a batch is adapted
+    to the size of the rows, so that each batch is about
+    C{batchBytes} bytes.
+    
+    The cursor is also an iterator of deferreds, each one firing with
+    a list of rows (the last one may fire with an empty list), so
+    that it can be used, as an example, with
+    L{twisted.internet.task.coiterate}:
+
+      >>> def process(cursor):
+      ...     for d in cursor:
+      ...         yield d.addCallback(cbRows)
+      >>> task.coiterate(process(cursor))
+
+    @ivar descriptions: a list of objects implementing
+                        L{pglib.ipg.IRowDescription}
+    @type descriptions: list
+
+    @ivar done: True when all the rows have been received
+    @type done: bool
+    """
+
+    implements(ipg.IPortalConsumer)
+
+    batchBytes = 2 ** 18
+    minRows = 10
+    maxRows = 10000
+
+    def __init__(self, protocol, rows=100, prefetch=1):
+        RowConsumer.__init__(self)
+        
+        self.protocol = protocol
+        self.rows = rows
+        self.prefetch = prefetch
+
+        self.descriptions = self.result.descriptions
+        self.done = False
+
+        self._request = None
+        self._batches = [] # batches ready
+        self._waiting = [] # deferreds waiting for a batch
+        self._closing = []
+        self._busy = True  # an Execute is in progress
+        self._size = 0     # bytes received in the current batch
+        self._failure = None
+
+    def start(self, request, deferred):
+        # called by the protocol
+        self._request = request
+        deferred.addCallbacks(self._cbFinish, self._ebFinish)
+
+    def _cbFinish(self, result):
+        self.done = True
+        
+        while self._waiting:
+            self._waiting.pop(0).callback([])
+
+        while self._closing:
+            self._closing.pop(0).callback(None)
+
+    def _ebFinish(self, reason):
+        self.done = True
+        self._failure = reason
+
+        while self._waiting:
+            self._waiting.pop(0).errback(reason)
+
+        while self._closing:
+            self._closing.pop(0).errback(reason)
+
+    def _write(self, data):
+        # helper method
+        self.protocol.transport.write(data)
+
+    def _execute(self):
+        # request the next batch, if required
+        if self._busy or self.done or self._closing:
+            return
+
+        if len(self._batches) < self.prefetch:
+            self._busy = True
+            self._write(executeMessage("", self.rows) + FLUSH_MESSAGE)
+
+    def _sync(self, data=""):
+        # terminate the request
+        self._request.needSync = False
+        self._write(data + SYNC_MESSAGE)
+
+    def _deliver(self, rows):
+        # helper method
+        if self._waiting:
+            self._waiting.pop(0).callback(rows)
+        elif rows:
+            self._batches.append(rows)
+
+    def row(self, data):
+        self._size = self._size + len(data)
+        RowConsumer.row(self, data)
+    
+    def suspended(self):
+        self._busy = False
+
+        rows = self.result.rows
+        self.result.rows = []
+
+        # adapt the size of the next batch
+        if rows:
+            size = max(self._size // len(rows), 1)
+            self.rows = max(self.minRows,
+                            min(self.maxRows, self.batchBytes // size))
+        self._size = 0
+
+        self._deliver(rows)
+        
+        if self._closing:
+            self._sync(closeMessage("P", ""))
+        else:
+            self._execute()
+
+    def complete(self, status, oid, rows):
+        self._busy = False
+        self.done = True
+
+        self._deliver(self.result.rows)
+        self._sync()
+        
+        result = Result()
+        result.descriptions = self.descriptions
+        result.cmdStatus = status
+        result.cmdTuples = rows
+        result.oidValue = oid
+        result.nfields = len(self.descriptions)
+        result.status = PGRES_TUPLES_OK
+
+        self.result = Result()
+
+        return result
+
+    def fetch(self):
+        """Fetch the next batch of rows.
+
+        @return: a deferred that will fire with a list of rows; the
+                 list is empty when there are no more rows.
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        if self._batches:
+            rows = self._batches.pop(0)
+            self._execute()
+            
+            return defer.succeed(rows)
+
+        if self._failure is not None:
+            return defer.fail(self._failure)
+
+        if self.done:
+            return defer.succeed([])
+
+        d = defer.Deferred()
+        self._waiting.append(d)
+        self._execute()
+
+        return d
+
+    def close(self):
+        """Close the cursor, discarding the remaining rows.
+
+        @return: a deferred that will fire when the portal has been
+                 closed, and the connection can be used again.
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        self._batches = []
+        
+        if self._failure is not None:
+            return defer.fail(self._failure)
+
+        d = defer.Deferred()
+        if self.done and not self._request.needSync:
+            if self.protocol._last is self._request:
+                # waiting for ReadyForQuery
+                self._closing.append(d)
+            else:
+                d.callback(None)
+
+            return d
+
+        self._closing.append(d)
+        if not self._busy and self.protocol._last is self._request:
+            self._sync(closeMessage("P", ""))
+
+        return d
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.done and not self._batches:
+            raise StopIteration
+        
+        return self.fetch()
@@ -0,0 +1,145 @@
+"""Allocation of sequence values in blocks.
+
+$Id$
+
+THIS SOFTWARE IS UNDER MIT LICENSE.
+Copyright (c) 2006 Perillo Manlio (manlio.perillo@gmail.com)
+
+Read LICENSE file for more informations.
+"""
+
+from twisted.internet import defer
+
+
+class SequenceAllocator(object):
+    """Hand out values of a sequence, fetched from the backend in
+    blocks of C{blockSize} values with a single query.
+
+    A new block is requested in the background when the available
+    values fall to C{lowWater}, so that most allocations do not wait
+    for the backend.
+
+    @note: Values are unique, but not contiguous, and values never
+           handed out are lost, as usual with sequences.
+
+    @ivar queries: the number of queries executed
+    @type queries: int
+    """
+
+    def __init__(self, protocol, name, blockSize=100, lowWater=25):
+        """Initialize the allocator.
+
+        @param name: the name of the sequence
+        @type name: str
+
+        @param blockSize: the number of values fetched by each query
+        @type blockSize: int
+
+        @param lowWater: the number of available values that starts
+                         a refill
+        @type lowWater: int
+        """
+
+        self.protocol = protocol
+        self.name = name
+        self.blockSize = blockSize
+        self.lowWater = lowWater
+
+        self.queries = 0
+
+        self._values = []
+        self._index = 0
+        self._waiters = []
+        self._refilling = False
+
+    def available(self):
+        """Return the number of values available locally.
+        """
+
+        return len(self._values) - self._index
+
+    def allocate(self):
+        """Return a new value of the sequence.
+
+        @return: a deferred that will fire with the value, at once when
+                 a value is available
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+
+        if self._index < len(self._values):
+            value = self._values[self._index]
+            self._index = self._index + 1
+
+            if self.available() <= self.lowWater:
+                self._refill()
+
+            return defer.succeed(value)
+
+        d = defer.Deferred()
+        self._waiters.append(d)
+        self._refill()
+
+        return d
+
+    def _refill(self):
+        # helper method
+        if self._refilling:
+            return
+
+        self._refilling = True
+        self.queries = self.queries + 1
+
+        count = max(self.blockSize, len(self._waiters))
+        d = self.protocol.execute(
+            "SELECT nextval(%s) FROM generate_series(1, %s)",
+            (self.name, count))
+        d.addCallbacks(self._cbRefill, self._ebRefill)
+
+    def _cbRefill(self, result):
+        self._refilling = False
+
+        values = self._values[self._index:]
+        values.extend([int(row[0]) for row in result.rows])
+
+        n = min(len(values), len(self._waiters))
+        waiters = self._waiters[:n]
+        del self._waiters[:n]
+
+        self._values = values
+        self._index = n
+
+        for d, value in zip(waiters, values):
+            d.callback(value)
+
+        if self._waiters or self.available() <= self.lowWater:
+            self._refill()
+
+    def _ebRefill(self, reason):
+        self._refilling = False
+
+        waiters = self._waiters
+        self._waiters = []
+        for d in waiters:
+            d.errback(reason)
+
+
+def allocator(protocol, name, blockSize=100, lowWater=25):
+    """Return the allocator for a sequence on a connection, creating
+    it when needed (the other arguments are then ignored).
+
+    The allocators are kept by the connection, so that they live as
+    long as it does.
+
+    @rtype: L{SequenceAllocator}
+    """
+
+    allocators = getattr(protocol, "_sequenceAllocators", None)
+    if allocators is None:
+        allocators = protocol._sequenceAllocators = {}
+
+    try:
+        return allocators[name]
+    except KeyError:
+        allocator = allocators[name] = SequenceAllocator(
+            protocol, name, blockSize, lowWater)
+        return allocator
@@ -0,0 +1,317 @@
+"""Query templates, with client side quoting of literals.
+
+$Id$
+
+THIS SOFTWARE IS UNDER MIT LICENSE.
+Copyright (c) 2006 Perillo Manlio (manlio.perillo@gmail.com)
+
+Read LICENSE file for more informations.
+"""
+
+import re
+import codecs
+import datetime
+
+try:
+    from decimal import Decimal
+except ImportError:
+    Decimal = None
+
+
+# placeholders: %s, %(name)s and the escaped %%
+PLACEHOLDER_RE = re.compile(r"%(?:\((?P<name>[^)]*)\))?(?P<type>.)")
+
+# the maximum number of compiled templates kept in the cache
+MAX_CACHED = 500
+
+# PostgreSQL encoding names that Python does not know
+ENCODINGS = {
+    "SQL_ASCII": "ascii",
+    "UNICODE": "utf_8",
+    "UTF8": "utf_8",
+    "LATIN1": "latin_1",
+    "LATIN2": "iso8859_2",
+    "LATIN9": "iso8859_15",
+    "WIN": "cp1251",
+    "ALT": "cp866",
+    "EUC_JP": "euc_jp",
+    "EUC_KR": "euc_kr",
+    "SJIS": "shift_jis",
+    "BIG5": "big5",
+    "GBK": "gbk",
+    "GB18030": "gb18030",
+    "WIN932": "cp932",
+    "WIN936": "cp936",
+    "WIN950": "cp950",
+    "UHC": "cp949",
+    "JOHAB": "johab",
+    "KOI8": "koi8_r",
+    }
+
+# client encodings where a byte of a multibyte character can be a quote
+# or a backslash, so that escaping must be done on characters
+UNSAFE_ENCODINGS = ["shift_jis", "big5", "gbk", "johab", "gb18030",
+                    "cp932", "cp936", "cp950", "big5hkscs"]
+
+
+class TemplateError(Exception):
+    pass
+
+
+class Template(object):
+    """A compiled query template.
+
+    The query is split once in literal parts and placeholders, so
+    that interpolation is a single join.
+
+    Placeholders can be positional (C{%s}) or named (C{%(name)s}),
+    but not both; C{%%} is a literal C{%}.
+
+    @ivar parts: the literal parts of the query
+    @type parts: list
+
+    @ivar keys: the index (for positional placeholders) or the name of
+                each parameter
+    @type keys: list
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.parts = []
+        self.keys = []
+
+        named = None
+        buf = []
+        pos = 0
+        for match in PLACEHOLDER_RE.finditer(query):
+            buf.append(query[pos:match.start()])
+            pos = match.end()
+
+            name, type = match.group("name", "type")
+            if type == "%" and name is None:
+                buf.append("%")
+                continue
+            elif type != "s":
+                raise TemplateError("unsupported format character %r at "
+                                    "index %d" % (type, match.start()))
+
+            if named is None:
+                named = name is not None
+            elif named != (name is not None):
+                raise TemplateError("positional and named placeholders "
+                                    "cannot be mixed")
+
+            self.parts.append("".join(buf))
+            buf = []
+
+            if named:
+                self.keys.append(name)
+            else:
+                self.keys.append(len(self.keys))
+
+        buf.append(query[pos:])
+        self.parts.append("".join(buf))
+
+        self.named = bool(named)
+
+    def interpolate(self, params, quote):
+        """Return the query, with parameters quoted and inserted.
+
+        @param params: a sequence or a mapping, with the parameters
+        @param quote: the function used for quoting a parameter
+        @type quote: callable
+        """
+
+        keys = self.keys
+        if not self.named and len(params) != len(keys):
+            raise TemplateError("the query requires %d parameters, "
+                                "%d given" % (len(keys), len(params)))
+
+        parts = self.parts
+        chunks = [parts[0]] * (2 * len(keys) + 1)
+        i = 1
+        for key in keys:
+            chunks[i] = quote(params[key])
+            chunks[i + 1] = parts[(i + 1) // 2]
+            i = i + 2
+
+        return "".join(chunks)
+
+
+_cache = {}
+
+def compile(query):
+    """Return the compiled template for the query, from the cache
+    when available.
+    """
+
+    try:
+        return _cache[query]
+    except KeyError:
+        if len(_cache) >= MAX_CACHED:
+            _cache.clear()
+
+        template = _cache[query] = Template(query)
+        return template
+
+
+class Quoter(object):
+    """Quote Python objects as SQL literals.
+
+    Quoting depends on the standard_conforming_strings and
+    client_encoding runtime parameters of the connection.
+
+    The quoting function is chosen by the type of the object; new
+    types can be registered in the C{adapters} dictionary, mapping a
+    type to a function that takes the quoter and the object.
+    """
+
+    def __init__(self, standardStrings=False, encoding="SQL_ASCII",
+                 escapeSyntax=True):
+        """Initialize the quoter.
+
+        @param standardStrings: True if backslashes are literal in
+                                strings (standard_conforming_strings)
+        @type standardStrings: bool
+
+        @param encoding: the client encoding, as named by PostgreSQL
+        @type encoding: str
+
+        @param escapeSyntax: True if the backend supports the E''
+                             syntax for escape strings (8.1 or later)
+        @type escapeSyntax: bool
+        """
+
+        self.standardStrings = standardStrings
+        self.escapeSyntax = escapeSyntax
+        self.encoding = ENCODINGS.get(encoding.upper(), encoding.lower())
+
+        try:
+            codecs.lookup(self.encoding)
+        except LookupError:
+            self.encoding = "utf_8"
+
+        self.adapters = ADAPTERS.copy()
+
+    def fromParameters(cls, parameters, serverVersion=None):
+        """Create a quoter for the given backend runtime parameters.
+
+        @param parameters: the parameterStatus of a connection
+        @type parameters: dict
+        """
+
+        standardStrings = parameters.get(
+            "standard_conforming_strings", "off") == "on"
+        encoding = parameters.get("client_encoding", "SQL_ASCII")
+        escapeSyntax = serverVersion is None or serverVersion >= 80100
+
+        return cls(standardStrings, encoding, escapeSyntax)
+    fromParameters = classmethod(fromParameters)
+
+    def __call__(self, obj):
+        try:
+            adapter = self.adapters[type(obj)]
+        except KeyError:
+            # try the base classes
+            for cls in type(obj).__mro__[1:]:
+                adapter = self.adapters.get(cls)
+                if adapter is not None:
+                    self.adapters[type(obj)] = adapter
+                    break
+            else:
+                raise TypeError("cannot quote objects of type %s" %
+                                type(obj).__name__)
+
+        return adapter(self, obj)
+
+    def quoteString(self, s):
+        """Quote a byte string, in the client encoding.
+        """
+
+        if self.encoding in UNSAFE_ENCODINGS:
+            try:
+                s = s.decode(self.encoding)
+            except UnicodeError:
+                raise ValueError("strings must be valid %s" % self.encoding)
+
+            return self._quote(s).encode(self.encoding)
+
+        return self._quote(s)
+
+    def _quote(self, s):
+        # helper method, s can be a byte or an unicode string
+        if "\0" in s:
+            raise ValueError("strings cannot contain null bytes")
+
+        s = s.replace("'", "''")
+        if self.standardStrings or "\\" not in s:
+            return "'" + s + "'"
+
+        s = s.replace("\\", "\\\\")
+        if self.escapeSyntax:
+            return "E'" + s + "'"
+        else:
+            return "'" + s + "'"
+
+
+def _quoteUnicode(quoter, obj):
+    if quoter.encoding in UNSAFE_ENCODINGS:
+        # escape the characters before encoding them
+        return quoter._quote(obj).encode(quoter.encoding)
+
+    return quoter.quoteString(obj.encode(quoter.encoding))
+
+def _quoteInt(quoter, obj):
+    # negative numbers are enclosed in parentheses, so that a minus in
+    # the query does not make a comment (as in "x-%s")
+    s = str(obj)
+    if s.startswith("-"):
+        return "(" + s + ")"
+
+    return s
+
+def _quoteFloat(quoter, obj):
+    # the sign is checked on the string, since -0.0 is not negative
+    s = repr(obj)
+    if s[-1:] in "0123456789":
+        if s.startswith("-"):
+            return "(" + s + ")"
+        return s
+
+    # nan or inf
+    return "'%s'::float8" % {"nan": "NaN", "inf": "Infinity",
+                             "-inf": "-Infinity"}[s.lower()]
+
+def _quoteSequence(quoter, obj):
+    # suitable for IN lists
+    if not obj:
+        raise ValueError("empty sequences cannot be quoted")
+
+    return "(" + ", ".join([quoter(item) for item in obj]) + ")"
+
+def _quoteList(quoter, obj):
+    return "ARRAY[" + ", ".join([quoter(item) for item in obj]) + "]"
+
+def _quoteDateTime(quoter, obj):
+    return "'" + obj.isoformat() + "'"
+
+ADAPTERS = {
+    str: Quoter.quoteString,
+    unicode: _quoteUnicode,
+    int: _quoteInt,
+    long: _quoteInt,
+    float: _quoteFloat,
+    bool: lambda quoter, obj: obj and "true" or "false",
+    type(None): lambda quoter, obj: "NULL",
+    tuple: _quoteSequence,
+    list: _quoteList,
+    datetime.date: _quoteDateTime,
+    datetime.time: _quoteDateTime,
+    datetime.datetime: _quoteDateTime,
+    datetime.timedelta: lambda quoter, obj: "'%d days %d seconds " \
+        "%d microseconds'::interval" % (obj.days, obj.seconds,
+                                        obj.microseconds),
+    }
+
+if Decimal is not None:
+    ADAPTERS[Decimal] = lambda quoter, obj: "'%s'::numeric" % obj
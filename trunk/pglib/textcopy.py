@@ -0,0 +1,193 @@
+"""The text format of COPY: escaping, encoding and decoding of rows.
+
+$Id$
+
+THIS SOFTWARE IS UNDER MIT LICENSE.
+Copyright (c) 2006 Perillo Manlio (manlio.perillo@gmail.com)
+
+Read LICENSE file for more informations.
+"""
+
+import re
+import datetime
+
+from zope.interface import implements
+
+import ipg
+import protocol
+
+
+NULL = "\\N"
+
+# the escapes used by the backend, and the ones it accepts
+ESCAPES = {
+    "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v",
+    }
+ESCAPE_RE = re.compile(r"\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))",
+                       re.DOTALL)
+
+
+def escape(s):
+    """Escape a string for the text format of COPY.
+    """
+
+    if "\\" in s:
+        s = s.replace("\\", "\\\\")
+
+    return s.replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def _unescapeMatch(match):
+    octal, hex, char = match.groups()
+    if octal is not None:
+        return chr(int(octal, 8) & 0xff)
+    elif hex is not None:
+        return chr(int(hex, 16))
+    else:
+        return ESCAPES.get(char, char)
+
+def unescape(s):
+    """Undo the escaping of a field in the text format of COPY.
+    """
+
+    if "\\" not in s:
+        return s
+
+    return ESCAPE_RE.sub(_unescapeMatch, s)
+
+
+# converters of Python values to text, before escaping
+def _str(value, encoding):
+    return value
+
+def _none(value, encoding):
+    return NULL
+
+def _unicode(value, encoding):
+    return value.encode(encoding)
+
+def _float(value, encoding):
+    return repr(value)
+
+def _bool(value, encoding):
+    return value and "t" or "f"
+
+def _isoformat(value, encoding):
+    return value.isoformat()
+
+def _other(value, encoding):
+    return str(value)
+
+CONVERTERS = {
+    str: _str,
+    type(None): _none,
+    unicode: _unicode,
+    int: _other,
+    long: _other,
+    float: _float,
+    bool: _bool,
+    datetime.date: _isoformat,
+    datetime.time: _isoformat,
+    datetime.datetime: _isoformat,
+    }
+
+
+def encodeValue(value, encoding="utf_8"):
+    """Return the text representation of a value, for COPY.
+
+    @param encoding: the encoding used for unicode strings
+    @type encoding: str
+    """
+
+    if value is None:
+        return NULL
+
+    return escape(CONVERTERS.get(type(value), _other)(value, encoding))
+
+def encodeRow(row, encoding="utf_8"):
+    """Return a row as a line of the text format of COPY.
+
+    The fields are joined and checked for special characters with a
+    few scans of the line; they are escaped one by one only when
+    needed.
+    """
+
+    get = CONVERTERS.get
+    fields = [get(type(value), _other)(value, encoding) for value in row]
+    line = "\t".join(fields)
+
+    # the only backslashes allowed are the ones of NULLs
+    backslashes = line.count("\\")
+    if "\n" in line or "\r" in line or \
+            line.count("\t") != len(fields) - 1 or \
+            (backslashes and
+             backslashes != len([value for value in row if value is None])):
+        fields = [(value is None and NULL) or escape(field)
+                  for value, field in zip(row, fields)]
+        line = "\t".join(fields)
+
+    return line + "\n"
+
+def decodeLine(line):
+    """Return the fields of a line in the text format of COPY, as a
+    list of strings (None for NULLs).
+    """
+
+    if line[-1:] == "\n":
+        line = line[:-1]
+
+    fields = line.split("\t")
+    if "\\" not in line:
+        return fields
+
+    for i, field in enumerate(fields):
+        if field == NULL:
+            fields[i] = None
+        elif "\\" in field:
+            fields[i] = ESCAPE_RE.sub(_unescapeMatch, field)
+
+    return fields
+
+def decodeLines(data):
+    """Return the rows of many lines in the text format of COPY.
+    """
+
+    lines = data.split("\n")
+    if not lines[-1]:
+        del lines[-1]
+
+    if "\\" not in data:
+        return [line.split("\t") for line in lines]
+
+    return [decodeLine(line) for line in lines]
+
+
+class TextConsumer(object):
+    """An implementation of the L{pglib.ipg.IConsumer} interface, that
+    decodes the rows of COPY TO STDOUT in the text format.
+
+    Rows are appended to C{rows}, as lists of strings (None for
+    NULLs).
+    """
+
+    implements(ipg.IConsumer)
+
+    def __init__(self):
+        self.rows = []
+
+    def description(self, ntuples, binaryTuples):
+        self.ntuples = ntuples
+        self.binaryTuples = binaryTuples
+
+    def write(self, data):
+        self.rows.extend(decodeLines(data))
+
+    def writeSequence(self, seq):
+        self.rows.extend(decodeLines("".join(seq)))
+
+    def close(self):
+        result = protocol.Result()
+        result.ntuples = self.ntuples
+        result.binaryTuples = self.binaryTuples
+        result.status = protocol.PGRES_COPY_OUT
+
+        return result
@@ -0,0 +1,129 @@
+"""A hashed timer wheel, for cheap timeouts.
+
+$Id$
+
+THIS SOFTWARE IS UNDER MIT LICENSE.
+Copyright (c) 2006 Perillo Manlio (manlio.perillo@gmail.com)
+
+Read LICENSE file for more informations.
+"""
+
+import math
+import time
+
+from twisted.python import log
+
+
+class Timer(object):
+    """A timer scheduled in a L{TimerWheel}.
+    """
+
+    __slots__ = ("wheel", "expires", "func", "args", "slot")
+
+    def __init__(self, wheel, expires, func, args):
+        self.wheel = wheel
+        self.expires = expires
+        self.func = func
+        self.args = args
+        self.slot = None
+
+    def active(self):
+        return self.slot is not None
+
+    def cancel(self):
+        """Cancel the timer; this is a O(1) operation.
+        """
+
+        if self.slot is not None:
+            del self.slot[self]
+            self.slot = None
+            self.wheel._remove()
+
+
+class TimerWheel(object):
+    """A hashed timer wheel.
+
+    Timers are kept in C{size} slots, each one covering C{resolution}
+    seconds; scheduling and cancelling a timer are O(1) operations,
+    and only one reactor call is used for all the timers.
+
+    The precision of timers is C{resolution} seconds.
+    """
+
+    def __init__(self, resolution=0.1, size=512):
+        self.resolution = resolution
+        self.size = size
+
+        self._slots = [{} for i in range(size)]
+        self._tick = 0     # the current tick
+        self._start = None # the time of tick 0
+        self._count = 0    # the number of active timers
+        self._call = None
+
+    def schedule(self, delay, func, *args):
+        """Call C{func(*args)} after C{delay} seconds.
+
+        @return: the timer
+        @rtype: L{Timer}
+        """
+
+        if self._call is None:
+            # the wheel was stopped; start again from the current tick
+            self._start = time.time() - self._tick * self.resolution
+            self._next()
+
+        ticks = max(int(math.ceil(delay / self.resolution)), 1)
+        timer = Timer(self, self._tick + ticks, func, args)
+
+        slot = timer.slot = self._slots[timer.expires % self.size]
+        slot[timer] = None
+        self._count = self._count + 1
+
+        return timer
+
+    def _remove(self):
+        # called when a timer is removed
+        self._count = self._count - 1
+
+        if not self._count and self._call is not None:
+            # nothing to do, stop the wheel
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+
+    def _next(self):
+        # schedule the next tick
+        from twisted.internet import reactor
+
+        when = self._start + (self._tick + 1) * self.resolution
+        self._call = reactor.callLater(max(when - time.time(), 0),
+                                       self._advance)
+
+    def _advance(self):
+        self._call = None
+        self._tick = self._tick + 1
+
+        tick = self._tick
+        slot = self._slots[tick % self.size]
+        expired = [timer for timer in slot if timer.expires <= tick]
+
+        for timer in expired:
+            if timer.slot is None:
+                # cancelled by a previous timer
+                continue
+            
+            del slot[timer]
+            timer.slot = None
+            self._count = self._count - 1
+
+            try:
+                timer.func(*timer.args)
+            except Exception:
+                log.err()
+
+        if self._count and self._call is None:
+            self._next()
+
+
+# the timer wheel used by pglib
+wheel = TimerWheel()
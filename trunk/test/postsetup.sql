@@ -40,6 +40,10 @@ DROP TABLE TestRW;
 DROP TABLE TestR;
 DROP TABLE TestCopyR;
 DROP TABLE TestCopyRW;
+DROP TABLE TestBatchRW;
+DROP TABLE TestUpsertRW;
+DROP SEQUENCE TestSeq;
+DROP TABLE TestJobsRW;
 
 
 CREATE TABLE TestRW (
@@ -62,6 +66,25 @@ CREATE TABLE TestCopyRW (
        s TEXT
 );
 
+CREATE TABLE TestBatchRW (
+       x INTEGER,
+       s TEXT
+);
+
+CREATE TABLE TestUpsertRW (
+       x INTEGER PRIMARY KEY,
+       s TEXT
+);
+
+CREATE SEQUENCE TestSeq;
+
+CREATE TABLE TestJobsRW (
+       id INTEGER PRIMARY KEY,
+       s TEXT,
+       attempts INTEGER NOT NULL DEFAULT 0,
+       run_after TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+
 
 INSERT INTO TestR VALUES (1, 'A');
 INSERT INTO TestR Values (2, 'B');
@@ -69,6 +92,8 @@ INSERT INTO TestR Values (2, 'B');
 INSERT INTO TestRW VALUES (1, 'A');
 INSERT INTO TestRW Values (2, 'B');
 
+INSERT INTO TestUpsertRW VALUES (1, 'A');
+
 
 COPY TestCopyR (x, s) FROM STDIN WITH DELIMITER '|';
 1|pglib
@@ -82,3 +107,7 @@ GRANT ALL PRIVILEGES ON TestR TO PUBLIC;
 GRANT ALL PRIVILEGES ON TestRW TO PUBLIC;
 GRANT ALL PRIVILEGES ON TestCopyR TO PUBLIC;
 GRANT ALL PRIVILEGES ON TestCopyRW TO PUBLIC;
+GRANT ALL PRIVILEGES ON TestBatchRW TO PUBLIC;
+GRANT ALL PRIVILEGES ON TestUpsertRW TO PUBLIC;
+GRANT ALL PRIVILEGES ON TestSeq TO PUBLIC;
+GRANT ALL PRIVILEGES ON TestJobsRW TO PUBLIC;
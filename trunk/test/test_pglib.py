@@ -11,6 +11,7 @@ Read LICENSE file for more informations.
 
 import os
 import sys
+import zlib
 sys.path.append("../")
 
 try:
@@ -26,6 +27,16 @@ from twisted.trial import unittest
 
 from pglib import ipg
 from pglib import protocol
+from pglib import prepared
+from pglib import batch
+from pglib import cache
+from pglib import bulk
+from pglib import sequence
+from pglib import jobs
+from pglib import binary
+from pglib import textcopy
+from pglib import archive
+from pglib import template
 
 
 
@@ -44,7 +55,9 @@ AUTHENTICATION_ERROR_CODE = "28000" # password authentication failed
 # no pg_hba.conf entry for host "host-address", user "user-name",
 # database "database-name", SSL on/off
 QUERY_ERROR_CODE = "42703" # column "column-name" does not exist
+SYNTAX_ERROR_CODE = "42601" # syntax error at or near "token"
 COPY_ERROR_CODE = "42P01"  # relation "table-name" does not exist
+TEXT_ERROR_CODE = "22P02"  # invalid input syntax for integer
 
 # some type's oid
 INT_OID = 23
@@ -330,6 +343,37 @@ class TestSimpleQuery(TestCaseCommon):
 
         return d
 
+    def testSendQuery(self):
+        d = defer.Deferred()
+        
+        def cbLogin(params):
+            self.protocol.sendQuery("SELECT 1", d.callback, d.errback)
+            return d
+            
+        def cbQuery(result):
+            self.failUnlessEqual(result.rows, [["1"]])
+        
+        return self.login().addCallback(cbLogin
+                                        ).addCallback(cbQuery
+                                                      )
+
+    def testSendQueryFail(self):
+        d = defer.Deferred()
+        
+        def cbLogin(params):
+            self.protocol.sendQuery("SELECT xxx", d.callback, d.errback)
+            return d
+            
+        def ebQuery(reason):
+            code = reason.value.args["C"]
+            self.failUnlessEqual(code, QUERY_ERROR_CODE)
+
+            return reason
+        
+        d2 = self.login().addCallback(cbLogin
+                                      ).addErrback(ebQuery)
+        return self.failUnlessFailure(d2, protocol.PgError)
+
     def testEmptyQuery(self):
         def cbLogin(params):
             return self.protocol.execute("")
@@ -409,31 +453,738 @@ class TestSimpleQuery(TestCaseCommon):
             
         d = self.login()
         return d.addCallback(cbLogin
-                             ).addCallback(cbQuery
-                                           )
-    
-    def testDelete(self):
+                             ).addCallback(cbQuery
+                                           )
+    
+    def testDelete(self):
+        def cbLogin(params):
+            return self.protocol.execute("""
+            DELETE FROM TestRW WHERE x = 1
+            """)
+            
+        def cbQuery(result):
+            self.failUnlessEqual(result.status,
+                                 protocol.PGRES_COMMAND_OK)
+            self.failUnlessEqual(result.nfields, 0)
+            self.failUnlessEqual(result.ntuples, 0)
+            
+            self.failUnlessEqual(result.descriptions, [])
+            self.failUnlessEqual(result.rows, [])
+            self.failUnlessEqual(result.cmdTuples, 1)
+            
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbQuery
+                                           )
+    
+    
+class TestExecuteMany(TestCaseCommon):
+    def testExecuteMany(self):
+        def cbLogin(params):
+            return self.protocol.executemany(
+                "INSERT INTO TestBatchRW VALUES ($1, $2)",
+                [("1", "A"), ("2", None), ("3", "C")]
+                )
+
+        def cbQuery(result):
+            self.failUnlessEqual(result.status,
+                                 protocol.PGRES_COMMAND_OK)
+            self.failUnlessEqual(result.cmdStatus, "INSERT")
+            self.failUnlessEqual(result.cmdTuples, 3)
+
+            self.failUnlessEqual(self.protocol.transactionStatus,
+                                 protocol.PGTRANS_IDLE)
+
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbQuery
+                                           )
+
+    def testExecuteManyTags(self):
+        def cbLogin(params):
+            return self.protocol.executemany(
+                "UPDATE TestBatchRW SET s = $2 WHERE x = $1",
+                [("1", "Z"), ("-1", "Z")], tags=True
+                )
+
+        def cbQuery(result):
+            self.failUnlessEqual(len(result.tags), 2)
+            self.failUnlessEqual(result.tags[1], ("UPDATE", 0, 0))
+
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbQuery
+                                           )
+
+    def testExecuteManyEmpty(self):
+        def cbLogin(params):
+            return self.protocol.execute("SELECT 1")
+
+        def cbSelect(result):
+            return self.protocol.executemany(
+                "INSERT INTO TestBatchRW VALUES ($1, $2)", [], tags=True
+                )
+
+        def cbQuery(result):
+            # not the result of the previous query
+            self.failUnlessEqual(result.status,
+                                 protocol.PGRES_COMMAND_OK)
+            self.failUnlessEqual(result.cmdStatus, None)
+            self.failUnlessEqual(result.cmdTuples, 0)
+            self.failUnlessEqual(result.rows, [])
+            self.failUnlessEqual(result.tags, [])
+
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbSelect
+                                           ).addCallback(cbQuery
+                                                         )
+
+    def testExecuteManyFail(self):
+        def cbLogin(params):
+            return self.protocol.executemany(
+                "INSERT INTO TestBatchRW VALUES ($1, $2)",
+                [("4", "D"), ("xxx", "E"), ("6", "F")]
+                )
+
+        def ebQuery(reason):
+            code = reason.value.args["C"]
+            self.failUnlessEqual(code, TEXT_ERROR_CODE)
+            self.failUnlessEqual(reason.value.index, 1)
+
+            return reason
+
+        d = self.login().addCallback(cbLogin
+                                     ).addErrback(ebQuery)
+        return self.failUnlessFailure(d, protocol.BatchError)
+
+
+class TestCursor(TestCaseCommon):
+    def testCursor(self):
+        rows = []
+        
+        def cbLogin(params):
+            self.cursor = self.protocol.cursor(
+                "SELECT x FROM generate_series(1, $1) AS x", ["1000"],
+                rows=10
+                )
+
+            return self.cursor.fetch().addCallback(cbFetch)
+
+        def cbFetch(batch):
+            if not batch:
+                return
+            
+            rows.extend(batch)
+            return self.cursor.fetch().addCallback(cbFetch)
+            
+        def cbCursor(result):
+            self.failUnless(self.cursor.done)
+            self.failUnlessEqual(len(rows), 1000)
+            self.failUnlessEqual(rows[-1], ["1000"])
+            self.failUnlessEqual(self.cursor.descriptions[0].ftype,
+                                 INT_OID)
+            
+            return self.protocol.execute("SELECT 1")
+            
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbCursor
+                                           )
+
+    def testCursorClose(self):
+        def cbLogin(params):
+            self.cursor = self.protocol.cursor(
+                "SELECT x FROM generate_series(1, 1000) AS x", rows=10
+                )
+
+            return self.cursor.fetch()
+
+        def cbFetch(rows):
+            self.failUnlessEqual(len(rows), 10)
+            
+            return self.cursor.close()
+
+        def cbClose(_):
+            return self.protocol.execute("SELECT 1")
+            
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbFetch
+                                           ).addCallback(cbClose
+                                                         )
+
+    def testCursorFail(self):
+        def cbLogin(params):
+            cursor = self.protocol.cursor("SELECT xxx FROM TestR")
+
+            return cursor.fetch()
+
+        def ebFetch(reason):
+            code = reason.value.args["C"]
+            self.failUnlessEqual(code, QUERY_ERROR_CODE)
+
+            return reason
+        
+        d = self.login().addCallback(cbLogin
+                                     ).addErrback(ebFetch)
+        return self.failUnlessFailure(d, protocol.PgError)
+
+
+class TestStatementCache(TestCaseCommon):
+    def testPromotion(self):
+        query = "SELECT x, s FROM TestR ORDER BY x"
+        
+        def cbLogin(params):
+            self.protocol.statements = prepared.StatementCache(
+                threshold=2
+                )
+
+            d = self.protocol.execute(query)
+            for i in range(3):
+                d.addCallback(cbQuery)
+
+            return d
+        
+        def cbQuery(result):
+            self.failUnlessEqual(result.status,
+                                 protocol.PGRES_TUPLES_OK)
+            self.failUnlessEqual(result.descriptions[0].fname, "x")
+            self.failUnlessEqual(result.rows, 
+                                 [["1", "A"], ["2", "B"]])
+
+            return self.protocol.execute(query)
+
+        def cbStats(result):
+            stats = self.protocol.statements.stats()
+            
+            self.failUnlessEqual(stats["promotions"], 1)
+            self.failUnlessEqual(stats["hits"], 2)
+            self.failUnlessEqual(stats["misses"], 2)
+            
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbStats
+                                           )
+
+    def testMultipleCommands(self):
+        def cbLogin(params):
+            self.protocol.statements = prepared.StatementCache(
+                threshold=1
+                )
+
+            return self.protocol.execute("BEGIN; SELECT 1")
+        
+        def cbQuery(result):
+            self.failUnlessEqual(self.protocol.statements.promotions, 0)
+            self.failUnlessEqual(self.protocol.transactionStatus,
+                                 protocol.PGTRANS_INTRANS)
+
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbQuery
+                                           )
+
+
+class TestTemplate(unittest.TestCase):
+    def testPositional(self):
+        quote = template.Quoter()
+        query = template.compile("SELECT %s, %s, 100%%").interpolate(
+            ("it's", None), quote
+            )
+
+        self.failUnlessEqual(query, "SELECT 'it''s', NULL, 100%")
+
+    def testNamed(self):
+        quote = template.Quoter()
+        query = template.compile("SELECT %(x)s, %(y)s, %(x)s"
+                                 ).interpolate({"x": 1, "y": True}, quote)
+
+        self.failUnlessEqual(query, "SELECT 1, true, 1")
+
+    def testStandardStrings(self):
+        params = ("a\\b",)
+        tpl = template.compile("SELECT %s")
+
+        query = tpl.interpolate(params, template.Quoter(True))
+        self.failUnlessEqual(query, "SELECT 'a\\b'")
+
+        query = tpl.interpolate(params, template.Quoter(False))
+        self.failUnlessEqual(query, "SELECT E'a\\\\b'")
+
+    def testNegative(self):
+        query = template.compile("SELECT 10-%s, 10-%s, 10-%s").interpolate(
+            (-1, -1.5, -0.0), template.Quoter()
+            )
+
+        self.failUnlessEqual(query, "SELECT 10-(-1), 10-(-1.5), 10-(-0.0)")
+
+    def testMultibyte(self):
+        # the second byte of the character is a backslash
+        quote = template.Quoter(False, "GBK")
+        s = u"\u4e57' OR 1=1 --"
+
+        self.failUnlessEqual(quote(s), "'\x81\\'' OR 1=1 --'")
+        self.failUnlessEqual(quote(s.encode("gbk")), quote(s))
+
+    def testMixed(self):
+        self.failUnlessRaises(template.TemplateError, template.compile,
+                              "SELECT %s, %(x)s")
+
+
+class TestTextCopy(unittest.TestCase):
+    rows = [
+        ((1, "pglib", None, 1.5, True),
+         ["1", "pglib", None, "1.5", "t"]),
+        ((2, "tab\there", "new\nline\r", u"\xe8", False),
+         ["2", "tab\there", "new\nline\r", "\xc3\xa8", "f"]),
+        ((3, "back\\slash", "\\N", 0, None),
+         ["3", "back\\slash", "\\N", "0", None]),
+        ]
+
+    def testRoundTrip(self):
+        for row, expected in self.rows:
+            line = textcopy.encodeRow(row)
+
+            self.failUnlessEqual(line.count("\n"), 1)
+            self.failUnlessEqual(textcopy.decodeLine(line), expected)
+
+    def testDecode(self):
+        line = "a\\tb\t\\N\t\\101\\x42\n"
+        self.failUnlessEqual(textcopy.decodeLine(line), ["a\tb", None, "AB"])
+
+
+class TestBinaryCopy(unittest.TestCase):
+    types = ("int4", "int8", "float8")
+    rows = [(i, i * 10 ** 10, i / 4.0) for i in range(1000)]
+    rows[500] = (500, None, 125.0)
+
+    def decode(self, chunkSize):
+        encoder = binary.BinaryEncoder(self.types)
+        data = binary.HEADER + "".join(
+            [encoder.encodeRow(row) for row in self.rows]) + binary.TRAILER
+
+        consumer = binary.BinaryConsumer(self.types)
+        consumer.description(len(self.types), 1)
+        for i in range(0, len(data), chunkSize):
+            consumer.write(data[i:i + chunkSize])
+        consumer.close()
+
+        return consumer
+
+    def testDecode(self):
+        for chunkSize in (7, 1000, 2 ** 16):
+            consumer = self.decode(chunkSize)
+
+            self.failUnlessEqual(consumer.count, 1000)
+            self.failUnlessEqual(list(consumer.columns[0]), range(1000))
+            self.failUnlessEqual(consumer.columns[1][499:502].tolist(),
+                                 [4990000000000L, 0, 5010000000000L])
+            self.failUnlessEqual(list(consumer.columns[2]),
+                                 [i / 4.0 for i in range(1000)])
+            self.failUnlessEqual(list(consumer.nulls[1]).count(1), 1)
+            self.failUnlessEqual(consumer.nulls[1][500], 1)
+
+
+class TestInterpolation(TestCaseCommon):
+    def testInterpolation(self):
+        def cbLogin(params):
+            return self.protocol.execute(
+                "SELECT %s, %s, %s", ("it's a \\ test", None, 10)
+                )
+
+        def cbQuery(result):
+            self.failUnlessEqual(result.rows,
+                                 [["it's a \\ test", None, "10"]])
+            
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbQuery
+                                           )
+
+
+class TestStatementBatcher(TestCaseCommon):
+    def testBatch(self):
+        def cbLogin(params):
+            batcher = batch.StatementBatcher(self.protocol)
+
+            dl = []
+            for i in range(10, 15):
+                d = batcher.execute(
+                    "INSERT INTO TestBatchRW VALUES (%s, 'batch')", (i,)
+                    )
+                dl.append(d)
+            dl.append(batcher.execute("SELECT count(*) FROM TestR"))
+            
+            return defer.gatherResults(dl)
+
+        def cbBatch(results):
+            for result in results[:-1]:
+                self.failUnlessEqual(result.cmdStatus, "INSERT")
+                self.failUnlessEqual(result.cmdTuples, 1)
+
+            self.failUnlessEqual(results[-1].rows, [["2"]])
+            
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbBatch
+                                           )
+
+    def testBatchFail(self):
+        def cbLogin(params):
+            batcher = batch.StatementBatcher(self.protocol)
+
+            d1 = batcher.execute("INSERT INTO TestBatchRW VALUES (20)")
+            d2 = batcher.execute("SELECT xxx FROM TestBatchRW")
+            d3 = batcher.execute("INSERT INTO TestBatchRW VALUES (21)")
+
+            d2.addErrback(ebQuery)
+            self.failUnlessFailure(d2, protocol.PgError)
+
+            return defer.gatherResults([d1, d2, d3])
+
+        def ebQuery(reason):
+            code = reason.value.args["C"]
+            self.failUnlessEqual(code, QUERY_ERROR_CODE)
+
+            return reason
+
+        def cbBatch(results):
+            return self.protocol.execute(
+                "SELECT x FROM TestBatchRW WHERE x IN (20, 21) ORDER BY x"
+                ).addCallback(cbSelect)
+
+        def cbSelect(result):
+            self.failUnlessEqual(result.rows, [["20"], ["21"]])
+            
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbBatch
+                                           )
+
+    def testBatchSyntaxError(self):
+        def cbLogin(params):
+            batcher = batch.StatementBatcher(self.protocol)
+
+            d1 = batcher.execute("INSERT INTO TestBatchRW VALUES (22)")
+            d2 = batcher.execute("INSERT INTO TestBatchRW VALUES (23)")
+            d3 = batcher.execute("INSERT INTO TestBatchRW VALUE (24)")
+            d4 = batcher.execute("INSERT INTO TestBatchRW VALUES (25)")
+
+            d3.addErrback(ebQuery)
+            self.failUnlessFailure(d3, protocol.PgError)
+
+            return defer.gatherResults([d1, d2, d3, d4])
+
+        def ebQuery(reason):
+            code = reason.value.args["C"]
+            self.failUnlessEqual(code, SYNTAX_ERROR_CODE)
+
+            return reason
+
+        def cbBatch(results):
+            return self.protocol.execute(
+                "SELECT x FROM TestBatchRW WHERE x BETWEEN 22 AND 25 "
+                "ORDER BY x"
+                ).addCallback(cbSelect)
+
+        def cbSelect(result):
+            self.failUnlessEqual(result.rows, [["22"], ["23"], ["25"]])
+            
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbBatch
+                                           )
+
+    def testLoader(self):
+        def cbLogin(params):
+            self.loader = batch.Loader(
+                self.protocol, "SELECT x, s FROM TestR WHERE x = ANY(%s)"
+                )
+
+            return defer.gatherResults([self.loader.load(key)
+                                        for key in (1, 2, 1, 3)])
+
+        def cbLoad(results):
+            self.failUnlessEqual(results, [[["1", "A"]], [["2", "B"]],
+                                           [["1", "A"]], []])
+            self.failUnlessEqual(self.loader.queries, 1)
+            self.failUnlessEqual(self.loader.requests, 4)
+
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbLoad
+                                           )
+
+    def testGroupCommit(self):
+        def cbLogin(params):
+            group = batch.GroupCommit(self.protocol)
+
+            d1 = group.execute("INSERT INTO TestBatchRW VALUES (30)")
+            d2 = group.execute("INSERT INTO TestBatchRW VALUES ('x')")
+            d3 = group.execute("INSERT INTO TestBatchRW VALUES (31)")
+
+            self.failUnlessFailure(d2, protocol.PgError)
+
+            return defer.gatherResults([d1, d2, d3])
+
+        def cbGroup(results):
+            self.failUnlessEqual(results[0].cmdTuples, 1)
+            self.failUnlessEqual(results[2].cmdTuples, 1)
+
+            return self.protocol.execute(
+                "SELECT x FROM TestBatchRW WHERE x IN (30, 31) ORDER BY x"
+                ).addCallback(cbSelect)
+
+        def cbSelect(result):
+            self.failUnlessEqual(result.rows, [["30"], ["31"]])
+            
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbGroup
+                                           )
+
+    def testGroupCommitSyntaxError(self):
+        def cbLogin(params):
+            group = batch.GroupCommit(self.protocol)
+
+            d1 = group.execute("INSERT INTO TestBatchRW VALUES (32)")
+            d2 = group.execute("INSERT INTO TestBatchRW VALUE (33)")
+            d3 = group.execute("INSERT INTO TestBatchRW VALUES (34)")
+
+            d2.addErrback(ebQuery)
+            self.failUnlessFailure(d2, protocol.PgError)
+
+            return defer.gatherResults([d1, d2, d3])
+
+        def ebQuery(reason):
+            code = reason.value.args["C"]
+            self.failUnlessEqual(code, SYNTAX_ERROR_CODE)
+
+            return reason
+
+        def cbGroup(results):
+            return self.protocol.execute(
+                "SELECT x FROM TestBatchRW WHERE x IN (32, 33, 34) "
+                "ORDER BY x"
+                ).addCallback(cbSelect)
+
+        def cbSelect(result):
+            self.failUnlessEqual(result.rows, [["32"], ["34"]])
+            self.failUnlessEqual(self.protocol.transactionStatus,
+                                 protocol.PGTRANS_IDLE)
+            
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbGroup
+                                           )
+
+
+class TestSingleFlight(TestCaseCommon):
+    def testSingleFlight(self):
+        def cbLogin(params):
+            self.flight = cache.SingleFlight(self.protocol, copy=True)
+
+            dl = []
+            for i in range(5):
+                dl.append(self.flight.execute(
+                        "SELECT x, s FROM TestR WHERE x = %s", (1,)
+                        ))
+
+            return defer.gatherResults(dl)
+
+        def cbQuery(results):
+            self.failUnlessEqual(self.flight.misses, 1)
+            self.failUnlessEqual(self.flight.hits, 4)
+            
+            for result in results:
+                self.failUnlessEqual(result.rows, [["1", "A"]])
+
+            self.failIfIdentical(results[0].rows, results[1].rows)
+            
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbQuery
+                                           )
+
+    def testCopyModified(self):
+        def cbLogin(params):
+            flight = cache.SingleFlight(self.protocol, copy=True)
+
+            d1 = flight.execute("SELECT x, s FROM TestR WHERE x = 1")
+            d1.addCallback(cbModify)
+            d2 = flight.execute("SELECT x, s FROM TestR WHERE x = 1")
+
+            return defer.gatherResults([d1, d2])
+
+        def cbModify(result):
+            # the first caller modifies its result
+            result.rows.append(["2", "B"])
+
+            return result
+
+        def cbQuery(results):
+            self.failUnlessEqual(results[1].rows, [["1", "A"]])
+            
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbQuery
+                                           )
+
+
+class TestResultCache(TestCaseCommon):
+    def testInvalidation(self):
+        def cbLogin(params):
+            self.cache = cache.ResultCache(self.protocol)
+            
+            return self.cache.execute("SELECT x, s FROM TestR WHERE x = 1",
+                                      tags=["testr"])
+
+        def cbQuery(result):
+            self.failUnlessEqual(result.rows, [["1", "A"]])
+            
+            return self.cache.execute("SELECT x, s FROM TestR WHERE x = 1",
+                                      tags=["testr"])
+
+        def cbCached(result):
+            self.failUnlessEqual(self.cache.hits, 1)
+            self.failUnlessEqual(self.cache.misses, 1)
+
+            return self.protocol.execute("NOTIFY testr").addCallback(
+                lambda _: waitFor(0.5))
+
+        def cbNotify(_):
+            self.failUnlessEqual(self.cache.invalidations, 1)
+            self.failUnlessEqual(self.cache.size, 0)
+            
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbQuery
+                                           ).addCallback(cbCached
+                                                         ).addCallback(cbNotify
+                                                                       )
+
+    def testInvalidationInProgress(self):
+        def cbLogin(params):
+            self.cache = cache.ResultCache(self.protocol, listen=False)
+            query = "SELECT x, s FROM TestR WHERE x = 1"
+
+            d1 = self.cache.execute(query, tags=["testr"])
+            self.cache.invalidate("testr")
+            # joins the query started before the invalidation
+            d2 = self.cache.execute(query, tags=["testr"])
+
+            return defer.gatherResults([d1, d2])
+
+        def cbQuery(results):
+            self.failUnlessEqual(self.cache.size, 0)
+            
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbQuery
+                                           )
+
+class TestSequence(TestCaseCommon):
+    def testAllocate(self):
+        def cbLogin(params):
+            self.allocator = sequence.allocator(self.protocol, "TestSeq",
+                                                blockSize=10, lowWater=2)
+            self.failUnlessIdentical(
+                self.allocator, sequence.allocator(self.protocol, "TestSeq"))
+
+            return defer.gatherResults([self.allocator.allocate()
+                                        for i in range(15)])
+
+        def cbAllocate(values):
+            self.failUnlessEqual(len(values), 15)
+            self.failUnlessEqual(len(dict.fromkeys(values)), 15)
+            self.failUnlessEqual(self.allocator.queries, 2)
+
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbAllocate
+                                           )
+
+class TestJobQueue(TestCaseCommon):
+    def testConsume(self):
+        def cbLogin(params):
+            return self.protocol.execute(
+                "INSERT INTO TestJobsRW VALUES (1, 'a'); "
+                "INSERT INTO TestJobsRW VALUES (2, 'b')"
+                )
+
+        def cbInsert(_):
+            self.jobs = []
+            self.queue = jobs.JobQueue([self.protocol], "TestJobsRW",
+                                       self.jobs.append,
+                                       channel="testjobs",
+                                       columns=("id", "s"))
+            self.queue.start()
+
+            return waitFor(0.5)
+
+        def cbWait(_):
+            self.failUnlessEqual(self.jobs, [["1", "a"], ["2", "b"]])
+            self.failUnlessEqual(self.queue.processed, 2)
+            
+            return self.queue.stop()
+
+        def cbStop(_):
+            return self.protocol.execute("SELECT count(*) FROM TestJobsRW")
+
+        def cbSelect(result):
+            self.failUnlessEqual(result.rows, [["0"]])
+
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbInsert
+                                           ).addCallback(cbWait
+                                                         ).addCallback(cbStop
+                                                                       ).addCallback(cbSelect
+                                                                                     )
+
+    def testRetry(self):
         def cbLogin(params):
-            return self.protocol.execute("""
-            DELETE FROM TestRW WHERE x = 1
-            """)
-            
-        def cbQuery(result):
-            self.failUnlessEqual(result.status,
-                                 protocol.PGRES_COMMAND_OK)
-            self.failUnlessEqual(result.nfields, 0)
-            self.failUnlessEqual(result.ntuples, 0)
-            
-            self.failUnlessEqual(result.descriptions, [])
-            self.failUnlessEqual(result.rows, [])
-            self.failUnlessEqual(result.cmdTuples, 1)
+            return self.protocol.execute(
+                "INSERT INTO TestJobsRW VALUES (3, 'bad'); "
+                "INSERT INTO TestJobsRW VALUES (4, 'c')"
+                )
+
+        def handler(row):
+            if row[1] == "bad":
+                raise ValueError("bad job")
+
+        def cbInsert(_):
+            self.queue = jobs.JobQueue([self.protocol], "TestJobsRW",
+                                       handler, columns=("id", "s"),
+                                       batchSize=2, backoff=60)
+            self.queue.start()
+
+            return waitFor(0.5)
+
+        def cbWait(_):
+            # the failed job is not dequeued again at once
+            self.failUnlessEqual(self.queue.processed, 1)
+            self.failUnlessEqual(self.queue.failed, 1)
+            self.flushLoggedErrors(ValueError)
             
+            return self.queue.stop()
+
+        def cbStop(_):
+            return self.protocol.execute(
+                "SELECT id, attempts, run_after > now() FROM TestJobsRW")
+
+        def cbSelect(result):
+            self.failUnlessEqual(result.rows, [["3", "1", "t"]])
+
         d = self.login()
         return d.addCallback(cbLogin
-                             ).addCallback(cbQuery
-                                           )
-    
-    
+                             ).addCallback(cbInsert
+                                           ).addCallback(cbWait
+                                                         ).addCallback(cbStop
+                                                                       ).addCallback(cbSelect
+                                                                                     )
+
 
 class TestFunctionCall(TestCaseCommon):
     # XXX TODO add a test for binary format
@@ -519,6 +1270,31 @@ class TestCancel(TestCaseCommon):
         reactor.callLater(2, cancel)
         return self.failUnlessFailure(d, protocol.PgError)
 
+    def testDeadline(self):
+        def cbLogin(params):
+            # the query is cancelled before completion
+            return self.protocol.execute("SELECT sleep(5)", timeout=1)
+
+        d = self.login().addCallback(cbLogin)
+        return self.failUnlessFailure(d, protocol.QueryTimeoutError)
+
+    def testDeadlineNext(self):
+        def cbLogin(params):
+            d = self.protocol.execute("SELECT sleep(5)", timeout=1)
+            d.addErrback(lambda reason: reason.trap(
+                    protocol.QueryTimeoutError))
+            
+            # the next query is not affected
+            return self.protocol.execute("SELECT 1", timeout=3)
+            
+        def cbQuery(result):
+            self.failUnlessEqual(result.rows, [["1"]])
+
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbQuery
+                                           )
+
 
 class TestSSL(TestCaseCommon):
     # XXX sslmode "prefer" and "allow" cannot be tested
@@ -632,6 +1408,309 @@ class TestCopy(TestCaseCommon):
                                      ).addCallback(cbCopy)
         return d
 
+    def testCopyInLarge(self):
+        def cbLogin(params):
+            # more data than the transport buffer
+            lines = ["%d\tlarge\n" % i for i in range(100000)]
+            self.protocol.producer = bulk.LinesProducer(lines)
+            
+            return self.protocol.execute("COPY TestCopyRW FROM STDIN")
+
+        def cbCopy(result):
+            return self.protocol.execute(
+                "SELECT count(*) FROM TestCopyRW WHERE s = 'large'")
+
+        def cbSelect(result):
+            self.failUnlessEqual(result.rows, [["100000"]])
+                                 
+        d = self.login().addCallback(cbLogin
+                                     ).addCallback(cbCopy
+                                                   ).addCallback(cbSelect)
+        return d
+
+    def testCopyInErrorThenCopy(self):
+        def cbLogin(params):
+            # the backend fails the COPY at the first line, while the
+            # rest of the data is still being sent
+            lines = ["%d\tfailed\n" % i for i in range(100000)]
+            lines[0] = "x\tfailed\n"
+            
+            request = protocol.PgRequest("Q", "COPY TestCopyRW FROM STDIN\0")
+            request.producer = bulk.LinesProducer(lines)
+            d1 = self.protocol.sendMessage(request)
+            d1.addErrback(ebCopy)
+            self.failUnlessFailure(d1, protocol.PgError)
+
+            # queued at once, and sent after the failure
+            request = protocol.PgRequest("Q", "COPY TestCopyRW FROM STDIN\0")
+            request.producer = bulk.LinesProducer(["300\tafter\n"])
+            d2 = self.protocol.sendMessage(request)
+
+            return defer.gatherResults([d1, d2])
+
+        def ebCopy(reason):
+            code = reason.value.args["C"]
+            self.failUnlessEqual(code, TEXT_ERROR_CODE)
+
+            return reason
+
+        def cbCopy(results):
+            return self.protocol.execute(
+                "SELECT s, count(*) FROM TestCopyRW "
+                "WHERE s IN ('failed', 'after') GROUP BY s")
+
+        def cbSelect(result):
+            self.failUnlessEqual(result.rows, [["after", "1"]])
+                                 
+        d = self.login().addCallback(cbLogin
+                                     ).addCallback(cbCopy
+                                                   ).addCallback(cbSelect)
+        return d
+
+    def testCopyInFile(self):
+        def cbLogin(params):
+            self.path = self.mktemp()
+            fp = open(self.path, "wb")
+            fp.write("200\tfile\n201\tfile\n")
+            fp.close()
+            
+            self.protocol.producer = bulk.FileProducer(self.path,
+                                                       useMmap=True)
+            
+            return self.protocol.execute("COPY TestCopyRW FROM STDIN")
+
+        def cbCopy(result):
+            return self.protocol.execute(
+                "SELECT x FROM TestCopyRW WHERE s = 'file' ORDER BY x")
+
+        def cbSelect(result):
+            self.failUnlessEqual(result.rows, [["200"], ["201"]])
+                                 
+        d = self.login().addCallback(cbLogin
+                                     ).addCallback(cbCopy
+                                                   ).addCallback(cbSelect)
+        return d
+
+    def testCopyInFileFail(self):
+        def cbLogin(params):
+            # the backend fails the COPY at the first line, while the
+            # rest of the file is still being sent
+            self.path = self.mktemp()
+            fp = open(self.path, "wb")
+            fp.write("x\tfilefail\n")
+            for i in range(100000):
+                fp.write("%d\tfilefail\n" % i)
+            fp.close()
+
+            self.producer = bulk.FileProducer(self.path, blockSize=4096,
+                                              useMmap=True)
+            self.protocol.producer = self.producer
+
+            return self.protocol.execute("COPY TestCopyRW FROM STDIN")
+
+        def ebCopy(reason):
+            code = reason.value.args["C"]
+            self.failUnlessEqual(code, TEXT_ERROR_CODE)
+
+            # the file and the memory map have been released
+            self.failUnlessEqual(self.producer._file, None)
+            self.failUnlessEqual(self.producer._mmap, None)
+
+            return reason
+
+        d = self.login().addCallback(cbLogin
+                                     ).addErrback(ebCopy)
+        return self.failUnlessFailure(d, protocol.PgError)
+
+    def testCopyInBinary(self):
+        def cbLogin(params):
+            rows = [(300, "binary"), (301, None), (302, u"binary")]
+            self.protocol.producer = binary.BinaryRowsProducer(
+                rows, ("int4", "text"))
+            
+            return self.protocol.execute(bulk.copyQuery(
+                    "TestCopyRW", ("x", "s"), binary=True))
+
+        def cbCopy(result):
+            return self.protocol.execute(
+                "SELECT x, s FROM TestCopyRW WHERE x >= 300 ORDER BY x")
+
+        def cbSelect(result):
+            self.failUnlessEqual(result.rows, [["300", "binary"],
+                                               ["301", None],
+                                               ["302", "binary"]])
+                                 
+        d = self.login().addCallback(cbLogin
+                                     ).addCallback(cbCopy
+                                                   ).addCallback(cbSelect)
+        return d
+
+    def testParallelLoader(self):
+        def cbLogin(params):
+            rows = [(i, "parallel") for i in range(400, 450)]
+            loader = bulk.ParallelLoader([self.protocol], "TestCopyRW",
+                                         ("x", "s"), transaction=True)
+            
+            return loader.load(bulk.rowChunks(rows, chunkRows=20))
+
+        def cbLoad(stats):
+            self.failUnlessEqual(stats["rows"], 50)
+            self.failUnlessEqual(stats["chunks"], 3)
+            self.failUnlessEqual(stats["connections"][0]["rows"], 50)
+            
+            return self.protocol.execute(
+                "SELECT count(*) FROM TestCopyRW WHERE s = 'parallel'")
+
+        def cbSelect(result):
+            self.failUnlessEqual(result.rows, [["50"]])
+                                 
+        d = self.login().addCallback(cbLogin
+                                     ).addCallback(cbLoad
+                                                   ).addCallback(cbSelect)
+        return d
+
+    def testBisectingLoader(self):
+        def cbLogin(params):
+            self.rejects = StringIO()
+            lines = ["%d\tbisect\n" % i for i in range(600, 610)]
+            lines[4] = "x\tbisect\n"
+            loader = bulk.BisectingLoader(self.protocol, "TestCopyRW",
+                                          ("x", "s"), chunkRows=4,
+                                          rejects=self.rejects)
+            
+            return loader.load(lines)
+
+        def cbLoad(stats):
+            self.failUnlessEqual(stats["rows"], 9)
+            self.failUnlessEqual(stats["rejected"], 1)
+            self.failUnlessEqual(self.rejects.getvalue(), "x\tbisect\n")
+            
+            return self.protocol.execute(
+                "SELECT count(*) FROM TestCopyRW WHERE s = 'bisect'")
+
+        def cbSelect(result):
+            self.failUnlessEqual(result.rows, [["9"]])
+                                 
+        d = self.login().addCallback(cbLogin
+                                     ).addCallback(cbLoad
+                                                   ).addCallback(cbSelect)
+        return d
+
+    def testBisectingLoaderLargeChunks(self):
+        def cbLogin(params):
+            # the chunks are larger than the transport buffer, so the
+            # backend fails a COPY while its data is still being sent
+            self.rejects = StringIO()
+            lines = ["%d\tbisectlarge\n" % i for i in range(100000)]
+            lines[10] = "x\tbisectlarge\n"
+            loader = bulk.BisectingLoader(self.protocol, "TestCopyRW",
+                                          ("x", "s"), chunkRows=50000,
+                                          rejects=self.rejects)
+
+            return loader.load(lines)
+
+        def cbLoad(stats):
+            self.failUnlessEqual(stats["rows"], 99999)
+            self.failUnlessEqual(stats["rejected"], 1)
+            self.failUnlessEqual(self.rejects.getvalue(),
+                                 "x\tbisectlarge\n")
+
+            return self.protocol.execute(
+                "SELECT count(*), count(DISTINCT x), sum(x) FROM TestCopyRW "
+                "WHERE s = 'bisectlarge'")
+
+        def cbSelect(result):
+            total = sum(range(100000)) - 10
+            self.failUnlessEqual(result.rows,
+                                 [["99999", "99999", str(total)]])
+
+        d = self.login().addCallback(cbLogin
+                                     ).addCallback(cbLoad
+                                                   ).addCallback(cbSelect)
+        return d
+
+    def testCopyPipe(self):
+        def cbLogin(params):
+            factory = TestFactory()
+            reactor.connectTCP(host, port, factory)
+
+            return factory.deferred.addCallback(cbConnect)
+
+        def cbConnect(source):
+            self.source = source
+
+            return source.login(
+                user="pglib_md5", password="test", database="pglib"
+                )
+
+        def cbSourceLogin(params):
+            pipe = bulk.CopyPipe(self.source, self.protocol, highWater=8)
+
+            return pipe.copy("COPY TestCopyR TO STDOUT",
+                             bulk.copyQuery("TestCopyRW", ("x", "s")))
+
+        def cbCopy(stats):
+            self.source.finish()
+            self.failUnlessEqual(stats["bytes"], len(copyData))
+
+            return self.protocol.execute(
+                "SELECT count(*) FROM TestCopyRW WHERE s = 'perillo'")
+
+        def cbSelect(result):
+            self.failUnless(int(result.rows[0][0]) >= 1)
+                                 
+        d = self.login().addCallback(cbLogin
+                                     ).addCallback(cbSourceLogin
+                                                   ).addCallback(cbCopy
+                                                                 ).addCallback(cbSelect)
+        return d
+
+    def testCopyPipeDestinationError(self):
+        # about 60 MB of rows, that the destination refuses
+        size = 5000000
+
+        def cbLogin(params):
+            factory = TestFactory()
+            reactor.connectTCP(host, port, factory)
+
+            return factory.deferred.addCallback(cbConnect)
+
+        def cbConnect(source):
+            self.source = source
+
+            return source.login(
+                user="pglib_md5", password="test", database="pglib"
+                )
+
+        def cbSourceLogin(params):
+            self.pipe = bulk.CopyPipe(self.source, self.protocol)
+
+            return self.pipe.copy(
+                "COPY (SELECT 'x' || i, 'pipe' "
+                "FROM generate_series(1, %d) AS i) TO STDOUT" % size,
+                bulk.copyQuery("TestCopyRW", ("x", "s")))
+
+        def ebCopy(reason):
+            code = reason.value.args["C"]
+            self.failUnlessEqual(code, TEXT_ERROR_CODE)
+            self.failUnless(self.pipe.stats["bytes"] < size * 10)
+
+            return reason
+
+        def cbFailed(reason):
+            # the source has been cancelled, and can be used again
+            return self.source.execute("SELECT 1")
+
+        def cbSelect(result):
+            self.source.finish()
+            self.failUnlessEqual(result.rows, [["1"]])
+
+        d = self.login().addCallback(cbLogin
+                                     ).addCallback(cbSourceLogin
+                                                   ).addErrback(ebCopy)
+        d = self.failUnlessFailure(d, protocol.PgError)
+        return d.addCallback(cbFailed).addCallback(cbSelect)
+
     def testCopyOut(self):
         def cbLogin(params):
             self.protocol.consumer = Consumer()
@@ -651,6 +1730,91 @@ class TestCopy(TestCaseCommon):
                                      ).addCallback(cbCopy)
         return d
 
+    def testCopyOutBuffered(self):
+        def cbLogin(params):
+            self.protocol.consumer = Consumer()
+            self.protocol.copyBufferSize = 2 ** 16
+            
+            return self.protocol.execute("""
+            COPY TestCopyR TO STDOUT WITH delimiter '|'
+            """)
+        
+        def cbCopy(result):
+            data = self.protocol.consumer.data
+
+            self.failUnlessEqual(result.status, protocol.PGRES_COPY_OUT)
+            self.failUnlessEqual(data, copyData)
+                
+        d = self.login().addCallback(cbLogin
+                                     ).addCallback(cbCopy)
+        return d
+
+    def testCopyOutBinary(self):
+        def cbLogin(params):
+            self.protocol.consumer = binary.BinaryConsumer(("int4", "text"))
+            
+            return self.protocol.execute(
+                "COPY TestCopyR TO STDOUT WITH BINARY")
+        
+        def cbCopy(result):
+            consumer = self.protocol.consumer
+
+            self.failUnlessEqual(consumer.count, 3)
+            self.failUnlessEqual(list(consumer.columns[0]), [1, 2, 3])
+            self.failUnlessEqual(consumer.columns[1],
+                                 ["pglib", "manlio", "perillo"])
+            self.failUnlessEqual(list(consumer.nulls[0]), [0, 0, 0])
+                
+        d = self.login().addCallback(cbLogin
+                                     ).addCallback(cbCopy)
+        return d
+
+    def testCopyOutText(self):
+        def cbLogin(params):
+            self.protocol.consumer = textcopy.TextConsumer()
+            
+            return self.protocol.execute("COPY TestCopyR TO STDOUT")
+        
+        def cbCopy(result):
+            rows = self.protocol.consumer.rows
+
+            self.failUnlessEqual(result.status, protocol.PGRES_COPY_OUT)
+            self.failUnlessEqual(rows, [["1", "pglib"], ["2", "manlio"],
+                                        ["3", "perillo"]])
+                
+        d = self.login().addCallback(cbLogin
+                                     ).addCallback(cbCopy)
+        return d
+
+    def testCopyOutArchive(self):
+        def cbLogin(params):
+            self.fp = StringIO()
+            self.protocol.consumer = archive.ArchiveConsumer(
+                self.fp, "zlib", threaded=True, maxQueue=1,
+                connection=self.protocol)
+            
+            return self.protocol.execute("""
+            COPY TestCopyR TO STDOUT WITH delimiter '|'
+            """)
+        
+        def cbExecute(result):
+            # wait for the worker
+            return self.protocol.consumer.finished
+
+        def cbCopy(result):
+            data = zlib.decompress(self.fp.getvalue())
+
+            self.failUnlessEqual(result.status, protocol.PGRES_COPY_OUT)
+            self.failUnlessEqual(data, copyData)
+            self.failUnlessEqual(result.stats["bytes"], len(copyData))
+            self.failUnlessEqual(result.stats["compressed"],
+                                 len(self.fp.getvalue()))
+                
+        d = self.login().addCallback(cbLogin
+                                     ).addCallback(cbExecute
+                                                   ).addCallback(cbCopy)
+        return d
+
     def testCopyInFail(self):
         def cbLogin(params):
             self.protocol.producer = Producer(fail=True)
@@ -691,3 +1855,52 @@ class TestCopy(TestCaseCommon):
                                      ).addErrback(ebCopy)
         
         return self.failUnlessFailure(d, protocol.PgError)
+
+    def testTableWriter(self):
+        def cbLogin(params):
+            self.writer = bulk.TableWriter(self.protocol, "TestCopyRW",
+                                           ("x", "s"), maxRows=2)
+            for i in range(100, 105):
+                self.writer.write((i, "tab\tand\\backslash"))
+
+            return self.writer.flush()
+
+        def cbFlush(_):
+            self.failUnlessEqual(self.writer.rows, 5)
+
+            return self.protocol.execute(
+                "SELECT count(*) FROM TestCopyRW WHERE s = %s AND x >= 100",
+                ("tab\tand\\backslash", ))
+
+        def cbSelect(result):
+            self.failUnlessEqual(result.rows, [["5"]])
+
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbFlush
+                                           ).addCallback(cbSelect
+                                                         )
+
+    def testUpsert(self):
+        def cbLogin(params):
+            upsert = bulk.BulkUpsert(self.protocol, "TestUpsertRW",
+                                     ("x", "s"), ("x", ), chunkRows=2)
+
+            return upsert.upsert([(1, "X"), (2, "Y"), (3, "Z")])
+
+        def cbUpsert(stats):
+            self.failUnlessEqual(stats, {"rows": 3, "inserted": 2,
+                                         "updated": 1, "chunks": 2})
+
+            return self.protocol.execute(
+                "SELECT x, s FROM TestUpsertRW ORDER BY x")
+
+        def cbSelect(result):
+            self.failUnlessEqual(result.rows, [["1", "X"], ["2", "Y"],
+                                               ["3", "Z"]])
+
+        d = self.login()
+        return d.addCallback(cbLogin
+                             ).addCallback(cbUpsert
+                                           ).addCallback(cbSelect
+                                                         )